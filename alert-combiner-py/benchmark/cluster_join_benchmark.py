@@ -0,0 +1,79 @@
+"""
+compares the row-wise cluster join and aggregation that get_forta_alerts used before with the vectorized add_cluster_identifiers (cluster codes are mapped back to identifiers to compare the output)
+run from the alert-combiner-py folder: python3 -m benchmark.cluster_join_benchmark [exploded_rows ...]
+"""
+import random
+import sys
+import time
+
+import pandas as pd
+
+from src.address_clusters import AddressClusters
+from src.agent import add_cluster_identifiers
+from src.constants import CATEGORICAL_ALERT_FIELDS
+
+
+def add_cluster_identifiers_row_wise(df_forta_alerts: pd.DataFrame, df_address_clusters: pd.DataFrame) -> pd.DataFrame:
+    df_forta_alerts_exploded = df_forta_alerts.explode("addresses")
+    df_forta_alerts_exploded["addresses"] = df_forta_alerts_exploded["addresses"].apply(lambda x: x.lower())
+    df_forta_alerts_exploded = df_forta_alerts_exploded.set_index("addresses")
+
+    df_forta_alerts_clusters_joined = df_forta_alerts_exploded.join(df_address_clusters, on="addresses", how="left", lsuffix="_alert", rsuffix="_cluster")
+    df_forta_alerts_clusters_joined = df_forta_alerts_clusters_joined.reset_index()
+    df_forta_alerts_clusters_joined["cluster_identifiers"] = df_forta_alerts_clusters_joined.apply(lambda x: x["addresses"] if pd.isnull(x["entity_addresses"]) else x["entity_addresses"], axis=1)
+    df_forta_alerts_clusters_joined.drop(columns=["entity_addresses_arr", "entity_addresses"], inplace=True)
+
+    df_forta_alerts = df_forta_alerts_clusters_joined.groupby(['hash']).agg({"cluster_identifiers": lambda x: x.tolist(), "severity": "first", "alertId": "first", "bot_id": "first", "description": "first", "metadata": "first", "transactionHash": "first"})
+    df_forta_alerts.reset_index(inplace=True)
+    return df_forta_alerts
+
+
+def generate(exploded_rows: int, addresses_per_alert: int = 4, cluster_share: float = 0.3) -> tuple:
+    rnd = random.Random(exploded_rows)
+    address_count = max(exploded_rows // 10, 10)
+    addresses = ["0x" + "".join(rnd.choice("0123456789abcdef") for _ in range(40)) for _ in range(address_count)]
+
+    # clusters of 2-4 addresses covering cluster_share of all addresses
+    clustered = addresses[:int(address_count * cluster_share)]
+    cluster_rows = []
+    i = 0
+    while i < len(clustered):
+        size = rnd.choice([2, 3, 4])
+        cluster = ",".join(clustered[i:i + size])
+        cluster_rows.extend([(address, cluster, address) for address in clustered[i:i + size]])
+        i += size
+    df_address_clusters = pd.DataFrame(cluster_rows, columns=["addresses", "entity_addresses", "entity_addresses_arr"]).set_index("addresses")
+
+    alert_rows = []
+    for i in range(exploded_rows // addresses_per_alert):
+        alert_rows.append(["HIGH", {"key": "value"}, f"ALERT-{i % 50}", "description", [address.upper().replace("0X", "0x") for address in rnd.sample(addresses, addresses_per_alert)],
+                           f"0x{i:064x}", f"0x{i:064x}", f"0xbot{i % 90}"])
+    df_forta_alerts = pd.DataFrame(alert_rows, columns=["severity", "metadata", "alertId", "description", "addresses", "hash", "transactionHash", "bot_id"])
+    return df_forta_alerts, df_address_clusters
+
+
+def benchmark(exploded_rows: int):
+    df_forta_alerts, df_address_clusters = generate(exploded_rows)
+
+    start = time.perf_counter()
+    df_row_wise = add_cluster_identifiers_row_wise(df_forta_alerts.copy(), df_address_clusters)
+    row_wise_seconds = time.perf_counter() - start
+
+    address_clusters = AddressClusters()
+    for cluster in df_address_clusters["entity_addresses"].unique():
+        address_clusters.add_cluster(cluster.split(","))
+
+    start = time.perf_counter()
+    df_vectorized = add_cluster_identifiers(df_forta_alerts.copy(), address_clusters)
+    vectorized_seconds = time.perf_counter() - start
+
+    df_vectorized.insert(1, "cluster_identifiers", [[address_clusters.identifier(cluster_code) for cluster_code in cluster_codes] for cluster_codes in df_vectorized.pop("cluster_codes")])
+    df_vectorized = df_vectorized.astype({column: object for column in CATEGORICAL_ALERT_FIELDS})
+
+    assert df_vectorized.equals(df_row_wise), "vectorized output differs from row-wise output"
+    print(f"{exploded_rows} exploded rows: row-wise {row_wise_seconds:.2f}s, vectorized {vectorized_seconds:.2f}s, speedup {row_wise_seconds / vectorized_seconds:.1f}x")
+
+
+if __name__ == "__main__":
+    for exploded_rows in [int(arg) for arg in sys.argv[1:]] or [100_000, 1_000_000]:
+        benchmark(exploded_rows)
@@ -0,0 +1,293 @@
+"""
+replays recorded or synthetic alerts through detect_attack with a stand-in FortaExplorer and web3, and reports wall time and peak memory per phase and the number of findings
+run from the alert-combiner-py folder: python3 -m benchmark.replay_benchmark [--alerts 10000 100000 1000000] [--clustered-share 0.3] [--cluster-overlap 0.1] [--runs 2] [--dump alerts.json]
+recorded dumps are json files with the alerts as returned by the Forta alerts query (a list of alerts or the full response), including the entity cluster alerts
+"""
+import argparse
+import functools
+import hashlib
+import json
+import logging
+import random
+import resource
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import pandas as pd
+from forta_agent import create_block_event
+from hexbytes import HexBytes
+
+import src.agent as agent
+from src.alert_store import AlertStore
+from src.cluster_aggregates import ClusterAggregates
+from src.constants import BASE_BOTS, COMBINER_RULES, ENTITY_CLUSTER_BOT, ENTITY_CLUSTER_BOT_ALERT_ID, CATEGORICAL_ALERT_FIELDS, ADDRESS_ALERT_FIELDS
+from src.forta_explorer import FortaExplorer
+from src.web3_mock import EthMock, Web3Mock
+
+END_DATE = datetime(2022, 4, 30, 23, 55, 17)
+STAGE_BOTS = {stage: [(bot_id, alert_id) for bot_id, alert_id, bot_stage in BASE_BOTS if bot_stage == stage] for stage in ["Funding", "Preparation", "Exploitation", "MoneyLaundering"]}
+SEVERITIES = ["INFO", "LOW", "MEDIUM", "HIGH", "CRITICAL"]
+
+
+class ReplayFortaExplorer(FortaExplorer):
+    """
+    stand-in for the FortaExplorer that serves the alerts of a dump; the first query of a batch returns all alerts of its pairs, later queries resume from the end cursor and return none
+    the alerts are held as json and decoded on each query like the responses of the API, so decode time and allocations match the real FortaExplorer
+    """
+
+    def __init__(self, df_alerts: pd.DataFrame):
+        super().__init__()
+        self.pages = {key: df.drop(columns=["transactionHash", "bot_id"]).to_json(orient="records") for key, df in df_alerts.groupby(["bot_id", "alertId"], sort=False)}
+        self.queries = 0
+
+    def alerts_by_bots_after(self, bot_alert_ids: list, chain_id: int, start_date: datetime, end_date: datetime, cursor: dict, fields: list = None) -> tuple:
+        self.queries += 1
+        if cursor is not None:
+            return {key: self.empty_alerts(fields) for key in bot_alert_ids}, cursor
+        alerts = {}
+        for key in bot_alert_ids:
+            if key not in self.pages:
+                alerts[key] = self.empty_alerts(fields)
+                continue
+            df_forta = pd.DataFrame(json.loads(self.pages[key]))
+            df_forta["bot_id"] = df_forta["source"].apply(lambda x: x["bot"]["id"])
+            df_forta["transactionHash"] = df_forta["source"].apply(lambda x: x["transactionHash"])
+            alerts[key] = df_forta[FortaExplorer.columns(fields)]
+        return alerts, {"alertId": bot_alert_ids[-1][1], "blockNumber": sum(len(df) for df in alerts.values())}
+
+
+class ReplayEthMock(EthMock):
+    """
+    stand-in for w3.eth that derives code and transaction counts from the address hash (about 1 in 10 addresses is a contract, 1 in 20 has a large transaction count) and counts the calls
+    """
+
+    def __init__(self, contracts: set):
+        super().__init__()
+        self.contracts = contracts
+        self.calls = 0
+
+    def get_code(self, address):
+        self.calls += 1
+        return HexBytes('0x01') if address.lower() in self.contracts or digest(address) % 10 == 0 else HexBytes('0x')
+
+    def get_transaction_count(self, address):
+        self.calls += 1
+        return 1000 if digest(address) % 20 == 1 else digest(address) % 100
+
+    def get_transaction(self, hash):
+        self.calls += 1
+        return {'to': "0x" + hashlib.sha1(hash.encode()).hexdigest()}
+
+    @property
+    def chain_id(self):
+        return 1
+
+
+class ReplayWeb3Mock(Web3Mock):
+    def __init__(self, contracts: set = None):
+        self.eth = ReplayEthMock(contracts or set())
+
+
+class PhaseTimer:
+    """
+    wraps functions of the agent module to accumulate the wall time and the peak memory allocated (above the memory at the start of the phase) per phase
+    """
+
+    def __init__(self, trace_memory: bool):
+        self.trace_memory = trace_memory
+        self.seconds = {}
+        self.peaks = {}
+        self.stack = []  # [name, start, memory at start, peak within the phase]
+
+    def wrap(self, name: str, function):
+        def wrapped(*args, **kwargs):
+            self.enter(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.exit(name)
+        return wrapped
+
+    def enter(self, name: str):
+        current = 0
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            for frame in self.stack:
+                frame[3] = max(frame[3], peak)
+            tracemalloc.reset_peak()
+        self.stack.append([name, time.perf_counter(), current, current])
+
+    def exit(self, name: str):
+        _, start, memory_at_start, peak = self.stack.pop()
+        self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+        if self.trace_memory:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            self.peaks[name] = max(self.peaks.get(name, 0), peak - memory_at_start)
+            for frame in self.stack:
+                frame[3] = max(frame[3], peak)
+
+
+def digest(value: str) -> int:
+    return int(hashlib.md5(value.lower().encode()).hexdigest()[:8], 16)
+
+
+def random_address(rnd: random.Random) -> str:
+    return "0x" + "".join(rnd.choice("0123456789abcdef") for _ in range(40))
+
+
+def checksum_case(rnd: random.Random, address: str) -> str:
+    return "0x" + "".join(c.upper() if rnd.random() < 0.5 else c for c in address[2:])
+
+
+def description_starts() -> dict:
+    """
+    this function collects where the combiner rules and ice phishing mappings expect the attacker address in the description of each alert id
+    :return: starts: dict alert_id -> start
+    """
+    starts = {alert_id: start for rule in COMBINER_RULES for alert_id, bot_id, severity, field, start in rule["candidate_sources"] if field == "description"}
+    df_mappings = pd.read_csv("ice_phishing_mappings.csv")
+    for row in df_mappings[df_mappings["location"] == "description"].to_dict("records"):
+        starts.setdefault(row["alert_id"], int(row["attacker_address_location_in_description"]))
+    return starts
+
+
+def generate_alerts(alert_count: int, clustered_share: float = 0.3, cluster_overlap: float = 0.1, attacker_share: float = 0.0005, seed: int = 0) -> pd.DataFrame:
+    """
+    this function generates a synthetic alert mix: entity clusters of 2-4 addresses covering clustered_share of the addresses (cluster_overlap of the cluster alerts reuse an address
+    of an earlier cluster, so clusters get merged), noise alerts of the base bots (a few noisy bots raise most alerts) and planted attackers with alerts in all stages and ice phishing combinations
+    :return: df_alerts: pd.DataFrame in the shape returned by FortaExplorer.alerts_by_bots_after
+    """
+    rnd = random.Random(seed)
+    starts = description_starts()
+    addresses = [random_address(rnd) for _ in range(max(alert_count // 4, 100))]
+    rows = []
+
+    def add_alert(bot_id: str, alert_id: str, severity: str, description: str, metadata: dict, alert_addresses: list):
+        alert_hash = f"0x{len(rows):064x}"
+        rows.append([(END_DATE - timedelta(seconds=rnd.randint(0, 20 * 60 * 60))).strftime("%Y-%m-%dT%H:%M:%SZ"), alert_id.lower(), "ethereum", "SUSPICIOUS",
+                     {"transactionHash": alert_hash, "block": {"number": 14_690_000 + len(rows), "chainId": 1}, "bot": {"id": bot_id}},
+                     severity, metadata, alert_id, description, [checksum_case(rnd, address) for address in alert_addresses], [], alert_hash, alert_hash, bot_id])
+
+    def add_base_bot_alert(bot_id: str, alert_id: str, severity: str, attacker: str, other_addresses: list):
+        description = "x" * starts.get(alert_id, 0) + checksum_case(rnd, attacker) + f" raised {alert_id}"
+        metadata = {"malicious_details": f"[{{'address': '{attacker}'}}]"} if alert_id == "AE-MALICIOUS-ADDR" else {}
+        add_alert(bot_id, alert_id, severity, description, metadata, [attacker] + other_addresses)
+
+    # entity clusters
+    clustered = addresses[:int(len(addresses) * clustered_share)]
+    clusters = []
+    i = 0
+    while i < len(clustered):
+        size = rnd.choice([2, 3, 4])
+        cluster = clustered[i:i + size]
+        if len(clusters) > 0 and rnd.random() < cluster_overlap:
+            cluster = cluster + [rnd.choice(rnd.choice(clusters))]
+        clusters.append(cluster)
+        add_alert(ENTITY_CLUSTER_BOT, ENTITY_CLUSTER_BOT_ALERT_ID, "INFO", f"Entity of size {len(cluster)} has been identified",
+                  {"entityAddresses": ",".join(checksum_case(rnd, address) for address in cluster)}, cluster[:1])
+        i += size
+
+    # planted attackers: all four stages through POSSIBLE-MONEY-LAUNDERING-TORNADO-CASH, and ice phishing with a funding or malicious address alert
+    ice_phishing_bots = [(bot_id, alert_id) for bot_id, alert_id, stage in BASE_BOTS if alert_id.startswith("ICE-PHISHING")]
+    ice_phishing_partners = [(bot_id, alert_id) for bot_id, alert_id, stage in BASE_BOTS if alert_id in ["FUNDING-TORNADO-CASH", "AE-MALICIOUS-ADDR", "SLEEPMINT-1"]]
+    money_laundering_bot = next((bot_id, alert_id) for bot_id, alert_id, stage in BASE_BOTS if alert_id == "POSSIBLE-MONEY-LAUNDERING-TORNADO-CASH")
+    for attacker in rnd.sample(addresses, max(int(alert_count * attacker_share), 1)):
+        if rnd.random() < 0.5:
+            for stage in ["Funding", "Preparation", "Exploitation"]:
+                add_base_bot_alert(*rnd.choice(STAGE_BOTS[stage]), "HIGH", attacker, rnd.sample(addresses, 1))
+            add_base_bot_alert(*money_laundering_bot, "HIGH", attacker, [])
+        else:
+            add_base_bot_alert(*rnd.choice(ice_phishing_bots), "HIGH", attacker, rnd.sample(addresses, 1))
+            add_base_bot_alert(*rnd.choice(ice_phishing_partners), "HIGH", attacker, [])
+
+    # noise alerts; bot weights follow a long tail
+    base_bots = [(bot_id, alert_id) for bot_id, alert_id, stage in BASE_BOTS]
+    weights = [1 / (position + 1) for position in range(len(base_bots))]
+    rnd.shuffle(weights)
+    for bot_id, alert_id in rnd.choices(base_bots, weights, k=max(alert_count - len(rows), 0)):
+        add_base_bot_alert(bot_id, alert_id, rnd.choice(SEVERITIES), rnd.choice(addresses), rnd.sample(addresses, rnd.choice([0, 1, 2, 3])))
+
+    return pd.DataFrame(rows, columns=['createdAt', 'name', 'protocol', 'findingType', 'source', 'severity', 'metadata', 'alertId', 'description', 'addresses', 'contracts', 'hash', 'transactionHash', 'bot_id'])
+
+
+def load_dump(path: str) -> pd.DataFrame:
+    """
+    this function loads recorded alerts in the shape of the Forta alerts query
+    :return: df_alerts: pd.DataFrame in the shape returned by FortaExplorer.alerts_by_bots_after
+    """
+    with open(path) as dump_file:
+        dump = json.load(dump_file)
+    if isinstance(dump, dict):
+        dump = dump["data"]["alerts"]["alerts"]
+    df_alerts = pd.concat([FortaExplorer().empty_alerts(), pd.DataFrame(dump)])
+    df_alerts["bot_id"] = df_alerts["source"].apply(lambda x: x["bot"]["id"])
+    df_alerts["transactionHash"] = df_alerts["source"].apply(lambda x: x["transactionHash"])
+    return df_alerts
+
+
+def replay(df_alerts: pd.DataFrame, runs: int, trace_memory: bool, alert_store_path: str = None):
+    """
+    this function runs detect_attack runs times on the alerts (the first run is cold, later runs resume from the alert store) and prints the phases of each run
+    """
+    end_date = datetime.strptime(df_alerts["createdAt"].max()[:19], "%Y-%m-%dT%H:%M:%S")
+    block_event = create_block_event({"type": 0, "block": {"hash": "0xa", "number": 14_700_000, "timestamp": int((end_date - datetime(1970, 1, 1)).total_seconds())}})
+
+    agent.initialize()
+    agent.ALERT_STORE = AlertStore(alert_store_path, CATEGORICAL_ALERT_FIELDS, ADDRESS_ALERT_FIELDS)
+    agent.ATTACK_DETECTOR = True
+    agent.SCAM_DETECTOR = True
+    forta_explorer = ReplayFortaExplorer(df_alerts)
+    w3 = ReplayWeb3Mock()
+
+    phases = {"fetch clusters": "get_address_clusters", "fetch alerts": "get_forta_alerts", "cluster join": "add_cluster_identifiers",
+              "index": "index_cluster_alerts", "candidates": "get_candidate_rules"}
+    originals = {function_name: getattr(agent, function_name) for function_name in phases.values()}
+    for run in range(runs):
+        timer = PhaseTimer(trace_memory)
+        for phase, function_name in phases.items():
+            setattr(agent, function_name, timer.wrap(phase, originals[function_name]))
+        agent.CLUSTER_AGGREGATES.update = timer.wrap("aggregates", functools.partial(ClusterAggregates.update, agent.CLUSTER_AGGREGATES))
+        if trace_memory:
+            tracemalloc.start()
+        calls = w3.eth.calls
+        try:
+            findings = timer.wrap("total", agent.run_detection)(w3, forta_explorer, block_event)
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+            for function_name, function in originals.items():
+                setattr(agent, function_name, function)
+            del agent.CLUSTER_AGGREGATES.update
+
+        # fetch alerts includes the cluster join, the rest of the run is spent in the pre-passes and the evaluation of the candidates
+        timer.seconds["fetch alerts"] -= timer.seconds.get("cluster join", 0.0)
+        timer.seconds["evaluate"] = timer.seconds["total"] - sum(seconds for phase, seconds in timer.seconds.items() if phase != "total")
+        print(f"  run {run + 1}: {len(findings)} findings, {w3.eth.calls - calls} web3 calls, {forta_explorer.queries} queries, peak rss {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024} MB")
+        for phase in list(phases.keys()) + ["aggregates", "evaluate", "total"]:
+            peak = f", peak {timer.peaks[phase] / 2 ** 20:.1f} MB" if phase in timer.peaks else ""
+            print(f"    {phase:<15} {timer.seconds.get(phase, 0.0):8.2f}s{peak}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="replay alerts through detect_attack")
+    parser.add_argument("--alerts", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="sizes of the synthetic alert mixes")
+    parser.add_argument("--clustered-share", type=float, default=0.3, help="share of addresses that belong to an entity cluster")
+    parser.add_argument("--cluster-overlap", type=float, default=0.1, help="share of entity clusters that reuse an address of an earlier cluster")
+    parser.add_argument("--attacker-share", type=float, default=0.0005, help="number of planted attackers per alert")
+    parser.add_argument("--runs", type=int, default=2, help="detection runs per alert mix; runs after the first resume from the alert store")
+    parser.add_argument("--dump", help="replay a recorded alert dump instead of synthetic alerts")
+    parser.add_argument("--alert-store", help="folder to persist the alert store to")
+    parser.add_argument("--no-trace-memory", action="store_true", help="skip tracemalloc, which slows down the phases it traces")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    if args.dump:
+        print(f"{args.dump}:")
+        replay(load_dump(args.dump), args.runs, not args.no_trace_memory, args.alert_store)
+    else:
+        for alert_count in args.alerts:
+            start = time.perf_counter()
+            df_alerts = generate_alerts(alert_count, args.clustered_share, args.cluster_overlap, args.attacker_share)
+            print(f"{len(df_alerts)} alerts (clustered share {args.clustered_share}, cluster overlap {args.cluster_overlap}), generated in {time.perf_counter() - start:.1f}s:")
+            replay(df_alerts, args.runs, not args.no_trace_memory, args.alert_store)
@@ -0,0 +1,121 @@
+import logging
+
+import pandas as pd
+
+
+class AddressClusters:
+    """
+    disjoint-set (union-find) over the addresses of the entity cluster alerts
+    overlapping clusters are merged, so each address belongs to exactly one cluster; the canonical cluster identifier is the comma separated list of its lower case addresses
+    the clusters are updated incrementally with new entity cluster alerts and rebuilt once alerts were evicted from the store, as a disjoint-set can't be split
+    the detection refers to cluster identifiers by integer codes; codes are handed out on first use and are only valid until the next update
+    each update records the addresses whose cluster identifier changed, so aggregates over the clusters can be maintained incrementally
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        this function removes all clusters
+        """
+        self.parents = {}  # address -> parent address; roots point to themselves
+        self.members = {}  # root address -> list of addresses of the cluster in the order they were added
+        self.cluster_ids = {}  # address -> canonical cluster identifier, e.g. "address1,address2,address3"
+        self.hashes = set()  # hashes of the entity cluster alerts the clusters were built from
+        self.changed_addresses = set()  # addresses whose cluster identifier changed in the last update
+        self.rebuilt = False  # whether the clusters were rebuilt in the last update
+        self.reset_codes()
+
+    def reset_codes(self):
+        self.codes = {}  # cluster identifier -> integer code
+        self.identifiers = []  # integer code -> cluster identifier
+
+    def __len__(self) -> int:
+        return len(self.parents)
+
+    def update(self, df_address_clusters_alerts: pd.DataFrame):
+        """
+        this function adds the clusters of entity cluster alerts that haven't been added yet; the clusters are rebuilt if an alert added before is no longer contained
+        """
+        self.reset_codes()
+        self.changed_addresses = set()
+        self.rebuilt = False
+        hashes = set(df_address_clusters_alerts["hash"])
+        if not self.hashes.issubset(hashes):
+            logging.info(f"Rebuilding address clusters as {len(self.hashes - hashes)} entity cluster alerts were evicted")
+            self.reset()
+            self.rebuilt = True
+
+        for alert_hash, metadata in zip(df_address_clusters_alerts["hash"], df_address_clusters_alerts["metadata"]):
+            if alert_hash in self.hashes:
+                continue
+            self.hashes.add(alert_hash)
+            self.add_cluster(metadata["entityAddresses"].lower().split(","))
+
+    def add_cluster(self, addresses: list):
+        """
+        this function merges the addresses and all clusters they are already part of into one cluster
+        """
+        root = None
+        for address in addresses:
+            if address not in self.parents:
+                self.parents[address] = address
+                self.members[address] = [address]
+            root = self.union(root, address) if root is not None else self.find(address)
+
+        cluster_id = ",".join(self.members[root])
+        for address in self.members[root]:
+            if self.cluster_ids.get(address) != cluster_id:
+                self.changed_addresses.add(address)
+            self.cluster_ids[address] = cluster_id
+
+    def find(self, address: str) -> str:
+        """
+        this function returns the root address of the cluster the address belongs to, compressing the path on the way
+        :return: root: str
+        """
+        root = address
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[address] != root:
+            self.parents[address], address = root, self.parents[address]
+        return root
+
+    def union(self, address_a: str, address_b: str) -> str:
+        """
+        this function merges the clusters of both addresses; the smaller cluster is attached to the larger one and its addresses are appended to the larger cluster's
+        :return: root: str - root address of the merged cluster
+        """
+        root_a = self.find(address_a)
+        root_b = self.find(address_b)
+        if root_a == root_b:
+            return root_a
+        if len(self.members[root_a]) < len(self.members[root_b]):
+            root_a, root_b = root_b, root_a
+        self.parents[root_b] = root_a
+        self.members[root_a].extend(self.members.pop(root_b))
+        return root_a
+
+    def cluster_identifier(self, address: str) -> str:
+        """
+        this function returns the canonical cluster identifier of the lower case address or the address itself if it isn't part of a cluster
+        :return: cluster_identifier: str
+        """
+        return self.cluster_ids.get(address, address)
+
+    def cluster_code(self, address: str) -> int:
+        """
+        this function returns the integer code of the cluster identifier of the lower case address
+        :return: cluster_code: int
+        """
+        cluster_identifier = self.cluster_ids.get(address, address)
+        cluster_code = self.codes.get(cluster_identifier)
+        if cluster_code is None:
+            cluster_code = len(self.identifiers)
+            self.codes[cluster_identifier] = cluster_code
+            self.identifiers.append(cluster_identifier)
+        return cluster_code
+
+    def identifier(self, cluster_code: int) -> str:
+        return self.identifiers[cluster_code]
@@ -0,0 +1,53 @@
+import pandas as pd
+
+from address_clusters import AddressClusters
+
+
+def cluster_alerts(rows: list) -> pd.DataFrame:
+    return pd.DataFrame([[alert_hash, {"entityAddresses": entity_addresses}] for alert_hash, entity_addresses in rows], columns=['hash', 'metadata'])
+
+
+class TestAddressClusters:
+    def test_cluster_identifier(self):
+        address_clusters = AddressClusters()
+        address_clusters.update(cluster_alerts([("0x1", "0xAA,0xBB")]))
+
+        assert address_clusters.cluster_identifier("0xaa") == "0xaa,0xbb", "address should map to its cluster"
+        assert address_clusters.cluster_identifier("0xbb") == "0xaa,0xbb", "address should map to its cluster"
+        assert address_clusters.cluster_identifier("0xcc") == "0xcc", "address outside of a cluster should map to itself"
+
+    def test_overlapping_clusters_are_merged(self):
+        address_clusters = AddressClusters()
+        address_clusters.update(cluster_alerts([("0x1", "0xaa,0xbb"), ("0x2", "0xcc,0xdd")]))
+        address_clusters.update(cluster_alerts([("0x1", "0xaa,0xbb"), ("0x2", "0xcc,0xdd"), ("0x3", "0xbb,0xcc,0xee")]))
+
+        assert len(address_clusters) == 5, "each address should be held once"
+        assert len({address_clusters.cluster_identifier(address) for address in ["0xaa", "0xbb", "0xcc", "0xdd", "0xee"]}) == 1, "overlapping clusters should share one identifier"
+        assert sorted(address_clusters.cluster_identifier("0xee").split(",")) == ["0xaa", "0xbb", "0xcc", "0xdd", "0xee"], "identifier should list all addresses of the merged cluster"
+
+    def test_update_rebuilds_after_eviction(self):
+        address_clusters = AddressClusters()
+        address_clusters.update(cluster_alerts([("0x1", "0xaa,0xbb"), ("0x2", "0xbb,0xcc")]))
+        address_clusters.update(cluster_alerts([("0x2", "0xbb,0xcc")]))
+
+        assert address_clusters.cluster_identifier("0xaa") == "0xaa", "address of an evicted cluster alert should no longer be clustered"
+        assert address_clusters.cluster_identifier("0xcc") == "0xbb,0xcc", "remaining cluster alert should be kept"
+
+    def test_cluster_code(self):
+        address_clusters = AddressClusters()
+        address_clusters.update(cluster_alerts([("0x1", "0xaa,0xbb")]))
+
+        assert address_clusters.cluster_code("0xaa") == address_clusters.cluster_code("0xbb"), "addresses of a cluster should share a code"
+        assert address_clusters.cluster_code("0xcc") != address_clusters.cluster_code("0xaa"), "address outside of a cluster should have its own code"
+        assert address_clusters.identifier(address_clusters.cluster_code("0xbb")) == "0xaa,0xbb", "code should map back to the cluster identifier"
+
+    def test_changed_addresses(self):
+        address_clusters = AddressClusters()
+        address_clusters.update(cluster_alerts([("0x1", "0xaa,0xbb"), ("0x2", "0xcc,0xdd")]))
+        address_clusters.update(cluster_alerts([("0x1", "0xaa,0xbb"), ("0x2", "0xcc,0xdd"), ("0x3", "0xdd,0xee")]))
+
+        assert address_clusters.changed_addresses == {"0xcc", "0xdd", "0xee"}, "only addresses of the merged cluster should have changed"
+        assert not address_clusters.rebuilt, "clusters should have been updated incrementally"
+
+        address_clusters.update(cluster_alerts([("0x2", "0xcc,0xdd"), ("0x3", "0xdd,0xee")]))
+        assert address_clusters.rebuilt, "clusters should have been rebuilt after an eviction"
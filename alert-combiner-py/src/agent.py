@@ -1,28 +1,46 @@
 import logging
+import os
 import sys
-import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from xmlrpc.client import _datetime
 
 import forta_agent
+import numpy as np
 import pandas as pd
 import re
-from forta_agent import get_json_rpc_url
+from forta_agent import get_json_rpc_url, create_block_event
 from hexbytes import HexBytes
 from web3 import Web3
 
 from src.constants import (ADDRESS_QUEUE_SIZE, BASE_BOTS, SCAM_DETECTOR, ATTACK_DETECTOR, ENTITY_CLUSTER_BOT_ALERT_ID,
-                           DATE_LOOKBACK_WINDOW_IN_DAYS, TX_COUNT_FILTER_THRESHOLD, ENTITY_CLUSTER_BOT, ENTITY_CLUSTER_BOT_DATE_LOOKBACK_WINDOW_IN_DAYS)
+                           DATE_LOOKBACK_WINDOW_IN_DAYS, TX_COUNT_FILTER_THRESHOLD, ENTITY_CLUSTER_BOT, ENTITY_CLUSTER_BOT_DATE_LOOKBACK_WINDOW_IN_DAYS, COMBINER_RULES,
+                           FORTA_EXPLORER_MAX_WORKERS, FORTA_EXPLORER_BATCH_SIZE, BASE_BOT_ALERT_FIELDS, ENTITY_CLUSTER_BOT_ALERT_FIELDS, CATEGORICAL_ALERT_FIELDS, ADDRESS_ALERT_FIELDS, RPC_BATCH_SIZE, RPC_CODE_CACHE_TTL_IN_SECONDS, RPC_TX_COUNT_CACHE_TTL_IN_SECONDS,
+                           RPC_LARGE_TX_COUNT_CACHE_TTL_IN_SECONDS, RPC_CACHE_MAX_SIZE,
+                           DETECTION_DEADLINE_IN_SECONDS, DETECTION_QUEUE_SIZE, ALERT_STORE_PATH, METRICS_PORT, PUSH_ALERTS)
+from src.address_clusters import AddressClusters
+from src.alert_store import AlertStore
+from src.cluster_aggregates import ClusterAggregates
 from src.findings import AlertCombinerFinding
 from src.forta_explorer import FortaExplorer
+from src.metrics import DetectionMetrics
+from src.rpc_cache import RpcCache
+from src.scheduler import DetectionScheduler
 
 web3 = Web3(Web3.HTTPProvider(get_json_rpc_url()))
-forta_explorer = FortaExplorer()
+forta_explorer = FortaExplorer(FORTA_EXPLORER_MAX_WORKERS)
 
 FINDINGS_CACHE = []
 ALERTED_CLUSTERS = []
-MUTEX = False
 ICE_PHISHING_MAPPINGS_DF = pd.DataFrame()
+ICE_PHISHING_EXTRACTORS = {}  # (bot_id, alert_id) -> list of (location, extractor)
+ICE_PHISHING_ATTACKER_ADDRESSES = {}  # alert hash -> set of attacker addresses extracted from the alert
+ALERT_STORE = AlertStore(categorical_columns=CATEGORICAL_ALERT_FIELDS, address_columns=ADDRESS_ALERT_FIELDS, push_alerts=PUSH_ALERTS)
+ADDRESS_CLUSTERS = AddressClusters()
+CLUSTER_AGGREGATES = ClusterAggregates(BASE_BOTS, RPC_TX_COUNT_CACHE_TTL_IN_SECONDS)
+RPC_CACHE = RpcCache(RPC_CODE_CACHE_TTL_IN_SECONDS, RPC_BATCH_SIZE, RPC_TX_COUNT_CACHE_TTL_IN_SECONDS, TX_COUNT_FILTER_THRESHOLD, RPC_LARGE_TX_COUNT_CACHE_TTL_IN_SECONDS, RPC_CACHE_MAX_SIZE)
+METRICS = DetectionMetrics("alert_combiner")
 
 root = logging.getLogger()
 root.setLevel(logging.INFO)
@@ -38,6 +56,7 @@ def initialize():
     """
     this function initializes the state variables that are tracked across tx and blocks
     it is called from test to reset state between tests
+    :return: alert_config: dict with the alert subscriptions of the base bots and the entity cluster bot if alerts are pushed; None otherwise
     """
     global ALERTED_CLUSTERS
     ALERTED_CLUSTERS = []
@@ -45,16 +64,37 @@ def initialize():
     global FINDINGS_CACHE
     FINDINGS_CACHE = []
 
-    global MUTEX
-    MUTEX = False
-
     global ICE_PHISHING_MAPPINGS_DF
     ICE_PHISHING_MAPPINGS_DF = pd.read_csv('ice_phishing_mappings.csv')
 
+    global ICE_PHISHING_EXTRACTORS
+    ICE_PHISHING_EXTRACTORS = compile_ice_phishing_extractors(ICE_PHISHING_MAPPINGS_DF)
+
+    global ICE_PHISHING_ATTACKER_ADDRESSES
+    ICE_PHISHING_ATTACKER_ADDRESSES = {}
+
+    global ALERT_STORE
+    ALERT_STORE = AlertStore(None if os.environ.get("PYTHON_ENV") == "test" else ALERT_STORE_PATH, CATEGORICAL_ALERT_FIELDS, ADDRESS_ALERT_FIELDS, PUSH_ALERTS)  # tests start from an empty store
+
+    global ADDRESS_CLUSTERS
+    ADDRESS_CLUSTERS = AddressClusters()
+
+    global CLUSTER_AGGREGATES
+    CLUSTER_AGGREGATES = ClusterAggregates(BASE_BOTS, RPC_TX_COUNT_CACHE_TTL_IN_SECONDS)
+
+    global RPC_CACHE
+    RPC_CACHE = RpcCache(RPC_CODE_CACHE_TTL_IN_SECONDS, RPC_BATCH_SIZE, RPC_TX_COUNT_CACHE_TTL_IN_SECONDS, TX_COUNT_FILTER_THRESHOLD, RPC_LARGE_TX_COUNT_CACHE_TTL_IN_SECONDS, RPC_CACHE_MAX_SIZE)
+
+    if os.environ.get("PYTHON_ENV") != "test" and METRICS_PORT:
+        METRICS.serve(METRICS_PORT)  # the endpoint and its histograms outlive initialize
+
+    if PUSH_ALERTS:
+        return {"alertConfig": {"subscriptions": [{"botId": bot_id, "alertId": alert_id} for bot_id, alert_id in subscribed_bot_alert_ids()]}}
+
+
+def subscribed_bot_alert_ids() -> list:
+    return [(bot_id, alert_id) for bot_id, alert_id, stage in BASE_BOTS] + [(ENTITY_CLUSTER_BOT, ENTITY_CLUSTER_BOT_ALERT_ID)]
 
-def handle_alert(alert_event):
-    print("handle_alert")
-    print(alert_event)
 
 def is_contract(w3, addresses) -> bool:
     """
@@ -67,7 +107,7 @@ def is_contract(w3, addresses) -> bool:
     is_contract = True
     for address in addresses.split(','):
         try:
-            code = w3.eth.get_code(Web3.toChecksumAddress(address))
+            code = RPC_CACHE.get_code(w3, address)
         except: # Exception as e:
             logging.error("Exception in is_contract")
             
@@ -112,319 +152,342 @@ def replace_with_cluster_identifiers(addresses: list, clusters: list) -> list:
 
 
 def get_max_transaction_count(w3, cluster: str) -> int:
+    """
+    this function returns the largest transaction count of the addresses of the cluster; as nonces only increase, an address cached above TX_COUNT_FILTER_THRESHOLD decides the filter without any lookup
+    :return: max_transaction_count: int
+    """
+    for address in cluster.split(','):
+        transaction_count = RPC_CACHE.cached_transaction_count(address)
+        if transaction_count is not None and transaction_count > TX_COUNT_FILTER_THRESHOLD:
+            return transaction_count
+
     max_transaction_count = 0
+    RPC_CACHE.prefetch_transaction_counts(w3, cluster.split(','))
     for address in cluster.split(','):
-        transaction_count = w3.eth.get_transaction_count(Web3.toChecksumAddress(address))
+        transaction_count = RPC_CACHE.get_transaction_count(w3, address)
         if transaction_count > max_transaction_count:
             max_transaction_count = transaction_count
     return max_transaction_count
 
 
-def get_clusters_exploded(start_date: datetime, end_date: datetime, forta_explorer: FortaExplorer, chain_id: int) -> pd.DataFrame:
-    df_address_clusters_alerts = forta_explorer.alerts_by_bot(ENTITY_CLUSTER_BOT, ENTITY_CLUSTER_BOT_ALERT_ID, chain_id, start_date, end_date)  #  metadate entity_addresses: "address1, address2, address3" (web3 checksum)
+def get_address_clusters(start_date: datetime, end_date: datetime, forta_explorer: FortaExplorer, chain_id: int) -> AddressClusters:
+    """
+    this function updates the address clusters with the entity cluster alerts of the lookback window
+    :return: address_clusters: AddressClusters
+    """
+    with METRICS.phase("fetch_clusters"):
+        df_address_clusters_alerts = ALERT_STORE.refresh(forta_explorer, ENTITY_CLUSTER_BOT, ENTITY_CLUSTER_BOT_ALERT_ID, chain_id, start_date, end_date, ENTITY_CLUSTER_BOT_ALERT_FIELDS)  #  metadate entity_addresses: "address1, address2, address3" (web3 checksum)
     logging.info(f"Fetched {len(df_address_clusters_alerts)} for entity clusters")
 
-    df_address_clusters = pd.DataFrame()
-    df_address_clusters["entity_addresses"] = df_address_clusters_alerts["metadata"].apply(lambda x: x["entityAddresses"].lower())
-    df_address_clusters["entity_addresses_arr"] = df_address_clusters_alerts["metadata"].apply(lambda x: x["entityAddresses"].lower().split(","))
-    df_address_clusters = df_address_clusters.explode("entity_addresses_arr")
-    df_address_clusters["addresses"] = df_address_clusters["entity_addresses_arr"].apply(lambda x: x.lower())
-    df_address_clusters = df_address_clusters.set_index("addresses")
-
-    return df_address_clusters
+    with METRICS.phase("update_clusters"):
+        ADDRESS_CLUSTERS.update(df_address_clusters_alerts)
+    METRICS.volume("entity_cluster_alerts", len(df_address_clusters_alerts))
+    METRICS.volume("clustered_addresses", len(ADDRESS_CLUSTERS))
+    return ADDRESS_CLUSTERS
 
 
-def get_forta_alerts(start_date: datetime, end_date: datetime, df_address_clusters: pd.DataFrame, forta_explorer: FortaExplorer, chain_id: int) -> pd.DataFrame:
+def get_forta_alerts(start_date: datetime, end_date: datetime, address_clusters: AddressClusters, forta_explorer: FortaExplorer, chain_id: int) -> pd.DataFrame:
     logging.info(f"Analyzing alerts from {start_date} to {end_date}, chain_id: {chain_id}")
 
-    # get all alerts for date range
-    df_forta_alerts = forta_explorer.empty_alerts()
-    for bot_id, alert_id, stage in BASE_BOTS:
-        bot_alerts = forta_explorer.alerts_by_bot(bot_id, alert_id, chain_id, start_date, end_date)
-        df_forta_alerts = pd.concat([df_forta_alerts, bot_alerts])
+    # get all alerts for date range; bots are fetched in batches that share one query and the batches are fetched concurrently
+    bot_alert_ids = [(bot_id, alert_id) for bot_id, alert_id, stage in BASE_BOTS]
+    batches = [bot_alert_ids[i:i + FORTA_EXPLORER_BATCH_SIZE] for i in range(0, len(bot_alert_ids), FORTA_EXPLORER_BATCH_SIZE)]
+    alerts = {}
+    with METRICS.phase("fetch_alerts"), FortaExplorer.paused_gc(), ThreadPoolExecutor(max_workers=FORTA_EXPLORER_MAX_WORKERS) as executor:
+        for batch_alerts in executor.map(lambda batch: ALERT_STORE.refresh_batch(forta_explorer, batch, chain_id, start_date, end_date, BASE_BOT_ALERT_FIELDS), batches):
+            alerts.update(batch_alerts)
+
+    all_bot_alerts = [alerts[bot_alert_id] for bot_alert_id in bot_alert_ids]
+    for (bot_id, alert_id), bot_alerts in zip(bot_alert_ids, all_bot_alerts):
         if len(bot_alerts) > 0:
             logging.info(f"Fetched {len(bot_alerts)} for bot {bot_id}, alert_id {alert_id}, chain_id {chain_id}")
+    df_forta_alerts = pd.concat([forta_explorer.empty_alerts(BASE_BOT_ALERT_FIELDS)] + all_bot_alerts)
 
-    # add a new field cluster_identifiers where all addresses are replaced with cluster identifiers if they exist
-    df_forta_alerts.drop(columns=["createdAt", "name", "protocol", "findingType", "source", "contracts"], inplace=True)
-    df_forta_alerts_exploded = df_forta_alerts.explode("addresses")
-    df_forta_alerts_exploded["addresses"] = df_forta_alerts_exploded["addresses"].apply(lambda x: x.lower())
-    df_forta_alerts_exploded = df_forta_alerts_exploded.set_index("addresses")
-
-    df_forta_alerts_clusters_joined = df_forta_alerts_exploded.join(df_address_clusters, on="addresses", how="left", lsuffix="_alert", rsuffix="_cluster")
-    df_forta_alerts_clusters_joined = df_forta_alerts_clusters_joined.reset_index()
-    df_forta_alerts_clusters_joined["cluster_identifiers"] = df_forta_alerts_clusters_joined.apply(lambda x: x["addresses"] if pd.isnull(x["entity_addresses"]) else x["entity_addresses"], axis=1)
-    df_forta_alerts_clusters_joined.drop(columns=["entity_addresses_arr", "entity_addresses"], inplace=True)
-
-    df_forta_alerts = df_forta_alerts_clusters_joined.groupby(['hash']).agg({"cluster_identifiers": lambda x: x.tolist(), "severity": "first", "alertId": "first", "bot_id": "first", "description": "first", "metadata": "first", "transactionHash": "first"})
-    df_forta_alerts.reset_index(inplace=True)
+    # add a new field cluster_codes where all addresses are replaced with the codes of their cluster identifiers; only the fields used by the detection are kept
+    with METRICS.phase("cluster_join"):
+        df_forta_alerts = add_cluster_identifiers(df_forta_alerts, address_clusters)
     logging.info("Added cluster identifiers to alerts")
+    METRICS.volume("alerts", len(df_forta_alerts))
 
     return df_forta_alerts
 
 
-def swap_addresses_with_clusters(addresses: list, df_address_clusters_exploded: pd.DataFrame) -> list:
-    df_addresses = pd.DataFrame(addresses, columns=["addresses"])
-    df_addresses["addresses"] = df_addresses["addresses"].apply(lambda x: x.lower())
-
-    df_addresses_joined = df_addresses.join(df_address_clusters_exploded, on="addresses", how="left", lsuffix="_alert", rsuffix="_cluster")
-    df_addresses_joined = df_addresses_joined.reset_index()
-    if len(df_addresses_joined) > 0:
-        df_addresses_joined["cluster_identifiers"] = df_addresses_joined.apply(lambda x: x["addresses"] if pd.isnull(x["entity_addresses"]) else x["entity_addresses"], axis=1)
-        df_addresses_joined.drop(columns=["entity_addresses_arr", "entity_addresses"], inplace=True)
-
-        return df_addresses_joined["cluster_identifiers"].tolist()
-    else:
-        return []
-
-
-def detect_attack(w3, forta_explorer: FortaExplorer, block_event: forta_agent.block_event.BlockEvent):
+def add_cluster_identifiers(df_forta_alerts: pd.DataFrame, address_clusters: AddressClusters) -> pd.DataFrame:
     """
-    this function returns finding for any address for which alerts in 4 stages were observed in a given time window
-    :return: findings: list
+    this function replaces the addresses of each alert with the integer codes of their cluster identifiers (see AddressClusters.cluster_code) and returns one row per alert hash
+    only the addresses are exploded and looked up; the lists are built by slicing the hash sorted cluster codes at the group boundaries, so no python function is called per group
+    the low cardinality columns alertId, bot_id and severity are held as categoricals
+    :return: df_forta_alerts: pd.DataFrame with columns hash, cluster_codes, severity, alertId, bot_id, description, metadata, transactionHash
     """
-    global ALERTED_CLUSTERS
-    global MUTEX
-
-    if not MUTEX:
-        MUTEX = True
-
-        ALERT_ID_STAGE_MAPPING = dict([(alert_id, stage) for bot_id, alert_id, stage in BASE_BOTS])
-
-        # get alerts from API and exchange addresses with clusters from the entity cluster bot
-        end_date = datetime.utcfromtimestamp(block_event.block.timestamp)
-        start_date = end_date - timedelta(days=ENTITY_CLUSTER_BOT_DATE_LOOKBACK_WINDOW_IN_DAYS)
-        df_address_clusters_exploded = get_clusters_exploded(start_date=start_date, end_date=end_date, forta_explorer=forta_explorer, chain_id=w3.eth.chain_id)
-        logging.info(f"Fetched clusters {len(df_address_clusters_exploded)}")
-
-        end_date = datetime.utcfromtimestamp(block_event.block.timestamp)
-        start_date = end_date - timedelta(days=DATE_LOOKBACK_WINDOW_IN_DAYS)
-        df_forta_alerts = get_forta_alerts(start_date=start_date, end_date=end_date, df_address_clusters=df_address_clusters_exploded, forta_explorer=forta_explorer, chain_id=w3.eth.chain_id)
+    df_forta_alerts = df_forta_alerts[["hash", "severity", "alertId", "bot_id", "description", "metadata", "transactionHash", "addresses"]].reset_index(drop=True)
+    hash_codes, hashes = pd.factorize(df_forta_alerts["hash"], sort=True)
+
+    # each distinct address is only looked up once
+    addresses = df_forta_alerts["addresses"].explode().dropna()  # indexed by alert position
+    address_codes, unique_addresses = pd.factorize(addresses.str.lower())
+    cluster_codes = np.array([address_clusters.cluster_code(address) for address in unique_addresses.tolist()], dtype=np.int64)[address_codes]
+
+    # group the exploded cluster codes by the hash of their alert; the stable sort keeps them in row order within each hash
+    exploded_hash_codes = hash_codes[addresses.index.to_numpy(dtype=np.int64)]
+    in_group = exploded_hash_codes >= 0
+    order = np.argsort(exploded_hash_codes[in_group], kind="stable")
+    cluster_codes = cluster_codes[in_group][order].tolist()
+    group_boundaries = np.searchsorted(exploded_hash_codes[in_group][order], np.arange(len(hashes) + 1)).tolist()
+
+    # rows with the same hash are the same alert, so the first row of each hash is taken; a positional take keeps categoricals, which groupby first has no fast path for
+    unique_hash_codes, first_positions = np.unique(hash_codes, return_index=True)
+    first_positions = first_positions[unique_hash_codes >= 0]
+    df_forta_alerts = df_forta_alerts.drop(columns=["hash", "addresses"]).take(first_positions).reset_index(drop=True)
+    df_forta_alerts.insert(0, "cluster_codes", [cluster_codes[group_boundaries[i]:group_boundaries[i + 1]] for i in range(len(hashes))])
+    df_forta_alerts.insert(0, "hash", hashes)
+    df_forta_alerts = df_forta_alerts.astype({column: "category" for column in CATEGORICAL_ALERT_FIELDS})
 
+    return df_forta_alerts
 
-        # get all addresses that were part of the alerts
-        # to optimize, we only check money laundering addresses as this is required to fullfill all 4 stage requirements
-        if ATTACK_DETECTOR:
-            logging.info("Attack detector - 4 stages")
-            money_laundering_tc = df_forta_alerts[df_forta_alerts["alertId"] == "POSSIBLE-MONEY-LAUNDERING-TORNADO-CASH"]
-            txt_msg_high = df_forta_alerts[(df_forta_alerts["alertId"] == "forta-text-messages-possible-hack") & (df_forta_alerts["severity"] == "HIGH")]
 
-            addresses = set()
-            for index, row in txt_msg_high.iterrows():
-                addresses = addresses.union(set(row['cluster_identifiers']))
+def swap_addresses_with_clusters(addresses: list, address_clusters: AddressClusters) -> list:
+    return [address_clusters.cluster_identifier(address.lower()) for address in addresses]
 
-            for index, row in money_laundering_tc.iterrows():
-                addresses.add(row["description"][0:42].lower())  # the money laundering TC bot transaction may not be the transaction that contains the TC transfer and therefore a set of addresses unrelated, so we parse the address from the description
 
-            # replace with cluster identifiers if they exist
-            clusters = swap_addresses_with_clusters(list(addresses), df_address_clusters_exploded)
+def index_cluster_alerts(alert_records: dict) -> dict:
+    """
+    this function builds an inverted index from cluster code to the positions of the alerts that reference the cluster, grouped by alert id
+    alert ids and positions are kept in row order, so a lookup yields the same alerts in the same order as a scan over cluster_codes
+    :return: cluster_alerts_index: dict cluster code -> dict alert id -> list of positions in alert_records
+    """
+    cluster_alerts_index = {}
+    for position, alert in sorted(alert_records.items()):
+        if alert["cluster_codes"] is None:
+            continue
+        for cluster in dict.fromkeys(alert["cluster_codes"]):
+            cluster_alerts_index.setdefault(cluster, {}).setdefault(alert["alertId"], []).append(position)
+    return cluster_alerts_index
 
-            # analyze each address' alerts
-            for potential_attacker_cluster_lower in clusters:
-                try:
-                    logging.debug(potential_attacker_cluster_lower)
-                    # if address is a contract or unlikely address, skip
-                    if(is_contract(w3, potential_attacker_cluster_lower) or not is_address(w3, potential_attacker_cluster_lower)):
-                        continue
 
-                    # map each alert to 4 stages
-                    stages = set()
-                    hashes = set()
-                    involved_clusters = set()
-                    if(len(df_forta_alerts) > 0):
-                        cluster_alerts = df_forta_alerts[df_forta_alerts["cluster_identifiers"].apply(lambda x: potential_attacker_cluster_lower in x if x is not None else False)]
-                        involved_alert_ids = cluster_alerts["alertId"].unique()
-                        for alert_id in involved_alert_ids:
-                            if alert_id in ALERT_ID_STAGE_MAPPING.keys():
-                                stage = ALERT_ID_STAGE_MAPPING[alert_id]
-                                stages.add(stage)
-                                # get addresses from address field to add to involved_addresses
-                                cluster_alerts[cluster_alerts["alertId"] == alert_id]["cluster_identifiers"].apply(lambda x: involved_clusters.update(set(x)))
-                                cluster_alerts[cluster_alerts["alertId"] == alert_id]["hash"].apply(lambda x: hashes.add(x))
-                                logging.info(f"Found alert {alert_id} in stage {stage} for cluster {potential_attacker_cluster_lower}")
-
-                        logging.info(f"Address {potential_attacker_cluster_lower} stages: {stages}")
-
-                        # if all 4 stages are observed, update the address alerted list and add a finding
-                        if len(stages) == 4 and potential_attacker_cluster_lower not in ALERTED_CLUSTERS:
-                            tx_count = 0
-                            try:
-                                tx_count = get_max_transaction_count(w3, potential_attacker_cluster_lower)
-                            except Exception as e:
-                                logging.error(e)
-                                logging.error("Exception in assessing get_transaction_count")
-
-                            if tx_count > TX_COUNT_FILTER_THRESHOLD:
-                                logging.info(f"Cluster {potential_attacker_cluster_lower} transacton count: {tx_count}")
-                                continue
-                            update_alerted_clusters(w3, potential_attacker_cluster_lower)
-                            FINDINGS_CACHE.append(AlertCombinerFinding.alert_combiner(potential_attacker_cluster_lower, start_date, end_date, involved_clusters, involved_alert_ids, 'ATTACK-DETECTOR-1', hashes))
-                            logging.info(f"Findings count {len(FINDINGS_CACHE)}")
-                except: # Exception as e:
-                    #logging.warn(f"Error processing address combiner alert 1 {potential_attacker_address}: {e}")
-                    logging.warn(f"Error processing address combiner alert 1 {potential_attacker_cluster_lower}")
-                    continue
+def group_positions_by_alert_id(alert_records: dict, positions: list) -> dict:
+    """
+    this function groups the given alert positions by alert id, keeping alert ids in order of first appearance
+    :return: cluster_alerts: dict alert id -> list of positions in alert_records
+    """
+    cluster_alerts = {}
+    for position in positions:
+        cluster_alerts.setdefault(alert_records[position]["alertId"], []).append(position)
+    return cluster_alerts
 
-            # alert combiner 2 alert
-            logging.info("Attack detector - 2 stages")
 
-            attack_simulation = df_forta_alerts[(df_forta_alerts["alertId"] == "AK-ATTACK-SIMULATION-0")]
-            suspicious_smart_contract_ml = df_forta_alerts[((df_forta_alerts["alertId"] == "SUSPICIOUS-CONTRACT-CREATION") & (df_forta_alerts["bot_id"] == "0x0b241032ca430d9c02eaa6a52d217bbff046f0d1b3f3d2aa928e42a97150ec91"))]
+def get_candidate_rules(alert_records: list, combiner_rules: list, address_clusters: AddressClusters) -> dict:
+    """
+    this function collects the potential attacker clusters of all combiner rules with one pass over the alerts; the candidate sources are indexed by alert id, so each alert is only matched against the sources of its alert id
+    :return: candidate_rules: dict cluster code -> set of positions of the rules in combiner_rules the cluster is a candidate for
+    """
+    candidate_sources = {}
+    for rule_position, rule in enumerate(combiner_rules):
+        for alert_id, bot_id, severity, field, start in rule["candidate_sources"]:
+            candidate_sources.setdefault(alert_id, []).append((rule_position, bot_id, severity, field, start))
+
+    candidate_rules = {}
+    for alert in alert_records:
+        for rule_position, bot_id, severity, field, start in candidate_sources.get(alert["alertId"], []):
+            if (bot_id is not None and alert["bot_id"] != bot_id) or (severity is not None and alert["severity"] != severity):
+                continue
+            if field == "cluster_identifiers":
+                for cluster_code in alert["cluster_codes"]:
+                    candidate_rules.setdefault(cluster_code, set()).add(rule_position)
+            elif isinstance(alert["description"], str):
+                candidate_rules.setdefault(address_clusters.cluster_code(alert["description"][start:start + 42].lower()), set()).add(rule_position)
+    return candidate_rules
+
+
+def aggregate_cluster_alerts(w3, alert_records: dict, cluster_alerts: dict, cluster: str, alert_filter: str, alert_id_stage_mapping: dict) -> dict:
+    """
+    this function aggregates the alerts of a cluster; with the ice_phishing alert filter, only alerts that contain the cluster according to the ice phishing mappings are aggregated
+    stages, alert ids, involved clusters and hashes are taken from the alerts of the base bots only; involved alert ids include all alert ids of the cluster
+    :return: cluster_aggregate: dict with keys stages, alert_ids, involved_alert_ids, involved_clusters (cluster identifiers), hashes
+    """
+    if alert_filter == "ice_phishing":
+        positions = sorted([position for positions in cluster_alerts.values() for position in positions])
+        cluster_alerts = group_positions_by_alert_id(alert_records, [position for position in positions if contains_attacker_addresses_ice_phishing(w3, alert_records[position], cluster)])
+
+    cluster_aggregate = {"stages": set(), "alert_ids": set(), "involved_alert_ids": list(cluster_alerts.keys()), "involved_clusters": set(), "hashes": set()}
+    for alert_id, positions in cluster_alerts.items():
+        if alert_id in alert_id_stage_mapping:
+            cluster_aggregate["stages"].add(alert_id_stage_mapping[alert_id])
+            cluster_aggregate["alert_ids"].add(alert_id)
+            # get addresses from address field to add to involved_addresses
+            for position in positions:
+                cluster_aggregate["involved_clusters"].update(ADDRESS_CLUSTERS.identifier(cluster_code) for cluster_code in alert_records[position]["cluster_codes"])
+                cluster_aggregate["hashes"].add(alert_records[position]["hash"])
+    return cluster_aggregate
+
+
+def matches_combiner_rule(rule: dict, cluster_aggregate: dict) -> bool:
+    """
+    this function assesses whether the aggregated alerts of a cluster meet the stage and alert id conditions of the rule
+    :return: matches: bool
+    """
+    return (len(cluster_aggregate["stages"]) >= rule["min_stages"]
+            and all(stage in cluster_aggregate["stages"] for stage in rule["required_stages"])
+            and (len(rule["alert_id_groups"]) == 0 or any(all(alert_id in cluster_aggregate["alert_ids"] for alert_id in alert_id_group) for alert_id_group in rule["alert_id_groups"])))
 
-            addresses = set()
-            for index, row in attack_simulation.iterrows():
-                addresses.add(row["description"][62:104].lower())  #  "Invocation of the function 0x53000000 of the created contract 0xfd0000000100069ad1670066004306009b487ad7 "
-  
-            for index, row in suspicious_smart_contract_ml.iterrows():
-                addresses.add(row["description"][0:42].lower())
 
-            # replace with cluster identifiers if they exist
-            clusters = swap_addresses_with_clusters(list(addresses), df_address_clusters_exploded)
+CANDIDATE_FILTERS = {"eoa": lambda w3, cluster: not is_contract(w3, cluster) and is_address(w3, cluster),  # skip contracts and unlikely addresses
+                     "no_null_address": lambda w3, cluster: "0x000000000000000000000000000" not in cluster}
 
-            # analyze each address' alerts
-            for potential_attacker_cluster_lower in clusters:
-                try:
-                    logging.debug(potential_attacker_cluster_lower)
-                    # if address is a contract or unlikely address, skip
-                    if(is_contract(w3, potential_attacker_cluster_lower) or not is_address(w3, potential_attacker_cluster_lower)):
-                        continue
 
-                    # map each alert to 4 stages
-                    stages = set()
-                    involved_clusters = set()
-                    hashes = set()
-                    if(len(df_forta_alerts) > 0):
-                        cluster_alerts = df_forta_alerts[df_forta_alerts["cluster_identifiers"].apply(lambda x: potential_attacker_cluster_lower in x if x is not None else False)]
-                        involved_alert_ids = cluster_alerts["alertId"].unique()
-                        for alert_id in involved_alert_ids:
-                            if alert_id in ALERT_ID_STAGE_MAPPING.keys():
-                                stage = ALERT_ID_STAGE_MAPPING[alert_id]
-                                stages.add(stage)
-                                # get addresses from address field to add to involved_addresses
-                                cluster_alerts[cluster_alerts["alertId"] == alert_id]["cluster_identifiers"].apply(lambda x: involved_clusters.update(set(x)))
-                                cluster_alerts[cluster_alerts["alertId"] == alert_id]["hash"].apply(lambda x: hashes.add(x))
-                                logging.info(f"Found alert {alert_id} in stage {stage} for cluster {potential_attacker_cluster_lower}")
-
-                        logging.info(f"Cluster {potential_attacker_cluster_lower} stages: {stages}")
-
-                        # if funding stage is also observed, update the address alerted list and add a finding
-                        if 'Funding' in stages and potential_attacker_cluster_lower not in ALERTED_CLUSTERS:
-                            tx_count = 0
-                            try:
-                                tx_count = get_max_transaction_count(w3, potential_attacker_cluster_lower)
-                            except: # Exception as e:
-                                #logging.error("Exception in assessing get_transaction_count: {}".format(e))
-                                logging.error("Exception in assessing get_transaction_count")
-                            
-                            if tx_count > TX_COUNT_FILTER_THRESHOLD:
-                                logging.info(f"Cluster {potential_attacker_cluster_lower} transacton count: {tx_count}")
-                                continue
-                            update_alerted_clusters(w3, potential_attacker_cluster_lower)
-                            FINDINGS_CACHE.append(AlertCombinerFinding.alert_combiner(potential_attacker_cluster_lower, start_date, end_date, involved_clusters, involved_alert_ids, 'ATTACK-DETECTOR-2', hashes))
-                            logging.info(f"Findings count {len(FINDINGS_CACHE)}")
-                except: # Exception as e:
-                    #logging.warn(f"Error processing address combiner alert 1 {potential_attacker_address}: {e}")
-                    logging.warn(f"Error processing address combiner alert 2 {potential_attacker_cluster_lower}")
+def detect_attack(w3, forta_explorer: FortaExplorer, block_event: forta_agent.block_event.BlockEvent):
+    """
+    this function returns finding for any address for which alerts in 4 stages were observed in a given time window
+    :return: findings: list
+    """
+    global ALERTED_CLUSTERS
+    global ICE_PHISHING_ATTACKER_ADDRESSES
+
+    ALERT_ID_STAGE_MAPPING = dict([(alert_id, stage) for bot_id, alert_id, stage in BASE_BOTS])
+    RPC_CACHE.new_cycle()
+
+    # get alerts from API and exchange addresses with clusters from the entity cluster bot
+    end_date = datetime.utcfromtimestamp(block_event.block.timestamp)
+    start_date = end_date - timedelta(days=ENTITY_CLUSTER_BOT_DATE_LOOKBACK_WINDOW_IN_DAYS)
+    address_clusters = get_address_clusters(start_date=start_date, end_date=end_date, forta_explorer=forta_explorer, chain_id=w3.eth.chain_id)
+    logging.info(f"Fetched clusters {len(address_clusters)}")
+
+    end_date = datetime.utcfromtimestamp(block_event.block.timestamp)
+    start_date = end_date - timedelta(days=DATE_LOOKBACK_WINDOW_IN_DAYS)
+    df_forta_alerts = get_forta_alerts(start_date=start_date, end_date=end_date, address_clusters=address_clusters, forta_explorer=forta_explorer, chain_id=w3.eth.chain_id)
+    with METRICS.phase("aggregates"):
+        CLUSTER_AGGREGATES.update(df_forta_alerts, address_clusters)
+    METRICS.volume("changed_clusters", len(CLUSTER_AGGREGATES.changed))
+
+    # collect the candidate clusters of all enabled combiner rules in one pass over the alerts of their candidate sources and evaluate the rules of each candidate on its aggregated alerts
+    # only candidates whose aggregate or rules changed since they were last evaluated are evaluated again, as well as candidates last evaluated a transaction count ttl ago,
+    # whose transaction count or alerted state may have changed since
+    enabled_detectors = {"ATTACK_DETECTOR": ATTACK_DETECTOR, "SCAM_DETECTOR": SCAM_DETECTOR}
+    combiner_rules = [rule for rule in COMBINER_RULES if enabled_detectors[rule["detector"]]]
+    source_alert_ids = [alert_id for rule in combiner_rules for alert_id, bot_id, severity, field, start in rule["candidate_sources"]]
+    with METRICS.phase("candidates"):
+        candidate_rules = get_candidate_rules(df_forta_alerts[df_forta_alerts["alertId"].isin(source_alert_ids)].to_dict("records"), combiner_rules, address_clusters)
+        changed_candidates = CLUSTER_AGGREGATES.changed_candidates({address_clusters.identifier(cluster_code): frozenset(combiner_rules[rule_position]["alert_id"] for rule_position in rule_positions)
+                                                                     for cluster_code, rule_positions in candidate_rules.items()})
+    METRICS.volume("candidates", len(candidate_rules))
+    METRICS.volume("changed_candidates", len(changed_candidates))
+    logging.info(f"Got {len(candidate_rules)} candidate clusters for {len(combiner_rules)} combiner rules, {len(changed_candidates)} of them changed")
+    candidate_rules = {cluster_code: rule_positions for cluster_code, rule_positions in candidate_rules.items() if address_clusters.identifier(cluster_code) in changed_candidates}
+
+    # only the alerts that reference a candidate cluster with an ice phishing rule are materialized (keyed by their position in df_forta_alerts) and indexed by cluster, so each candidate below is a dictionary lookup
+    # the other rules are evaluated on the cluster aggregates
+    with METRICS.phase("index"):
+        ice_phishing_candidates = [cluster_code for cluster_code, rule_positions in candidate_rules.items() if any(combiner_rules[rule_position]["alert_filter"] == "ice_phishing" for rule_position in rule_positions)]
+        exploded_cluster_codes = df_forta_alerts["cluster_codes"].explode()
+        positions = np.unique(exploded_cluster_codes.index[exploded_cluster_codes.isin(ice_phishing_candidates)].to_numpy(dtype=np.int64))
+        alert_records = dict(zip(positions.tolist(), df_forta_alerts.iloc[positions].to_dict("records")))
+        cluster_alerts_index = index_cluster_alerts(alert_records)
+    METRICS.volume("materialized_alerts", len(alert_records))
+
+    # batched pre-passes for the is_contract checks and the tx_to ice phishing mappings; attacker addresses extracted in earlier cycles are kept for alerts that are still in the window
+    with METRICS.phase("rpc_prefetch"):
+        RPC_CACHE.prefetch_codes(w3, [address for cluster_code, rule_positions in candidate_rules.items() if any("eoa" in combiner_rules[rule_position]["candidate_filters"] for rule_position in rule_positions)
+                                      for address in address_clusters.identifier(cluster_code).split(',')])
+        ICE_PHISHING_ATTACKER_ADDRESSES = {alert_hash: ICE_PHISHING_ATTACKER_ADDRESSES[alert_hash] for alert_hash in df_forta_alerts["hash"] if alert_hash in ICE_PHISHING_ATTACKER_ADDRESSES}
+        candidate_positions = {position for cluster_code in ice_phishing_candidates for positions in cluster_alerts_index.get(cluster_code, {}).values() for position in positions}
+        RPC_CACHE.prefetch_transaction_tos(w3, [alert_records[position]["transactionHash"] for position in sorted(candidate_positions)
+                                                if alert_records[position]["hash"] not in ICE_PHISHING_ATTACKER_ADDRESSES
+                                                and any(location == "tx_to" for location, extractor in ICE_PHISHING_EXTRACTORS.get((alert_records[position]["bot_id"], alert_records[position]["alertId"]), []))])
+    METRICS.volume("rpc_prefetch_round_trips", RPC_CACHE.round_trips)
+
+    for potential_attacker_cluster_code, rule_positions in candidate_rules.items():
+        if SCHEDULER.deadline_exceeded():
+            logging.warn("Detection deadline exceeded; skipping remaining candidate clusters")
+            break
+        potential_attacker_cluster_lower = address_clusters.identifier(potential_attacker_cluster_code)
+        cluster_aggregates = {}  # alert filter -> aggregate of the cluster's alerts, shared by all rules with the same alert filter
+        for rule_position in sorted(rule_positions):
+            rule = combiner_rules[rule_position]
+            rule_start = time.perf_counter()
+            try:
+                logging.debug(f"{rule['alert_id']} {potential_attacker_cluster_lower}")
+                if not all(CANDIDATE_FILTERS[candidate_filter](w3, potential_attacker_cluster_lower) for candidate_filter in rule["candidate_filters"]):
                     continue
 
-        # alert combiner 3 alert - ice phishing
-        if SCAM_DETECTOR:
-            logging.info("Scam detector - ice phishing")
-
-            ice_phishing = df_forta_alerts[(df_forta_alerts["alertId"] == "ICE-PHISHING-HIGH-NUM-APPROVED-TRANSFERS") | (df_forta_alerts["alertId"] == "ICE-PHISHING-PERMITTED-ERC20-TRANSFER")
-                                           | (df_forta_alerts["alertId"] == "ICE-PHISHING-HIGH-NUM-ERC20-APPROVALS") | (df_forta_alerts["alertId"] == "ICE-PHISHING-HIGH-NUM-ERC721-APPROVALS") | (df_forta_alerts["alertId"] == "ICE-PHISHING-ERC20-APPROVAL-FOR-ALL")
-                                           | (df_forta_alerts["alertId"] == "ICE-PHISHING-ERC721-APPROVAL-FOR-ALL") | (df_forta_alerts["alertId"] == "ICE-PHISHING-ERC1155-APPROVAL-FOR-ALL")]
-            addresses = set()
-            ice_phishing["description"].apply(lambda x: addresses.add(get_ice_phishing_attacker_address(x)))
-            logging.info(f"Got {len(addresses)} ice phishing addresses")
-
-            clusters = swap_addresses_with_clusters(list(addresses), df_address_clusters_exploded)
-            logging.info(f"Mapped ice phishing addresses to {len(clusters)} clusters.")
-
-            for potential_attacker_cluster_lower in clusters:
-                try:
-                    logging.debug(potential_attacker_cluster_lower)
-                    if "0x000000000000000000000000000" in potential_attacker_cluster_lower:
+                if rule["alert_filter"] is None and None not in cluster_aggregates:
+                    cluster_aggregates[None] = CLUSTER_AGGREGATES.aggregate(potential_attacker_cluster_lower)
+                elif rule["alert_filter"] not in cluster_aggregates:
+                    cluster_aggregates[rule["alert_filter"]] = aggregate_cluster_alerts(w3, alert_records, cluster_alerts_index.get(potential_attacker_cluster_code, {}), potential_attacker_cluster_lower, rule["alert_filter"], ALERT_ID_STAGE_MAPPING)
+                cluster_aggregate = cluster_aggregates[rule["alert_filter"]]
+                logging.info(f"Cluster {potential_attacker_cluster_lower} stages: {cluster_aggregate['stages']}, alert ids: {cluster_aggregate['alert_ids']}")
+
+                # if the rule's conditions are met, update the address alerted list and add a finding
+                if matches_combiner_rule(rule, cluster_aggregate) and potential_attacker_cluster_lower not in ALERTED_CLUSTERS:
+                    tx_count = 0
+                    try:
+                        tx_count = get_max_transaction_count(w3, potential_attacker_cluster_lower)
+                    except Exception as e:
+                        logging.error(f"Exception in assessing get_transaction_count: {e}")
+
+                    if tx_count > TX_COUNT_FILTER_THRESHOLD:
+                        logging.info(f"Cluster {potential_attacker_cluster_lower} transacton count: {tx_count}")
                         continue
-
-                    alert_ids = set()
-                    involved_clusters = set()
-                    hashes = set()
-                    if(len(df_forta_alerts) > 0):
-                        cluster_alerts = df_forta_alerts[df_forta_alerts["cluster_identifiers"].apply(lambda x: potential_attacker_cluster_lower in x if x is not None else False)]
-                        cluster_alerts = cluster_alerts[cluster_alerts.apply(lambda x: contains_attacker_addresses_ice_phishing(w3, x, potential_attacker_cluster_lower), axis=1)]
-                        involved_alert_ids = cluster_alerts["alertId"].unique()
-                        for alert_id in involved_alert_ids:
-                            if alert_id in ALERT_ID_STAGE_MAPPING.keys():
-                                stage = ALERT_ID_STAGE_MAPPING[alert_id]
-                                alert_ids.add(alert_id)
-                                # get addresses from address field to add to involved_addresses
-                                cluster_alerts[cluster_alerts["alertId"] == alert_id]["cluster_identifiers"].apply(lambda x: involved_clusters.update(set(x)))
-                                cluster_alerts[cluster_alerts["alertId"] == alert_id]["hash"].apply(lambda x: hashes.add(x))
-                                logging.info(f"Found alert {alert_id} in stage {stage} for cluster {potential_attacker_cluster_lower}")
-
-                        logging.info(f"Cluster {potential_attacker_cluster_lower} stages: {alert_ids}")
-
-                        if potential_attacker_cluster_lower not in ALERTED_CLUSTERS:
-                            if (('SLEEPMINT-1' in alert_ids or 'SLEEPMINT-2' in alert_ids)
-                            or ('FUNDING-TORNADO-CASH' in alert_ids or 'TORNADO-CASH-FUNDED-ACCOUNT-INTERACTION' in alert_ids or 'POSSIBLE-MONEY-LAUNDERING-TORNADO-CASH' in alert_ids or 'MALICIOUS-ACCOUNT-FUNDING' in alert_ids)
-                            or ('UNVERIFIED-CODE-CONTRACT-CREATION' in alert_ids and 'FLASHBOT-TRANSACTION' in alert_ids)
-                            or ('AE-MALICIOUS-ADDR' in alert_ids or 'forta-text-messages-possible-hack' in alert_ids)):
-
-                                tx_count = 0
-                                try:
-                                    tx_count = get_max_transaction_count(w3, potential_attacker_cluster_lower)
-                                except: # Exception as e:
-                                    #logging.error("Exception in assessing get_transaction_count: {}".format(e))
-                                    logging.error("Exception in assessing get_transaction_count")
-                            
-                                if tx_count > TX_COUNT_FILTER_THRESHOLD:
-                                    logging.info(f"Cluster {potential_attacker_cluster_lower} transacton count: {tx_count}")
-                                    continue
-                                update_alerted_clusters(w3, potential_attacker_cluster_lower)
-                                FINDINGS_CACHE.append(AlertCombinerFinding.alert_combiner(potential_attacker_cluster_lower, start_date, end_date, involved_clusters, involved_alert_ids, 'ATTACK-DETECTOR-ICE-PHISHING', hashes))
-                                logging.info(f"Findings count {len(FINDINGS_CACHE)}")
-                except Exception as e:
-                    logging.warn(f"Error processing address combiner alert 1 {potential_attacker_cluster_lower}: {e}")
-                    #logging.warn(f"Error processing address combiner alert 3 {potential_attacker_cluster_lower}")
-                    continue
-
-        MUTEX = False
-
-
-def get_ice_phishing_attacker_address(description: str) -> str:
-    # 0x7DA4580bF3168A78f5e30d9bb82f7Ce46daB2dE7 obtained transfer approval for 3 assets by 6 accounts over period of 2 days. ICE-PHISHING-HIGH-NUM-APPROVALS
-    # 0x2f993D27649d935cCcD44E6591eee3f7175866cf obtained transfer approval for all tokens from 0xf45CFeaf03BD53C8e5Ff5524a58d974126284c67. ICE-PHISHING-APPROVAL-FOR-ALL
-    # 0x0899935fe73759DCBd7CCd18982980A0733A01Aa transferred 3 assets from 1 accounts over period of 1 days. ICE-PHISHING-HIGH-NUM-APPROVED-TRANSFERS
-    return description[:42].lower()
+                    update_alerted_clusters(w3, potential_attacker_cluster_lower)
+                    FINDINGS_CACHE.append(AlertCombinerFinding.alert_combiner(potential_attacker_cluster_lower, start_date, end_date, cluster_aggregate["involved_clusters"],
+                                                                              cluster_aggregate["involved_alert_ids"], rule["alert_id"], cluster_aggregate["hashes"]))
+                    logging.info(f"Findings count {len(FINDINGS_CACHE)}")
+            except Exception as e:
+                logging.warn(f"Error processing {rule['alert_id']} for cluster {potential_attacker_cluster_lower}: {e}")
+                continue  # evaluated again once the aggregate changes or the recheck ttl passed, not every cycle
+            finally:
+                METRICS.add_seconds(f"evaluate_{rule['alert_id']}", time.perf_counter() - rule_start)
+                METRICS.volume(f"evaluated_{rule['alert_id']}", 1)
+        CLUSTER_AGGREGATES.evaluated(potential_attacker_cluster_lower)
+
+    logging.info(f"JSON-RPC round trips {RPC_CACHE.round_trips}")
+    METRICS.volume("findings", len(FINDINGS_CACHE))
+    METRICS.volume("rpc_round_trips", RPC_CACHE.round_trips)
+    METRICS.volume("rpc_lookups", RPC_CACHE.lookups)
+    METRICS.volume("rpc_cache_hits", RPC_CACHE.hits)
+
+
+def compile_ice_phishing_extractors(df_ice_phishing_mappings: pd.DataFrame) -> dict:
+    """
+    this function compiles the ice phishing mappings into extractors of the attacker addresses of an alert
+    :return: ice_phishing_extractors: dict (bot_id, alert_id) -> list of (location, extractor); extractor(w3, alert) returns a list of addresses
+    """
+    metadata_address_pattern = re.compile(r"0x[a-fA-F0-9]{40}")
+    ice_phishing_extractors = {}
+    #  bot_id,alert_id,location,attacker_address_location_in_description,metadata_field
+    for row in df_ice_phishing_mappings.to_dict("records"):
+        if row['location'] == 'description':
+            extractor = lambda w3, alert, start=int(row["attacker_address_location_in_description"]): [alert['description'][start:42].lower()]
+        elif row['location'] == 'metadata':
+            extractor = lambda w3, alert, field=row['metadata_field']: metadata_address_pattern.findall(alert['metadata'][field]) if field in alert['metadata'].keys() else []
+        elif row['location'] == 'cluster_identifiers':
+            extractor = lambda w3, alert: [ADDRESS_CLUSTERS.identifier(cluster_code) for cluster_code in alert['cluster_codes']]  # lower not required as it comes from the network as opposed to user field
+        elif row['location'] == 'tx_to':
+            extractor = lambda w3, alert: [(RPC_CACHE.get_transaction_to(w3, alert['transactionHash']) or "").lower()]  # contract creations have no to address
+        else:
+            continue
+        ice_phishing_extractors.setdefault((row['bot_id'], row['alert_id']), []).append((row['location'], extractor))
+    return ice_phishing_extractors
+
+
+def get_ice_phishing_attacker_addresses(w3, alert: dict) -> set:
+    """
+    this function extracts the attacker addresses of the alert according to the ice phishing mappings; the addresses are memoized by alert hash
+    :return: attacker_addresses: set
+    """
+    attacker_addresses = ICE_PHISHING_ATTACKER_ADDRESSES.get(alert['hash'])
+    if attacker_addresses is None:
+        attacker_addresses = set()
+        for location, extractor in ICE_PHISHING_EXTRACTORS.get((alert['bot_id'], alert['alertId']), []):
+            attacker_addresses.update(extractor(w3, alert))
+        ICE_PHISHING_ATTACKER_ADDRESSES[alert['hash']] = attacker_addresses
+    return attacker_addresses
 
 
-def contains_attacker_addresses_ice_phishing(w3, alert: pd.Series, potential_attacker_address: str) -> bool:
-    global ICE_PHISHING_MAPPINGS_DF
-    # iterate over ice phishing mappings and assess whether the potential attacker address is involved according to the mapping
+def contains_attacker_addresses_ice_phishing(w3, alert: dict, potential_attacker_address: str) -> bool:
+    # assess whether the potential attacker address is involved according to the ice phishing mappings
     if "ICE-PHISHING" in alert["alertId"]:
         return True
 
-    for index, row in ICE_PHISHING_MAPPINGS_DF.iterrows():
-        #  bot_id,alert_id,location,attacker_address_location_in_description,metadata_field
-        if row['bot_id'] == alert['bot_id'] and row['alert_id'] == alert['alertId']:
-            if row['location'] == 'description':
-                if alert['description'][int(row["attacker_address_location_in_description"]):42].lower() == potential_attacker_address:
-                    return True
-            elif row['location'] == 'metadata':
-                if row['metadata_field'] in alert['metadata'].keys():
-                    metadata = alert['metadata'][row["metadata_field"]]
-                    for address in re.findall(r"0x[a-fA-F0-9]{40}", metadata):
-                        if address == potential_attacker_address:
-                            return True
-            elif row['location'] == 'cluster_identifiers':
-                if potential_attacker_address in alert['cluster_identifiers']:  # lower not required as it comes from the network as opposed to user field
-                    return True
-            elif row['location'] == 'tx_to':
-                if potential_attacker_address == w3.eth.get_transaction(alert['transactionHash'])['to'].lower():
-                    return True
-
-    return False
+    return potential_attacker_address in get_ice_phishing_attacker_addresses(w3, alert)
 
 
 def update_alerted_clusters(w3, cluster: str):
@@ -439,32 +502,81 @@ def update_alerted_clusters(w3, cluster: str):
         ALERTED_CLUSTERS.pop(0)
 
 
+def run_detection(w3, forta_explorer: FortaExplorer, block_event: forta_agent.block_event.BlockEvent) -> list:
+    """
+    this function runs detect_attack on the scheduler's worker thread and hands over the findings of the run
+    :return: findings: list
+    """
+    global FINDINGS_CACHE
+
+    METRICS.start_run()
+    try:
+        with METRICS.phase("total"):
+            detect_attack(w3, forta_explorer, block_event)
+    finally:
+        METRICS.finish_run({"rpc_cache_hit_ratio": RPC_CACHE.hits / RPC_CACHE.lookups if RPC_CACHE.lookups > 0 else 1.0, "detection_backlog": SCHEDULER.backlog(),
+                            "detection_coalesced_total": SCHEDULER.coalesced, "detection_deadline_exceeded_total": SCHEDULER.deadline_exceeded_runs})
+    findings = FINDINGS_CACHE
+    FINDINGS_CACHE = []
+    return findings
+
+
 def provide_handle_block(w3, forta_explorer):
     logging.debug("provide_handle_block called")
 
     def handle_block(block_event: forta_agent.block_event.BlockEvent) -> list:
         logging.debug("handle_block with w3 called")
-        global FINDINGS_CACHE
-        global MUTEX
-
-        #detect_attack(w3, forta_explorer, block_event)
-        if not MUTEX:
-            thread = threading.Thread(target=detect_attack, args=(w3, forta_explorer, block_event))
-            thread.start()
 
-        # uncomment for local testing of tx/block ranges (ok for npm run start); otherwise the process will exit
-        #while (thread.is_alive()):
-        #    pass
-        findings = FINDINGS_CACHE
-        FINDINGS_CACHE = []
-        return findings
+        # detection runs on the scheduler's worker; the latest block wins if detection is still busy with an earlier one
+        # pushed alerts trigger their own runs, so blocks only trigger the run that backfills the lookback window
+        if not PUSH_ALERTS or len(ALERT_STORE.backfilled) == 0:
+            SCHEDULER.submit(w3, forta_explorer, block_event)
+        return SCHEDULER.collect()
 
     return handle_block
 
 
+def provide_handle_alert(w3, forta_explorer):
+    logging.debug("provide_handle_alert called")
+    subscriptions = set(subscribed_bot_alert_ids())
+    w3_chain_ids = []  # chain id of w3; resolved on the first pushed alert and reused, as provide_handle_alert also runs on import
+
+    def handle_alert(alert_event: forta_agent.alert_event.AlertEvent) -> list:
+        logging.debug("handle_alert with w3 called")
+        if not PUSH_ALERTS:
+            return []
+
+        # the pushed alert is merged into the alert window by the next run, which only evaluates the candidate clusters whose aggregates changed
+        # the run ends the lookback window at the creation of the alert; runs of alerts pushed while detection is busy are coalesced
+        alert = FortaExplorer.api_alert(alert_event.alert)
+        chain_id = alert["source"]["block"]["chainId"] if alert["source"]["block"] is not None else None
+        if (alert["source"]["bot"]["id"], alert["alertId"]) not in subscriptions:
+            return SCHEDULER.collect()
+        if len(w3_chain_ids) == 0:
+            w3_chain_ids.append(w3.eth.chain_id)
+        if chain_id in [None, w3_chain_ids[0]]:
+            #  alerts pushed without createdAt are taken as created when they are handled, so they end the window then and are evicted with the window
+            created_at = pd.Timestamp(alert["createdAt"]) if alert["createdAt"] is not None else pd.NaT
+            if pd.isna(created_at):
+                created_at = pd.Timestamp.now(tz="UTC")
+                alert["createdAt"] = created_at.isoformat()
+            ALERT_STORE.push(alert)
+            SCHEDULER.submit(w3, forta_explorer, create_block_event({'block': {'timestamp': int(created_at.timestamp())}}))
+        return SCHEDULER.collect()
+
+    return handle_alert
+
+
+SCHEDULER = DetectionScheduler(run_detection, DETECTION_DEADLINE_IN_SECONDS, DETECTION_QUEUE_SIZE)
 real_handle_block = provide_handle_block(web3, forta_explorer)
+real_handle_alert = provide_handle_alert(web3, forta_explorer)
 
 
 def handle_block(block_event: forta_agent.block_event.BlockEvent):
     logging.debug("handle_block called")
     return real_handle_block(block_event)
+
+
+def handle_alert(alert_event: forta_agent.alert_event.AlertEvent):
+    logging.debug("handle_alert called")
+    return real_handle_alert(alert_event)
@@ -1,15 +1,29 @@
 import time
+from datetime import datetime
 
 import pandas as pd
-from forta_agent import create_block_event
+from forta_agent import create_alert_event, create_block_event
 
 import agent
+from address_clusters import AddressClusters
+from constants import COMBINER_RULES
 from forta_explorer_mock import FortaExplorerMock
-from web3_mock import CONTRACT, EOA_ADDRESS, Web3Mock, EOA_ADDRESS_LARGE_TX
+from web3_mock import CONTRACT, EOA_ADDRESS, EthMock, Web3Mock, EOA_ADDRESS_LARGE_TX
 
 w3 = Web3Mock()
 
 
+class EthChainIdMock(EthMock):
+    def __init__(self):
+        super().__init__()
+        self.chain_id_calls = 0
+
+    @property
+    def chain_id(self):
+        self.chain_id_calls += 1
+        return 1
+
+
 class TestAlertCombiner:
     def test_is_contract_eoa(self):
         assert not agent.is_contract(w3, EOA_ADDRESS), "EOA shouldn't be identified as a contract"
@@ -40,6 +54,52 @@ class TestAlertCombiner:
 
 
 
+    def test_index_cluster_alerts(self):
+        alert_records = {0: {"alertId": "A", "cluster_codes": [0, 1], "hash": "0x1"},
+                         1: {"alertId": "B", "cluster_codes": [0, 0], "hash": "0x2"},
+                         5: {"alertId": "A", "cluster_codes": [1], "hash": "0x3"},
+                         6: {"alertId": "C", "cluster_codes": None, "hash": "0x4"}}
+
+        cluster_alerts_index = agent.index_cluster_alerts(alert_records)
+
+        assert cluster_alerts_index == {0: {"A": [0], "B": [1]}, 1: {"A": [0, 5]}}, "index should map each cluster to its alert positions grouped by alert id"
+
+    def test_get_candidate_rules(self):
+        address_clusters = AddressClusters()
+        address_clusters.add_cluster(["0x1c5dcdd006ea78a7e4783f9e6021c32935a10fb4", "0xdec08cb92a506b88411da9ba290f3694be223c26"])
+        alert_records = [{"alertId": "POSSIBLE-MONEY-LAUNDERING-TORNADO-CASH", "bot_id": "0xbot", "severity": "HIGH", "description": "0x1C5dCdd006EA78a7E4783f9e6021C32935a10fb4 potentially transferred funds", "cluster_codes": []},
+                         {"alertId": "forta-text-messages-possible-hack", "bot_id": "0xbot", "severity": "LOW", "description": "", "cluster_codes": [address_clusters.cluster_code("0x2320a28f52334d62622cc2eafa15de55f9987ed9")]},
+                         {"alertId": "ICE-PHISHING-ERC20-APPROVAL-FOR-ALL", "bot_id": "0xbot", "severity": "HIGH", "description": "0x2320A28f52334d62622cc2EaFa15DE55F9987eD9 obtained transfer approval", "cluster_codes": []}]
+
+        candidate_rules = {address_clusters.identifier(cluster_code): rule_positions for cluster_code, rule_positions in agent.get_candidate_rules(alert_records, COMBINER_RULES, address_clusters).items()}
+
+        assert candidate_rules == {"0x1c5dcdd006ea78a7e4783f9e6021c32935a10fb4,0xdec08cb92a506b88411da9ba290f3694be223c26": {0}, "0x2320a28f52334d62622cc2eafa15de55f9987ed9": {2}}, "candidates should be mapped to clusters and only collected for matching sources"
+
+    def test_matches_combiner_rule(self):
+        attack_detector_1, attack_detector_2, ice_phishing = COMBINER_RULES
+
+        assert agent.matches_combiner_rule(attack_detector_1, {"stages": {"Preparation", "Exploitation", "Funding", "MoneyLaundering"}, "alert_ids": set()}), "4 stages should match"
+        assert not agent.matches_combiner_rule(attack_detector_1, {"stages": {"Preparation", "Exploitation", "Funding"}, "alert_ids": set()}), "3 stages should not match"
+        assert agent.matches_combiner_rule(attack_detector_2, {"stages": {"Funding"}, "alert_ids": set()}), "funding stage should match"
+        assert agent.matches_combiner_rule(ice_phishing, {"stages": set(), "alert_ids": {"UNVERIFIED-CODE-CONTRACT-CREATION", "FLASHBOT-TRANSACTION"}}), "complete alert id group should match"
+        assert not agent.matches_combiner_rule(ice_phishing, {"stages": set(), "alert_ids": {"UNVERIFIED-CODE-CONTRACT-CREATION"}}), "incomplete alert id group should not match"
+
+    def test_get_ice_phishing_attacker_addresses(self):
+        agent.initialize()
+        w3 = Web3Mock()
+        transaction_hashes = []
+        get_transaction = w3.eth.get_transaction
+        w3.eth.get_transaction = lambda transaction_hash: transaction_hashes.append(transaction_hash) or get_transaction(transaction_hash)
+
+        text_message = {"alertId": "forta-text-messages-possible-hack", "bot_id": "0x11b3d9ffb13a72b776e1aed26616714d879c481d7a463020506d1fb5f33ec1d4", "hash": "0x1", "transactionHash": "0xabc", "description": "", "metadata": {}}
+        malicious_address = {"alertId": "AE-MALICIOUS-ADDR", "bot_id": "0xd935a697faab13282b3778b2cb8dd0aa4a0dde07877f9425f3bf25ac7b90b895", "hash": "0x2", "transactionHash": "0xdef", "description": "",
+                             "metadata": {"malicious_details": "[{'address': '0x21e13f16838e2fe78056f5fd50251ffd6e7098b4'}]"}}
+
+        assert agent.get_ice_phishing_attacker_addresses(w3, text_message) == {"0x21e13f16838e2fe78056f5fd50251ffd6e7098b4"}, "tx_to mapping should extract the to address"
+        assert agent.get_ice_phishing_attacker_addresses(w3, malicious_address) == {"0x21e13f16838e2fe78056f5fd50251ffd6e7098b4"}, "metadata mapping should extract the addresses of the metadata field"
+        assert agent.contains_attacker_addresses_ice_phishing(w3, text_message, "0x21e13f16838e2fe78056f5fd50251ffd6e7098b4"), "extracted address should be contained"
+        assert transaction_hashes == ["0xabc"], "transaction should only be fetched once per alert"
+
     def test_detect_alert_pos_finding_combiner_1(self):
         agent.initialize()
 
@@ -158,6 +218,124 @@ class TestAlertCombiner:
 
         assert len(agent.FINDINGS_CACHE) == 1, "this should have triggered a finding"
 
+    def test_run_detection_records_metrics(self):
+        agent.initialize()
+
+        forta_explorer = FortaExplorerMock()
+
+        df_forta = pd.DataFrame([
+            ["2022-04-30T23:55:17.284158264Z", "Account got approval for all tokens", "ethereum",
+             "SUSPICIOUS", {"transactionHash": "0x53244cc27feed6c1d7f44381119cf14054ef2aa6ea7fbec5af4e4258a5a02617", "block": {"number": 14688607, "chainId": 1}, "bot": {"id": "0xe8527df509859e531e58ba4154e9157eb6d9b2da202516a66ab120deabd3f9f6"}},
+             "HIGH", {}, "ICE-PHISHING-ERC20-APPROVAL-FOR-ALL", "0x21E13f16838e2fe78056f5fd50251ffd6e7098b4 obtained transfer approval for 3 assets by 6 accounts over period of 2 days.", ["0x21e13f16838e2fe78056f5fd50251ffd6e7098b4"], [], "0x22abd26df70f12b4d2527a092b8f42a467dd6356fcff57a0d9241ac1c6244e10"],
+
+            ["2022-04-30T23:55:17.284158264Z", "Malicious Address", "ethereum",
+             "SUSPICIOUS", {"transactionHash": "0x53244cc27feed6c1d7f44381119cf14054ef2aa6ea7fbec5af4e4258a5a02618", "block": {"number": 14688607, "chainId": 1}, "bot": {"id": "0xd935a697faab13282b3778b2cb8dd0aa4a0dde07877f9425f3bf25ac7b90b895"}},
+             "HIGH", {"amount":"0","from":"0x4f07bb5b0c204da3d1c7a35dab23114ac2145980","malicious_details":"[{'index': '609', 'id': '1ae52e', 'name': 'moonbirdsraffle.xyz', 'type': 'scam', 'url': 'https://moonbirdsraffle.xyz', 'hostname': 'moonbirdsraffle.xyz', 'featured': '0', 'path': '/*', 'category': 'Phishing', 'subcategory': 'Moonbirds', 'description': 'Fake Moonbirds NFT site phishing for funds', 'reporter': 'CryptoScamDB', 'severity': '1', 'updated': '1.65635E+12', 'address': '0x21e13f16838e2fe78056f5fd50251ffd6e7098b4'}]","to":"0x335eeef8e93a7a757d9e7912044d9cd264e2b2d8"}, "AE-MALICIOUS-ADDR", "0x21e13f16838e2fe78056f5fd50251ffd6e7098b4 obtained", ["0x21e13f16838e2fe78056f5fd50251ffd6e7098b4"], [], "0x32abd26df70f12b4d2527a092b8f42a467dd6356fcff57a0d9241ac1c6244e11"]
+        ], columns=['createdAt', 'name', 'protocol', 'findingType', 'source', 'severity', 'metadata', 'alertId', 'description', 'addresses', 'contracts', 'hash'])
+
+        forta_explorer.set_df(df_forta)
+        block_event = create_block_event({
+            'block': {
+                'timestamp': 1651314415,
+            }
+        })
+
+        runs = agent.METRICS.runs
+        findings = agent.run_detection(w3, forta_explorer, block_event)
+
+        assert len(findings) == 1, "this should have triggered a finding"
+        assert agent.METRICS.runs == runs + 1, "run should be recorded"
+        assert {"fetch_clusters", "fetch_alerts", "cluster_join", "aggregates", "candidates", "index", "rpc_prefetch", "evaluate_ATTACK-DETECTOR-ICE-PHISHING", "total"}.issubset(agent.METRICS.seconds.keys()), "all phases should be timed"
+        assert agent.METRICS.volumes["alerts"] == 2, "alert rows should be counted"
+        assert agent.METRICS.volumes["findings"] == 1, "findings should be counted"
+        assert agent.METRICS.volumes["evaluated_ATTACK-DETECTOR-ICE-PHISHING"] == 1, "evaluated candidates should be counted per rule"
+
+    def test_handle_alert_detects_pushed_alert(self):
+        push_alerts = agent.PUSH_ALERTS
+        try:
+            agent.PUSH_ALERTS = True
+            alert_config = agent.initialize()
+
+            forta_explorer = FortaExplorerMock()
+            df_forta = pd.DataFrame([
+                ["2022-04-30T23:55:17.284158264Z", "Account got approval for all tokens", "ethereum",
+                 "SUSPICIOUS", {"transactionHash": "0x53244cc27feed6c1d7f44381119cf14054ef2aa6ea7fbec5af4e4258a5a02617", "block": {"number": 14688607, "chainId": 1}, "bot": {"id": "0x8badbf2ad65abc3df5b1d9cc388e419d9255ef999fb69aac6bf395646cf01c14"}},
+                 "HIGH", {}, "ICE-PHISHING-ERC20-APPROVAL-FOR-ALL", "0x21E13f16838e2fe78056f5fd50251ffd6e7098b4 obtained transfer approval for 3 assets by 6 accounts over period of 2 days.", ["0x21e13f16838e2fe78056f5fd50251ffd6e7098b4"], [], "0x22abd26df70f12b4d2527a092b8f42a467dd6356fcff57a0d9241ac1c6244e10"]
+            ], columns=['createdAt', 'name', 'protocol', 'findingType', 'source', 'severity', 'metadata', 'alertId', 'description', 'addresses', 'contracts', 'hash'])
+            forta_explorer.set_df(df_forta)
+
+            handle_block = agent.provide_handle_block(w3, forta_explorer)
+            handle_alert = agent.provide_handle_alert(w3, forta_explorer)
+
+            handle_block(create_block_event({'block': {'timestamp': 1651314415}}))
+            agent.SCHEDULER.join()
+
+            def alerts_by_bots_after(*args):
+                raise Exception("api should only be queried to backfill the window")
+            forta_explorer.alerts_by_bots_after = alerts_by_bots_after
+
+            handle_block(create_block_event({'block': {'timestamp': 1651314427}}))
+            handle_alert(create_alert_event({'alert': {
+                'createdAt': "2022-04-30T23:55:17.284158264Z", 'name': "Malicious Address", 'protocol': "ethereum", 'findingType': "SUSPICIOUS", 'severity': "HIGH",
+                'source': {"transactionHash": "0x53244cc27feed6c1d7f44381119cf14054ef2aa6ea7fbec5af4e4258a5a02618", "block": {"number": 14688607, "chainId": 1}, "bot": {"id": "0xd935a697faab13282b3778b2cb8dd0aa4a0dde07877f9425f3bf25ac7b90b895"}},
+                'metadata': {"amount":"0","from":"0x4f07bb5b0c204da3d1c7a35dab23114ac2145980","malicious_details":"[{'index': '609', 'id': '1ae52e', 'name': 'moonbirdsraffle.xyz', 'type': 'scam', 'url': 'https://moonbirdsraffle.xyz', 'hostname': 'moonbirdsraffle.xyz', 'featured': '0', 'path': '/*', 'category': 'Phishing', 'subcategory': 'Moonbirds', 'description': 'Fake Moonbirds NFT site phishing for funds', 'reporter': 'CryptoScamDB', 'severity': '1', 'updated': '1.65635E+12', 'address': '0x21e13f16838e2fe78056f5fd50251ffd6e7098b4'}]","to":"0x335eeef8e93a7a757d9e7912044d9cd264e2b2d8"}, 'alertId': "AE-MALICIOUS-ADDR", 'description': "0x21e13f16838e2fe78056f5fd50251ffd6e7098b4 obtained",
+                'addresses': ["0x21e13f16838e2fe78056f5fd50251ffd6e7098b4"], 'contracts': [], 'hash': "0x32abd26df70f12b4d2527a092b8f42a467dd6356fcff57a0d9241ac1c6244e11"}}))
+            agent.SCHEDULER.join()
+            findings = handle_alert(create_alert_event({'alert': {'alertId': "OTHER-ALERT", 'source': {"bot": {"id": "0x1"}}}}))
+        finally:
+            agent.PUSH_ALERTS = push_alerts
+            agent.initialize()
+
+        assert {"botId": "0xd935a697faab13282b3778b2cb8dd0aa4a0dde07877f9425f3bf25ac7b90b895", "alertId": "AE-MALICIOUS-ADDR"} in alert_config["alertConfig"]["subscriptions"], "base bots should be subscribed to"
+        assert len(findings) == 1, "pushed alert should have triggered a finding"
+
+    def test_handle_alert_without_created_at(self):
+        push_alerts = agent.PUSH_ALERTS
+        submit = agent.SCHEDULER.submit
+        block_events = []
+        try:
+            agent.PUSH_ALERTS = True
+            agent.initialize()
+            agent.SCHEDULER.submit = lambda w3, forta_explorer, block_event: block_events.append(block_event)
+            handle_alert = agent.provide_handle_alert(w3, FortaExplorerMock())
+
+            handle_alert(create_alert_event({'alert': {
+                'alertId': "AE-MALICIOUS-ADDR", 'hash': "0x1",
+                'source': {"block": {"number": 14688607, "chainId": 1}, "bot": {"id": "0xd935a697faab13282b3778b2cb8dd0aa4a0dde07877f9425f3bf25ac7b90b895"}}}}))
+            pushed = agent.ALERT_STORE.pop_pushed([("0xd935a697faab13282b3778b2cb8dd0aa4a0dde07877f9425f3bf25ac7b90b895", "AE-MALICIOUS-ADDR")])
+        finally:
+            agent.SCHEDULER.submit = submit
+            agent.PUSH_ALERTS = push_alerts
+            agent.initialize()
+
+        assert len(pushed) == 1 and pushed[0]["createdAt"] is not None, "alert without createdAt should be pushed as created when it was handled"
+        assert len(block_events) == 1 and abs(block_events[0].block.timestamp - datetime.now().timestamp()) < 60, "run should end the window at the time the alert was handled"
+
+    def test_handle_alert_from_other_chain(self):
+        push_alerts = agent.PUSH_ALERTS
+        submit = agent.SCHEDULER.submit
+        block_events = []
+        w3_chain_id = Web3Mock()
+        w3_chain_id.eth = EthChainIdMock()
+        try:
+            agent.PUSH_ALERTS = True
+            agent.initialize()
+            agent.SCHEDULER.submit = lambda w3, forta_explorer, block_event: block_events.append(block_event)
+            handle_alert = agent.provide_handle_alert(w3_chain_id, FortaExplorerMock())
+
+            for chain_id in [137, 1, 137]:
+                handle_alert(create_alert_event({'alert': {
+                    'createdAt': "2022-04-30T23:55:17.284158264Z", 'alertId': "AE-MALICIOUS-ADDR", 'hash': "0x1",
+                    'source': {"block": {"number": 14688607, "chainId": chain_id}, "bot": {"id": "0xd935a697faab13282b3778b2cb8dd0aa4a0dde07877f9425f3bf25ac7b90b895"}}}}))
+            pushed = agent.ALERT_STORE.pop_pushed([("0xd935a697faab13282b3778b2cb8dd0aa4a0dde07877f9425f3bf25ac7b90b895", "AE-MALICIOUS-ADDR")])
+        finally:
+            agent.SCHEDULER.submit = submit
+            agent.PUSH_ALERTS = push_alerts
+            agent.initialize()
+
+        assert len(pushed) == 1 and len(block_events) == 1, "only the alert of the bot's chain should be pushed"
+        assert w3_chain_id.eth.chain_id_calls == 1, "chain id should only be resolved once"
+
     def test_detect_alert_pos_finding_combiner_3_tx_to(self):
         agent.initialize()
 
@@ -184,6 +362,49 @@ class TestAlertCombiner:
 
         assert len(agent.FINDINGS_CACHE) == 1, "this should have triggered a finding"
 
+    def test_detect_alert_tx_to_contract_creation(self):
+        agent.initialize()
+        w3 = Web3Mock()
+        w3.eth.get_transaction = lambda transaction_hash: {'to': None}
+
+        text_message = {"alertId": "forta-text-messages-possible-hack", "bot_id": "0x11b3d9ffb13a72b776e1aed26616714d879c481d7a463020506d1fb5f33ec1d4", "hash": "0x1", "transactionHash": "0xabc", "description": "", "metadata": {}}
+        assert agent.get_ice_phishing_attacker_addresses(w3, text_message) == {""}, "contract creation should not yield an attacker address"
+
+    def test_detect_alert_failed_candidate_is_not_evaluated_every_cycle(self):
+        agent.initialize()
+        w3 = Web3Mock()
+        transaction_hashes = []
+
+        def get_transaction(transaction_hash):
+            transaction_hashes.append(transaction_hash)
+            raise Exception("transaction not found")
+        w3.eth.get_transaction = get_transaction
+
+        forta_explorer = FortaExplorerMock()
+        df_forta = pd.DataFrame([
+            ["2022-04-30T23:55:17.284158264Z", "Account got approval for all tokens", "ethereum",
+             "SUSPICIOUS", {"transactionHash": "0x53244cc27feed6c1d7f44381119cf14054ef2aa6ea7fbec5af4e4258a5a02617", "block": {"number": 14688607, "chainId": 1}, "bot": {"id": "0xe8527df509859e531e58ba4154e9157eb6d9b2da202516a66ab120deabd3f9f6"}},
+             "HIGH", {}, "ICE-PHISHING-ERC20-APPROVAL-FOR-ALL", "0x21E13f16838e2fe78056f5fd50251ffd6e7098b4 obtained transfer approval for 3 assets by 6 accounts over period of 2 days.", ["0x21e13f16838e2fe78056f5fd50251ffd6e7098b4"], [], "0x22abd26df70f12b4d2527a092b8f42a467dd6356fcff57a0d9241ac1c6244e10"],
+
+            ["2022-04-30T23:55:17.284158264Z", "Text message agent", "ethereum",
+             "SUSPICIOUS", {"transactionHash": "0x53244cc27feed6c1d7f44381119cf14054ef2aa6ea7fbec5af4e4258a5a02618", "block": {"number": 14688607, "chainId": 1}, "bot": {"id": "0x11b3d9ffb13a72b776e1aed26616714d879c481d7a463020506d1fb5f33ec1d4"}},
+             "HIGH", {}, "forta-text-messages-possible-hack", "description", ["0x21e13f16838e2fe78056f5fd50251ffd6e7098b4"], [], "0x32abd26df70f12b4d2527a092b8f42a467dd6356fcff57a0d9241ac1c6244e11"]
+        ], columns=['createdAt', 'name', 'protocol', 'findingType', 'source', 'severity', 'metadata', 'alertId', 'description', 'addresses', 'contracts', 'hash'])
+        forta_explorer.set_df(df_forta)
+        block_event = create_block_event({
+            'block': {
+                'timestamp': 1651314415,
+            }
+        })
+
+        agent.detect_attack(w3, forta_explorer, block_event)
+        assert len(transaction_hashes) > 0, "transaction of the text message should have been looked up"
+        assert len(agent.FINDINGS_CACHE) == 0, "failed candidate should not trigger a finding"
+
+        lookups = len(transaction_hashes)
+        agent.detect_attack(w3, forta_explorer, block_event)
+        assert len(transaction_hashes) == lookups, "failed candidate with an unchanged aggregate should not be evaluated again before the recheck ttl"
+
     def test_detect_alert_no_finding_large_tx_count(self):
         agent.initialize()
 
@@ -330,3 +551,35 @@ class TestAlertCombiner:
         agent.detect_attack(w3, forta_explorer, block_event)
 
         assert len(agent.FINDINGS_CACHE) == 1, "this should have triggered a finding"
+
+    def test_get_forta_alerts_concurrent_matches_sequential(self):
+        forta_explorer = FortaExplorerMock()
+
+        df_forta = pd.DataFrame([
+            ["2022-04-30T23:55:17.284158264Z", "Tornado Cash Funding", "ethereum",
+             "SUSPICIOUS", {"transactionHash": "0x53244cc27feed6c1d7f44381119cf14054ef2aa6ea7fbec5af4e4258a5a02618", "block": {"number": 14688607, "chainId": 1}, "bot": {"id": "0xa91a31df513afff32b9d85a2c2b7e786fdd681b3cdd8d93d6074943ba31ae400"}},
+             "HIGH", {}, "FUNDING-TORNADO-CASH", "description", ["0x1c5dCdd006EA78a7E4783f9e6021C32935a10fb4"], [], "0x32abd26df70f12b4d2527a092b8f42a467dd6356fcff57a0d9241ac1c6244e11"],
+
+            ["2022-04-30T23:55:17.284158264Z", "Reentrancy", "ethereum",
+             "SUSPICIOUS", {"transactionHash": "0x53244cc27feed6c1d7f44381119cf14054ef2aa6ea7fbec5af4e4258a5a02620", "block": {"number": 14688607, "chainId": 1}, "bot": {"id": "0x492c05269cbefe3a1686b999912db1fb5a39ce2e4578ac3951b0542440f435d9"}},
+             "HIGH", {}, "NETHFORTA-25", "description", ["0x91C1B58F24F5901276b1F2CfD197a5B73e31F96E", EOA_ADDRESS], [], "0x42abd26df70f12b4d2527a092b8f42a467dd6356fcff57a0d9241ac1c6244e12"]
+        ], columns=['createdAt', 'name', 'protocol', 'findingType', 'source', 'severity', 'metadata', 'alertId', 'description', 'addresses', 'contracts', 'hash'])
+        forta_explorer.set_df(df_forta)
+
+        start_date = datetime(2022, 4, 29)
+        end_date = datetime(2022, 4, 30)
+        max_workers = agent.FORTA_EXPLORER_MAX_WORKERS
+        try:
+            agent.initialize()
+            agent.FORTA_EXPLORER_MAX_WORKERS = 1
+            address_clusters = agent.get_address_clusters(start_date, end_date, forta_explorer, 1)
+            df_sequential = agent.get_forta_alerts(start_date, end_date, address_clusters, forta_explorer, 1)
+
+            agent.initialize()
+            agent.FORTA_EXPLORER_MAX_WORKERS = 8
+            address_clusters = agent.get_address_clusters(start_date, end_date, forta_explorer, 1)
+            df_concurrent = agent.get_forta_alerts(start_date, end_date, address_clusters, forta_explorer, 1)
+        finally:
+            agent.FORTA_EXPLORER_MAX_WORKERS = max_workers
+
+        assert df_concurrent.equals(df_sequential), "concurrent fetch should return the same alerts as sequential fetch"
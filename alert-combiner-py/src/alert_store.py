@@ -0,0 +1,229 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from contextlib import closing
+from datetime import datetime
+
+import pandas as pd
+
+
+class AlertStore:
+    """
+    rolling in-process store of alerts keyed by (bot_id, alert_id)
+    it remembers the endCursor of the last page fetched for each batch of keys, so a refresh only pulls alerts raised since the previous refresh,
+    and evicts alerts once they age out of the lookback window
+    if a path is given, alerts and cursors are also persisted there (one SQLite partition per day keyed by alert hash), so a restarted bot loads the partitions
+    inside the lookback window and resumes from the stored cursors instead of re-downloading the window
+    with push_alerts, alerts pushed to the bot are buffered and merged by the next refresh; the API is then only queried once per batch of keys to backfill the window
+    """
+
+    def __init__(self, path: str = None, categorical_columns: list = None, address_columns: list = None, push_alerts: bool = False):
+        self.alerts = {}  # (bot_id, alert_id) -> pd.DataFrame
+        self.cursors = {}  # tuple of (bot_id, alert_id) fetched together -> endCursor, e.g. {"alertId": "...", "blockNumber": 123}
+        self.categorical_columns = categorical_columns or []  # low cardinality columns held as categoricals
+        self.address_columns = address_columns or []  # columns with lists of addresses held as interned lower case strings, so an address seen in many alerts is held once; FortaExplorer interns the fetched alerts, the store the loaded ones
+        self.path = path  # folder with alerts-YYYY-MM-DD.sqlite partitions and cursors.json; None keeps the alerts in memory only
+        self.lock = threading.Lock()  # batches are refreshed concurrently: guards the dicts and sets shared between them and writes to disk one at a time
+        self.loaded = set()  # (bot_id, alert_id) whose persisted alerts were loaded
+        self.evicted = set()  # (day, bot_id, alert_id) already deleted from partitions outside of the lookback window
+        self.push_alerts = push_alerts
+        self.pushed = {}  # (bot_id, alert_id) -> list of pushed alerts as returned by the API that weren't merged yet
+        self.backfilled = set()  # tuple of (bot_id, alert_id) fetched together that were backfilled from the API by this process
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self.cursors = self.load_cursors()
+
+    def refresh(self, forta_explorer, bot_id: str, alert_id: str, chain_id: int, start_date: datetime, end_date: datetime, fields: list = None) -> pd.DataFrame:
+        """
+        this function fetches new alerts for the bot/ alert id, merges them into the store and evicts alerts older than start_date
+        :return: df_alerts: pd.DataFrame - all stored alerts for the bot/ alert id within the lookback window
+        """
+        return self.refresh_batch(forta_explorer, [(bot_id, alert_id)], chain_id, start_date, end_date, fields)[(bot_id, alert_id)]
+
+    def refresh_batch(self, forta_explorer, bot_alert_ids: list, chain_id: int, start_date: datetime, end_date: datetime, fields: list = None) -> dict:
+        """
+        this function fetches new alerts for several (bot_id, alert_id) pairs with one batched query that shares a single cursor,
+        merges them into the store and evicts alerts older than start_date; only the given fields are fetched (None fetches all fields), so a pair should always be refreshed with the same fields
+        with push_alerts, the batch is only fetched from the API once to backfill the window; later refreshes merge the pushed alerts instead
+        :return: alerts: dict (bot_id, alert_id) -> pd.DataFrame - all stored alerts for each pair within the lookback window
+        """
+        batch_key = tuple(bot_alert_ids)
+        if self.path is not None:
+            self.load_partitions([key for key in bot_alert_ids if key not in self.loaded], start_date)
+        if self.push_alerts and batch_key in self.backfilled:
+            # the cursor isn't advanced by pushed alerts, so a restarted bot backfills from the last fetched alert; refetched alerts are deduplicated by hash
+            new_alerts, _ = forta_explorer.alerts_by_bots_from_pages(bot_alert_ids, [(self.pop_pushed(bot_alert_ids), None)], fields)
+        else:
+            with self.lock:
+                cursor = self.cursors.get(batch_key)
+            new_alerts, cursor = forta_explorer.alerts_by_bots_after(bot_alert_ids, chain_id, start_date, end_date, cursor, fields)
+            with self.lock:
+                self.cursors[batch_key] = cursor
+                self.backfilled.add(batch_key)  # alerts pushed during the backfill are merged by the next refresh
+        if self.path is not None:
+            self.persist(bot_alert_ids, new_alerts, start_date)
+
+        alerts = {}
+        for key in bot_alert_ids:
+            df_new_alerts = new_alerts[key]
+            with self.lock:
+                df_alerts = self.alerts.get(key)
+            if df_alerts is None:
+                df_alerts = df_new_alerts.drop_duplicates(subset="hash", keep="last")
+            elif len(df_new_alerts) > 0:
+                df_alerts = pd.concat([df_alerts, df_new_alerts]).drop_duplicates(subset="hash", keep="last")
+
+            df_alerts = self.compact(AlertStore.evict(df_alerts, start_date))
+            with self.lock:
+                self.alerts[key] = df_alerts
+            alerts[key] = df_alerts
+            logging.debug(f"Alert store {key[0]}, {key[1]}: fetched {len(df_new_alerts)} alerts, holding {len(df_alerts)} alerts")
+        return alerts
+
+    def push(self, alert: dict):
+        """
+        this function buffers an alert pushed to the bot (as returned by the API, see FortaExplorer.api_alert) until the next refresh of its bot/ alert id
+        """
+        with self.lock:
+            self.pushed.setdefault((alert["source"]["bot"]["id"], alert["alertId"]), []).append(alert)
+
+    def pop_pushed(self, bot_alert_ids: list) -> list:
+        """
+        this function removes the buffered alerts of the (bot_id, alert_id) pairs from the buffer
+        :return: alerts: list of alerts as returned by the API, per pair in the order they were pushed
+        """
+        with self.lock:
+            return [alert for key in bot_alert_ids for alert in self.pushed.pop(key, [])]
+
+    @staticmethod
+    def evict(df_alerts: pd.DataFrame, start_date: datetime) -> pd.DataFrame:
+        """
+        this function removes alerts created before the start date; the date range of the API is day granular, so is the eviction
+        createdAt is parsed by FortaExplorer.collect_alerts and load_partitions; alerts merged in any other way are parsed here
+        :return: df_alerts: pd.DataFrame
+        """
+        if len(df_alerts) == 0:
+            return df_alerts
+
+        created_at = df_alerts["createdAt"]
+        if not pd.api.types.is_datetime64tz_dtype(created_at):
+            created_at = pd.to_datetime(created_at, utc=True)
+        start_day = pd.Timestamp(start_date).normalize()
+        in_window = created_at >= (start_day.tz_localize("UTC") if start_day.tzinfo is None else start_day)
+        if in_window.all():
+            return df_alerts
+        return df_alerts[in_window].reset_index(drop=True)
+
+    def intern_addresses(self, df_alerts: pd.DataFrame) -> pd.DataFrame:
+        """
+        this function replaces the addresses of the address columns of loaded alerts with interned lower case strings
+        :return: df_alerts: pd.DataFrame
+        """
+        columns = [column for column in self.address_columns if column in df_alerts.columns]
+        if len(columns) == 0 or len(df_alerts) == 0:
+            return df_alerts
+        return df_alerts.assign(**{column: [[sys.intern(address.lower()) for address in addresses] if isinstance(addresses, list) else addresses for addresses in df_alerts[column]] for column in columns})
+
+    def compact(self, df_alerts: pd.DataFrame) -> pd.DataFrame:
+        """
+        this function converts the categorical columns that were widened to strings by merging new alerts back to categoricals
+        :return: df_alerts: pd.DataFrame
+        """
+        columns = [column for column in self.categorical_columns if column in df_alerts.columns and not isinstance(df_alerts[column].dtype, pd.CategoricalDtype)]
+        if len(columns) == 0:
+            return df_alerts
+        return df_alerts.astype({column: "category" for column in columns})
+
+    def partition_path(self, day: str) -> str:
+        return os.path.join(self.path, f"alerts-{day}.sqlite")
+
+    def partition_days(self) -> list:
+        """
+        this function lists the days of all persisted partitions
+        :return: days: list of str "%Y-%m-%d" in ascending order
+        """
+        return sorted(file_name[len("alerts-"):-len(".sqlite")] for file_name in os.listdir(self.path) if file_name.startswith("alerts-") and file_name.endswith(".sqlite"))
+
+    def connect(self, day: str) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.partition_path(day))
+        connection.execute("CREATE TABLE IF NOT EXISTS alerts (hash TEXT PRIMARY KEY, bot_id TEXT, alert_id TEXT, alert TEXT)")
+        connection.execute("CREATE INDEX IF NOT EXISTS alerts_bot_alert_id ON alerts (bot_id, alert_id)")
+        return connection
+
+    def load_partitions(self, bot_alert_ids: list, start_date: datetime):
+        """
+        this function loads the persisted alerts of the (bot_id, alert_id) pairs from the partitions inside the lookback window
+        """
+        start_day = datetime.strftime(start_date, "%Y-%m-%d")
+        records = {key: [] for key in bot_alert_ids}
+        with self.lock:
+            for day in self.partition_days():
+                if day < start_day:
+                    continue
+                with closing(self.connect(day)) as connection:
+                    for bot_id, alert_id in bot_alert_ids:
+                        for (alert,) in connection.execute("SELECT alert FROM alerts WHERE bot_id = ? AND alert_id = ? ORDER BY rowid", (bot_id, alert_id)):
+                            records[(bot_id, alert_id)].append(json.loads(alert))
+
+        for key in bot_alert_ids:
+            df_alerts = None
+            if len(records[key]) > 0:
+                df_alerts = self.intern_addresses(pd.DataFrame(records[key]))
+                df_alerts = df_alerts.assign(createdAt=pd.to_datetime(df_alerts["createdAt"], utc=True))
+            with self.lock:
+                self.loaded.add(key)
+                if df_alerts is None or key in self.alerts:
+                    continue
+                self.alerts[key] = df_alerts
+            logging.info(f"Alert store {key[0]}, {key[1]}: loaded {len(records[key])} persisted alerts")
+
+    def persist(self, bot_alert_ids: list, new_alerts: dict, start_date: datetime):
+        """
+        this function writes new alerts to the partition of the day they were created, deletes the pairs' alerts from partitions outside of the lookback window
+        (removing partitions that become empty) and writes the cursors; the cursors are written last, so a crash in between at most refetches alerts
+        """
+        start_day = datetime.strftime(start_date, "%Y-%m-%d")
+        rows = {}  # day -> list of (hash, bot_id, alert_id, alert)
+        for (bot_id, alert_id) in bot_alert_ids:
+            for alert in new_alerts[(bot_id, alert_id)].to_dict("records"):
+                day = str(alert["createdAt"])[:10]
+                if day >= start_day:
+                    rows.setdefault(day, []).append((alert["hash"], bot_id, alert_id, json.dumps(alert, default=str)))
+
+        with self.lock:
+            for day, day_rows in rows.items():
+                with closing(self.connect(day)) as connection, connection:
+                    connection.executemany("INSERT OR REPLACE INTO alerts (hash, bot_id, alert_id, alert) VALUES (?, ?, ?, ?)", day_rows)
+
+            for day in self.partition_days():
+                if day >= start_day:
+                    break
+                keys = [(bot_id, alert_id) for bot_id, alert_id in bot_alert_ids if (day, bot_id, alert_id) not in self.evicted]
+                if len(keys) == 0:
+                    continue
+                with closing(self.connect(day)) as connection:
+                    with connection:
+                        connection.executemany("DELETE FROM alerts WHERE bot_id = ? AND alert_id = ?", keys)
+                    remaining = connection.execute("SELECT COUNT(*) FROM alerts").fetchone()[0]
+                if remaining == 0:
+                    os.remove(self.partition_path(day))
+                    logging.info(f"Alert store: removed partition {day}")
+                self.evicted.update((day, bot_id, alert_id) for bot_id, alert_id in keys)
+
+            self.persist_cursors()
+
+    def load_cursors(self) -> dict:
+        cursors_path = os.path.join(self.path, "cursors.json")
+        if not os.path.exists(cursors_path):
+            return {}
+        with open(cursors_path) as cursors_file:
+            return {tuple(tuple(key) for key in entry["bot_alert_ids"]): entry["cursor"] for entry in json.load(cursors_file)}
+
+    def persist_cursors(self):
+        cursors_path = os.path.join(self.path, "cursors.json")
+        with open(cursors_path + ".tmp", "w") as cursors_file:
+            json.dump([{"bot_alert_ids": list(batch_key), "cursor": cursor} for batch_key, cursor in list(self.cursors.items())], cursors_file)
+        os.replace(cursors_path + ".tmp", cursors_path)
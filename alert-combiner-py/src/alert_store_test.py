@@ -0,0 +1,153 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+
+from alert_store import AlertStore
+
+
+class PagedFortaExplorerMock:
+    def __init__(self, pages: list):
+        self.pages = pages
+        self.cursors = []
+
+    def alerts_by_bots_after(self, bot_alert_ids: list, chain_id: int, start_date: datetime, end_date: datetime, cursor: dict, fields: list = None) -> tuple:
+        self.cursors.append(cursor)
+        if len(self.pages) == 0:
+            return {key: pd.DataFrame(columns=['createdAt', 'hash']) for key in bot_alert_ids}, cursor
+        df = self.pages.pop(0)
+        alerts = {key: df[df["alertId"] == key[1]] if "alertId" in df.columns else df for key in bot_alert_ids}
+        return alerts, {"blockNumber": len(self.cursors), "alertId": bot_alert_ids[-1][1]}
+
+    def alerts_by_bots_from_pages(self, bot_alert_ids: list, pages, fields: list = None, cursor: dict = None) -> tuple:
+        alerts = [alert for page_alerts, _ in pages for alert in page_alerts]
+        return {key: pd.DataFrame([[alert["createdAt"], alert["hash"]] for alert in alerts if alert["alertId"] == key[1]], columns=['createdAt', 'hash']) for key in bot_alert_ids}, cursor
+
+
+class KeyedFortaExplorerMock:
+    def alerts_by_bots_after(self, bot_alert_ids: list, chain_id: int, start_date: datetime, end_date: datetime, cursor: dict, fields: list = None) -> tuple:
+        return {key: pd.DataFrame([["2022-04-30T10:00:00Z", f"0x{key[1]}"]], columns=['createdAt', 'hash']) for key in bot_alert_ids}, {"blockNumber": 1, "alertId": bot_alert_ids[-1][1]}
+
+
+def pushed_alert(created_at: str, alert_hash: str, alert_id: str = "ALERT") -> dict:
+    return {"createdAt": created_at, "hash": alert_hash, "alertId": alert_id, "source": {"bot": {"id": "bot"}}}
+
+
+class TestAlertStore:
+    def test_refresh_resumes_from_cursor(self):
+        explorer = PagedFortaExplorerMock([pd.DataFrame([["2022-04-30T10:00:00Z", "0x1"]], columns=['createdAt', 'hash']),
+                                           pd.DataFrame([["2022-04-30T11:00:00Z", "0x2"]], columns=['createdAt', 'hash'])])
+        store = AlertStore()
+        start_date = datetime(2022, 4, 29)
+        end_date = datetime(2022, 4, 30)
+
+        store.refresh(explorer, "bot", "ALERT", 1, start_date, end_date)
+        df = store.refresh(explorer, "bot", "ALERT", 1, start_date, end_date)
+
+        assert explorer.cursors == [None, {"blockNumber": 1, "alertId": "ALERT"}], "second refresh should resume from the first end cursor"
+        assert len(df) == 2, "alerts of both refreshes should be held"
+
+    def test_refresh_keeps_cursor_without_new_alerts(self):
+        explorer = PagedFortaExplorerMock([pd.DataFrame([["2022-04-30T10:00:00Z", "0x1"]], columns=['createdAt', 'hash'])])
+        store = AlertStore()
+        start_date = datetime(2022, 4, 29)
+        end_date = datetime(2022, 4, 30)
+
+        store.refresh(explorer, "bot", "ALERT", 1, start_date, end_date)
+        store.refresh(explorer, "bot", "ALERT", 1, start_date, end_date)
+        df = store.refresh(explorer, "bot", "ALERT", 1, start_date, end_date)
+
+        assert explorer.cursors[2] == {"blockNumber": 1, "alertId": "ALERT"}, "cursor should not be reset by an empty refresh"
+        assert len(df) == 1, "stored alert should still be held"
+
+    def test_refresh_deduplicates_by_hash(self):
+        explorer = PagedFortaExplorerMock([pd.DataFrame([["2022-04-30T10:00:00Z", "0x1"]], columns=['createdAt', 'hash']),
+                                           pd.DataFrame([["2022-04-30T10:00:00Z", "0x1"]], columns=['createdAt', 'hash'])])
+        store = AlertStore()
+        start_date = datetime(2022, 4, 29)
+        end_date = datetime(2022, 4, 30)
+
+        store.refresh(explorer, "bot", "ALERT", 1, start_date, end_date)
+        df = store.refresh(explorer, "bot", "ALERT", 1, start_date, end_date)
+
+        assert len(df) == 1, "alert returned twice should only be stored once"
+
+    def test_refresh_evicts_old_alerts(self):
+        explorer = PagedFortaExplorerMock([pd.DataFrame([["2022-04-28T23:59:59Z", "0x1"], ["2022-04-29T00:00:00Z", "0x2"]], columns=['createdAt', 'hash'])])
+        store = AlertStore()
+
+        store.refresh(explorer, "bot", "ALERT", 1, datetime(2022, 4, 28), datetime(2022, 4, 29))
+        df = store.refresh(explorer, "bot", "ALERT", 1, datetime(2022, 4, 29, 12), datetime(2022, 4, 30))
+
+        assert df["hash"].tolist() == ["0x2"], "alert from before the lookback window should have been evicted"
+
+    def test_evict_parsed_alerts(self):
+        df_alerts = pd.DataFrame({"createdAt": pd.to_datetime(["2022-04-28T23:59:59Z", "2022-04-29T00:00:00Z"], utc=True), "hash": ["0x1", "0x2"]})
+
+        assert AlertStore.evict(df_alerts, datetime(2022, 4, 29, 12))["hash"].tolist() == ["0x2"], "alerts created before the day of the start date should be evicted"
+
+    def test_refresh_batch_shares_cursor_and_splits_alerts(self):
+        explorer = PagedFortaExplorerMock([pd.DataFrame([["2022-04-30T10:00:00Z", "0x1", "ALERT-1"], ["2022-04-30T10:00:00Z", "0x2", "ALERT-2"]], columns=['createdAt', 'hash', 'alertId']),
+                                           pd.DataFrame([["2022-04-30T11:00:00Z", "0x3", "ALERT-2"]], columns=['createdAt', 'hash', 'alertId'])])
+        store = AlertStore()
+        start_date = datetime(2022, 4, 29)
+        end_date = datetime(2022, 4, 30)
+        bot_alert_ids = [("bot1", "ALERT-1"), ("bot2", "ALERT-2")]
+
+        store.refresh_batch(explorer, bot_alert_ids, 1, start_date, end_date)
+        alerts = store.refresh_batch(explorer, bot_alert_ids, 1, start_date, end_date)
+
+        assert explorer.cursors == [None, {"blockNumber": 1, "alertId": "ALERT-2"}], "batch should resume from its shared end cursor"
+        assert alerts[("bot1", "ALERT-1")]["hash"].tolist() == ["0x1"], "alerts should be split per bot/ alert id"
+        assert alerts[("bot2", "ALERT-2")]["hash"].tolist() == ["0x2", "0x3"], "alerts should be split per bot/ alert id"
+
+    def test_persisted_store_resumes_after_restart(self, tmp_path):
+        explorer = PagedFortaExplorerMock([pd.DataFrame([["2022-04-29T10:00:00Z", "0x1"], ["2022-04-30T10:00:00Z", "0x2"]], columns=['createdAt', 'hash'])])
+        start_date = datetime(2022, 4, 29)
+        end_date = datetime(2022, 4, 30)
+
+        AlertStore(str(tmp_path)).refresh(explorer, "bot", "ALERT", 1, start_date, end_date)
+        df = AlertStore(str(tmp_path)).refresh(explorer, "bot", "ALERT", 1, start_date, end_date)
+
+        assert explorer.cursors == [None, {"blockNumber": 1, "alertId": "ALERT"}], "restarted store should resume from the persisted end cursor"
+        assert df["hash"].tolist() == ["0x1", "0x2"], "restarted store should load the persisted alerts"
+        assert sorted(path.name for path in tmp_path.glob("alerts-*.sqlite")) == ["alerts-2022-04-29.sqlite", "alerts-2022-04-30.sqlite"], "alerts should be partitioned by day"
+        assert df["createdAt"].tolist() == [pd.Timestamp("2022-04-29T10:00:00Z"), pd.Timestamp("2022-04-30T10:00:00Z")], "createdAt of the persisted alerts should be parsed on load"
+
+    def test_persisted_store_removes_partitions_outside_of_window(self, tmp_path):
+        explorer = PagedFortaExplorerMock([pd.DataFrame([["2022-04-28T10:00:00Z", "0x1"], ["2022-04-29T10:00:00Z", "0x2"]], columns=['createdAt', 'hash'])])
+
+        store = AlertStore(str(tmp_path))
+        store.refresh(explorer, "bot", "ALERT", 1, datetime(2022, 4, 28), datetime(2022, 4, 29))
+        store.refresh(explorer, "bot", "ALERT", 1, datetime(2022, 4, 29), datetime(2022, 4, 30))
+        df = AlertStore(str(tmp_path)).refresh(explorer, "bot", "ALERT", 1, datetime(2022, 4, 28), datetime(2022, 4, 30))
+
+        assert [path.name for path in tmp_path.glob("alerts-*.sqlite")] == ["alerts-2022-04-29.sqlite"], "partition outside of the lookback window should have been removed"
+        assert df["hash"].tolist() == ["0x2"], "evicted alert should not be loaded again"
+
+    def test_refresh_merges_pushed_alerts_after_backfill(self):
+        explorer = PagedFortaExplorerMock([pd.DataFrame([["2022-04-30T10:00:00Z", "0x1"]], columns=['createdAt', 'hash']),
+                                           pd.DataFrame([["2022-04-30T11:00:00Z", "0x9"]], columns=['createdAt', 'hash'])])
+        store = AlertStore(push_alerts=True)
+        start_date = datetime(2022, 4, 29)
+        end_date = datetime(2022, 4, 30)
+
+        store.push(pushed_alert("2022-04-30T10:00:00Z", "0x1"))
+        store.refresh(explorer, "bot", "ALERT", 1, start_date, end_date)
+        store.push(pushed_alert("2022-04-30T11:00:00Z", "0x2"))
+        store.push(pushed_alert("2022-04-30T11:00:00Z", "0x3", "OTHER-ALERT"))
+        df = store.refresh(explorer, "bot", "ALERT", 1, start_date, end_date)
+
+        assert explorer.cursors == [None], "api should only be queried to backfill the window"
+        assert df["hash"].tolist() == ["0x1", "0x2"], "pushed alerts should be merged and deduplicated with the backfilled ones"
+        assert store.pushed == {("bot", "OTHER-ALERT"): [pushed_alert("2022-04-30T11:00:00Z", "0x3", "OTHER-ALERT")]}, "alerts of other bot/ alert ids should stay buffered"
+
+    def test_refresh_batches_concurrently(self, tmp_path):
+        store = AlertStore(str(tmp_path))
+        batches = [[("bot", f"ALERT-{number}")] for number in range(50)]
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda batch: store.refresh_batch(KeyedFortaExplorerMock(), batch, 1, datetime(2022, 4, 29), datetime(2022, 4, 30)), batches))
+
+        assert len(store.alerts) == 50 and len(store.cursors) == 50, "alerts and cursors of all concurrently refreshed batches should be stored"
+        assert len(AlertStore(str(tmp_path)).load_cursors()) == 50, "cursors of all batches should be persisted"
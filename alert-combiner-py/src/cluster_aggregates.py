@@ -0,0 +1,148 @@
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.address_clusters import AddressClusters
+
+
+class ClusterAggregates:
+    """
+    per-cluster aggregates of the alerts in the window: the hashes of the cluster's alerts per alert id, a bitmask of the stages they cover and counts of the clusters involved in them
+    the aggregates are maintained incrementally: alerts are added when they enter the window, removed when they leave it and recounted when clusters merge
+    clusters whose aggregate changed since they were last evaluated are tracked, so a detection cycle only needs to re-evaluate those;
+    candidates are re-evaluated after recheck_ttl_seconds regardless, as their outcome also depends on state outside the aggregate (transaction counts, alerted clusters)
+    """
+
+    def __init__(self, base_bots: list, recheck_ttl_seconds: float = float("inf")):
+        self.recheck_ttl_seconds = recheck_ttl_seconds
+        self.alert_id_stage_mapping = {alert_id: stage for bot_id, alert_id, stage in base_bots}
+        self.stage_bits = {stage: 1 << position for position, stage in enumerate(dict.fromkeys(stage for bot_id, alert_id, stage in base_bots))}
+        self.reset()
+
+    def reset(self):
+        """
+        this function removes all aggregates
+        """
+        self.alerts = {}  # alert hash -> (alert id, tuple of the cluster identifiers of the alert) as counted
+        self.alert_hashes = {}  # cluster identifier -> dict alert id -> set of hashes of the cluster's alerts
+        self.stages = {}  # cluster identifier -> bitmask of the stages of the cluster's alerts
+        self.involved_clusters = {}  # cluster identifier -> dict involved cluster identifier -> number of the cluster's stage alerts that involve it
+        self.candidate_rules = {}  # cluster identifier -> alert ids of the rules the cluster was a candidate for in the previous cycle
+        self.changed = set()  # cluster identifiers whose aggregate changed since they were last evaluated
+        self.evaluated_at = {}  # cluster identifier -> timestamp the candidate was last evaluated
+
+    def __len__(self) -> int:
+        return len(self.alert_hashes)
+
+    def update(self, df_forta_alerts: pd.DataFrame, address_clusters: AddressClusters):
+        """
+        this function adds the alerts that entered the window, removes the ones that left it and recounts the alerts that involve addresses whose cluster changed
+        all aggregates are rebuilt if the address clusters were rebuilt
+        """
+        if address_clusters.rebuilt:
+            logging.info("Rebuilding cluster aggregates as the address clusters were rebuilt")
+            self.reset()
+
+        hashes = df_forta_alerts["hash"]
+        for alert_hash in self.alerts.keys() - set(hashes):
+            self.remove(alert_hash)
+
+        recount = ~hashes.isin(self.alerts.keys()).to_numpy()
+        if len(address_clusters.changed_addresses) > 0:
+            changed_codes = [address_clusters.cluster_code(address) for address in address_clusters.changed_addresses]
+            exploded_cluster_codes = df_forta_alerts["cluster_codes"].explode()
+            recount[np.unique(exploded_cluster_codes.index[exploded_cluster_codes.isin(changed_codes)].to_numpy(dtype=np.int64))] = True
+
+        added = 0
+        for alert_hash, alert_id, cluster_codes in zip(hashes[recount], df_forta_alerts["alertId"][recount], df_forta_alerts["cluster_codes"][recount]):
+            counted = (alert_id, tuple(dict.fromkeys(address_clusters.identifier(cluster_code) for cluster_code in cluster_codes)))
+            if self.alerts.get(alert_hash) == counted:
+                continue
+            if alert_hash in self.alerts:
+                self.remove(alert_hash)
+            self.add(alert_hash, *counted)
+            added += 1
+        logging.info(f"Updated cluster aggregates with {added} alerts; {len(self.changed)} of {len(self)} clusters changed")
+
+    def add(self, alert_hash: str, alert_id: str, cluster_identifiers: tuple):
+        """
+        this function counts the alert in the aggregates of all its clusters
+        """
+        self.alerts[alert_hash] = (alert_id, cluster_identifiers)
+        stage = self.alert_id_stage_mapping.get(alert_id)
+        for cluster_identifier in cluster_identifiers:
+            alert_hashes = self.alert_hashes.setdefault(cluster_identifier, {})
+            alert_hashes.setdefault(alert_id, set()).add(alert_hash)
+            if stage is not None:
+                self.stages[cluster_identifier] = self.stages.get(cluster_identifier, 0) | self.stage_bits[stage]
+                involved_clusters = self.involved_clusters.setdefault(cluster_identifier, {})
+                for involved_cluster in cluster_identifiers:
+                    involved_clusters[involved_cluster] = involved_clusters.get(involved_cluster, 0) + 1
+            self.changed.add(cluster_identifier)
+
+    def remove(self, alert_hash: str):
+        """
+        this function removes the alert from the aggregates of all clusters it was counted in
+        """
+        alert_id, cluster_identifiers = self.alerts.pop(alert_hash)
+        stage = self.alert_id_stage_mapping.get(alert_id)
+        for cluster_identifier in cluster_identifiers:
+            alert_hashes = self.alert_hashes[cluster_identifier]
+            alert_hashes[alert_id].discard(alert_hash)
+            if len(alert_hashes[alert_id]) == 0:
+                del alert_hashes[alert_id]
+            if stage is not None:
+                involved_clusters = self.involved_clusters[cluster_identifier]
+                for involved_cluster in cluster_identifiers:
+                    involved_clusters[involved_cluster] -= 1
+                    if involved_clusters[involved_cluster] == 0:
+                        del involved_clusters[involved_cluster]
+                self.stages[cluster_identifier] = self.stage_mask(alert_hashes)
+            if len(alert_hashes) == 0:
+                del self.alert_hashes[cluster_identifier]
+                self.stages.pop(cluster_identifier, None)
+                self.involved_clusters.pop(cluster_identifier, None)
+            self.changed.add(cluster_identifier)
+
+    def stage_mask(self, alert_hashes: dict) -> int:
+        stage_mask = 0
+        for alert_id in alert_hashes.keys():
+            if alert_id in self.alert_id_stage_mapping:
+                stage_mask |= self.stage_bits[self.alert_id_stage_mapping[alert_id]]
+        return stage_mask
+
+    def aggregate(self, cluster_identifier: str) -> dict:
+        """
+        this function returns the aggregate of the cluster's alerts; involved alert ids are ordered by the smallest hash of their alerts, i.e. in the row order of the hash sorted alerts
+        :return: cluster_aggregate: dict with keys stages, alert_ids, involved_alert_ids, involved_clusters (cluster identifiers), hashes
+        """
+        alert_hashes = self.alert_hashes.get(cluster_identifier, {})
+        stage_mask = self.stages.get(cluster_identifier, 0)
+        stage_alert_hashes = [hashes for alert_id, hashes in alert_hashes.items() if alert_id in self.alert_id_stage_mapping]
+        return {"stages": {stage for stage, stage_bit in self.stage_bits.items() if stage_mask & stage_bit},
+                "alert_ids": {alert_id for alert_id in alert_hashes.keys() if alert_id in self.alert_id_stage_mapping},
+                "involved_alert_ids": sorted(alert_hashes.keys(), key=lambda alert_id: min(alert_hashes[alert_id])),
+                "involved_clusters": set(self.involved_clusters.get(cluster_identifier, {}).keys()),
+                "hashes": set().union(*stage_alert_hashes)}
+
+    def changed_candidates(self, candidate_rules: dict, now: float = None) -> set:
+        """
+        this function returns the candidate clusters that need to be evaluated: candidates whose aggregate changed, that became a candidate of other rules since the previous cycle
+        or that were last evaluated recheck_ttl_seconds ago
+        clusters that aren't candidates are considered evaluated; the returned clusters stay changed until they are marked as evaluated
+        :return: changed_candidates: set of cluster identifiers
+        """
+        now = time.time() if now is None else now
+        changed_candidates = {cluster_identifier for cluster_identifier, rule_alert_ids in candidate_rules.items()
+                              if cluster_identifier in self.changed or self.candidate_rules.get(cluster_identifier) != rule_alert_ids
+                              or now - self.evaluated_at.get(cluster_identifier, now) >= self.recheck_ttl_seconds}
+        self.candidate_rules = candidate_rules
+        self.changed = set(changed_candidates)
+        self.evaluated_at = {cluster_identifier: evaluated_at for cluster_identifier, evaluated_at in self.evaluated_at.items() if cluster_identifier in candidate_rules}
+        return changed_candidates
+
+    def evaluated(self, cluster_identifier: str, now: float = None):
+        self.changed.discard(cluster_identifier)
+        self.evaluated_at[cluster_identifier] = time.time() if now is None else now
@@ -0,0 +1,88 @@
+import pandas as pd
+
+from address_clusters import AddressClusters
+from cluster_aggregates import ClusterAggregates
+
+BASE_BOTS = [("0xbot1", "FUNDING", "Funding"), ("0xbot2", "PREPARATION", "Preparation"), ("0xbot3", "EXPLOITATION", "Exploitation")]
+
+
+def cluster_alerts(rows: list) -> pd.DataFrame:
+    return pd.DataFrame([[alert_hash, {"entityAddresses": entity_addresses}] for alert_hash, entity_addresses in rows], columns=['hash', 'metadata'])
+
+
+def alerts(address_clusters: AddressClusters, rows: list) -> pd.DataFrame:
+    return pd.DataFrame([[alert_hash, alert_id, [address_clusters.cluster_code(address) for address in addresses]] for alert_hash, alert_id, addresses in rows], columns=['hash', 'alertId', 'cluster_codes'])
+
+
+class TestClusterAggregates:
+    def test_alerts_enter_and_leave_the_window(self):
+        address_clusters = AddressClusters()
+        cluster_aggregates = ClusterAggregates(BASE_BOTS)
+
+        address_clusters.update(cluster_alerts([]))
+        cluster_aggregates.update(alerts(address_clusters, [("0x2", "FUNDING", ["0xaa", "0xbb"]), ("0x1", "PREPARATION", ["0xaa"])]), address_clusters)
+        aggregate = cluster_aggregates.aggregate("0xaa")
+
+        assert aggregate["stages"] == {"Funding", "Preparation"}, "stages of both alerts should be covered"
+        assert aggregate["involved_alert_ids"] == ["PREPARATION", "FUNDING"], "involved alert ids should be ordered by their smallest hash"
+        assert aggregate["involved_clusters"] == {"0xaa", "0xbb"}, "clusters of the alerts should be involved"
+        assert aggregate["hashes"] == {"0x1", "0x2"}, "hashes of both alerts should be included"
+        assert cluster_aggregates.changed == {"0xaa", "0xbb"}, "clusters of new alerts should have changed"
+
+        address_clusters.update(cluster_alerts([]))
+        cluster_aggregates.changed_candidates({})
+        cluster_aggregates.update(alerts(address_clusters, [("0x1", "PREPARATION", ["0xaa"])]), address_clusters)
+        aggregate = cluster_aggregates.aggregate("0xaa")
+
+        assert aggregate["stages"] == {"Preparation"}, "stage of the expired alert should be removed"
+        assert aggregate["involved_clusters"] == {"0xaa"}, "clusters of the expired alert should no longer be involved"
+        assert aggregate["hashes"] == {"0x1"}, "hash of the expired alert should be removed"
+        assert "0xbb" not in cluster_aggregates.alert_hashes, "cluster without alerts should be dropped"
+        assert cluster_aggregates.changed == {"0xaa", "0xbb"}, "clusters of the expired alert should have changed"
+
+    def test_alerts_are_recounted_when_clusters_merge(self):
+        address_clusters = AddressClusters()
+        cluster_aggregates = ClusterAggregates(BASE_BOTS)
+
+        address_clusters.update(cluster_alerts([("0xe1", "0xaa,0xbb")]))
+        cluster_aggregates.update(alerts(address_clusters, [("0x1", "FUNDING", ["0xaa"]), ("0x2", "EXPLOITATION", ["0xcc"])]), address_clusters)
+        cluster_aggregates.changed_candidates({})
+
+        address_clusters.update(cluster_alerts([("0xe1", "0xaa,0xbb"), ("0xe2", "0xbb,0xcc")]))
+        cluster_aggregates.update(alerts(address_clusters, [("0x1", "FUNDING", ["0xaa"]), ("0x2", "EXPLOITATION", ["0xcc"])]), address_clusters)
+
+        assert cluster_aggregates.aggregate("0xaa,0xbb,0xcc")["stages"] == {"Funding", "Exploitation"}, "alerts of the merged clusters should be counted in the merged cluster"
+        assert cluster_aggregates.aggregate("0xaa,0xbb")["stages"] == set(), "alerts should no longer be counted in the clusters that were merged"
+        assert cluster_aggregates.changed == {"0xaa,0xbb", "0xcc", "0xaa,0xbb,0xcc"}, "merged clusters should have changed"
+
+    def test_changed_candidates(self):
+        address_clusters = AddressClusters()
+        cluster_aggregates = ClusterAggregates(BASE_BOTS)
+
+        address_clusters.update(cluster_alerts([]))
+        cluster_aggregates.update(alerts(address_clusters, [("0x1", "FUNDING", ["0xaa"]), ("0x2", "FUNDING", ["0xbb"])]), address_clusters)
+        assert cluster_aggregates.changed_candidates({"0xaa": frozenset(["RULE-1"])}) == {"0xaa"}, "changed candidate should be evaluated"
+        assert cluster_aggregates.changed == {"0xaa"}, "changes of clusters that aren't candidates should be dropped"
+
+        cluster_aggregates.evaluated("0xaa")
+        address_clusters.update(cluster_alerts([]))
+        cluster_aggregates.update(alerts(address_clusters, [("0x1", "FUNDING", ["0xaa"]), ("0x2", "FUNDING", ["0xbb"])]), address_clusters)
+        assert cluster_aggregates.changed_candidates({"0xaa": frozenset(["RULE-1"])}) == set(), "unchanged candidate should not be evaluated again"
+        assert cluster_aggregates.changed_candidates({"0xaa": frozenset(["RULE-1", "RULE-2"])}) == {"0xaa"}, "candidate of another rule should be evaluated"
+        assert cluster_aggregates.changed_candidates({"0xaa": frozenset(["RULE-1", "RULE-2"])}) == {"0xaa"}, "candidate should be evaluated until it is marked as evaluated"
+
+    def test_candidates_are_rechecked_after_ttl(self):
+        address_clusters = AddressClusters()
+        cluster_aggregates = ClusterAggregates(BASE_BOTS, 60)
+
+        address_clusters.update(cluster_alerts([]))
+        cluster_aggregates.update(alerts(address_clusters, [("0x1", "FUNDING", ["0xaa"])]), address_clusters)
+        assert cluster_aggregates.changed_candidates({"0xaa": frozenset(["RULE-1"])}, 1000.0) == {"0xaa"}, "changed candidate should be evaluated"
+        cluster_aggregates.evaluated("0xaa", 1000.0)
+
+        assert cluster_aggregates.changed_candidates({"0xaa": frozenset(["RULE-1"])}, 1059.0) == set(), "unchanged candidate should not be evaluated again within the ttl"
+        assert cluster_aggregates.changed_candidates({"0xaa": frozenset(["RULE-1"])}, 1060.0) == {"0xaa"}, "unchanged candidate should be evaluated again after the ttl"
+        cluster_aggregates.evaluated("0xaa", 1060.0)
+
+        cluster_aggregates.changed_candidates({}, 1070.0)
+        assert cluster_aggregates.evaluated_at == {}, "evaluation times of clusters that are no longer candidates should be dropped"
@@ -1,6 +1,27 @@
 DATE_LOOKBACK_WINDOW_IN_DAYS = 1
 ADDRESS_QUEUE_SIZE = 10000
 
+FORTA_EXPLORER_MAX_WORKERS = 10  # max number of queries that are fetched concurrently; 1 fetches them one after another
+FORTA_EXPLORER_BATCH_SIZE = 10  # max number of (bot_id, alert_id) pairs fetched with a single query
+BASE_BOT_ALERT_FIELDS = ["severity", "metadata", "alertId", "description", "addresses", "hash"]  # alert fields requested for the base bots; the fields needed to split, evict and deduplicate alerts are always requested
+ENTITY_CLUSTER_BOT_ALERT_FIELDS = ["metadata", "hash"]  # alert fields requested for the entity cluster bot
+CATEGORICAL_ALERT_FIELDS = ["severity", "alertId", "bot_id"]  # low cardinality alert fields held as pandas categoricals rather than one string object per alert
+ADDRESS_ALERT_FIELDS = ["addresses"]  # alert fields with lists of addresses held as interned lower case strings
+
+PUSH_ALERTS = False  # base bot and entity cluster alerts are pushed to handle_alert through alert subscriptions; the API is then only queried to backfill the lookback window on startup
+
+DETECTION_DEADLINE_IN_SECONDS = 300  # a detection run stops evaluating further candidates once it exceeds the deadline
+DETECTION_QUEUE_SIZE = 10  # max number of pending blocks; the scheduler only runs the latest of them
+
+ALERT_STORE_PATH = "./alert_store"  # folder the alert store persists its daily partitions and cursors to, so a restart doesn't re-download the lookback window
+METRICS_PORT = 9102  # port the detection metrics are served on at /metrics in the Prometheus text format; 0 disables the endpoint
+
+RPC_BATCH_SIZE = 100  # max number of calls sent with a single JSON-RPC batch request
+RPC_CODE_CACHE_TTL_IN_SECONDS = 6 * 60 * 60  # bytecode is cached across cycles
+RPC_TX_COUNT_CACHE_TTL_IN_SECONDS = 60 * 60  # transaction counts up to TX_COUNT_FILTER_THRESHOLD are refetched after this ttl
+RPC_LARGE_TX_COUNT_CACHE_TTL_IN_SECONDS = 7 * 24 * 60 * 60  # transaction counts above TX_COUNT_FILTER_THRESHOLD only increase, so they are kept longer; they still expire to bound the cache
+RPC_CACHE_MAX_SIZE = 100_000  # max number of addresses whose bytecode and transaction counts are kept across cycles; the entries closest to expiry are dropped first
+
 TX_COUNT_FILTER_THRESHOLD = 500  # ignore EOAs with tx count larger than this threshold to mitigate FPs
 
 SCAM_DETECTOR = True
@@ -103,4 +124,31 @@ BASE_BOTS = [("0x8badbf2ad65abc3df5b1d9cc388e419d9255ef999fb69aac6bf395646cf01c1
            ("0xdba64bc69511d102162914ef52441275e651f817e297276966be16aeffe013b0", "UMBRA-SEND", "MoneyLaundering"),  # umbra send
            ("0xaf9ac4c204eabdd39e9b00f91c8383dc01ef1783e010763cad05cc39e82643bb", "LARGE-TRANSFER-OUT", "MoneyLaundering"),  # large native transfer out           
            ("0x2df302b07030b5ff8a17c91f36b08f9e2b1e54853094e2513f7cda734cf68a46", "MALICIOUS-ACCOUNT-FUNDING", "Funding")  # Malicious Account Funding
-        ]
\ No newline at end of file
+        ]
+
+# combiners evaluated by detect_attack in one pass over the alerts of each candidate cluster; each combiner is a rule:
+#   detector: name of the constant above that enables the rule
+#   candidate_sources: (alert_id, bot_id, severity, field, start) of the alerts the potential attacker addresses are taken from; bot_id/ severity None match any;
+#                      field "description" takes the address at description[start:start + 42], field "cluster_identifiers" takes all cluster identifiers of the alert
+#   candidate_filters: "eoa" skips contracts and unlikely addresses, "no_null_address" skips the null address
+#   alert_filter: "ice_phishing" only counts alerts that contain the candidate according to ice_phishing_mappings.csv; None counts all alerts of the candidate
+#   min_stages, required_stages, alert_id_groups: the rule fires if the alerts of the candidate cover min_stages stages, include all required_stages
+#                      and (if any groups are given) all alert ids of at least one of the alert_id_groups
+ICE_PHISHING_ALERT_IDS = ["ICE-PHISHING-HIGH-NUM-APPROVED-TRANSFERS", "ICE-PHISHING-PERMITTED-ERC20-TRANSFER", "ICE-PHISHING-HIGH-NUM-ERC20-APPROVALS", "ICE-PHISHING-HIGH-NUM-ERC721-APPROVALS",
+                          "ICE-PHISHING-ERC20-APPROVAL-FOR-ALL", "ICE-PHISHING-ERC721-APPROVAL-FOR-ALL", "ICE-PHISHING-ERC1155-APPROVAL-FOR-ALL"]
+
+COMBINER_RULES = [{"alert_id": "ATTACK-DETECTOR-1", "detector": "ATTACK_DETECTOR",  # 4 stages; only money laundering candidates as this is required to fullfill all 4 stages
+                   "candidate_sources": [("forta-text-messages-possible-hack", None, "HIGH", "cluster_identifiers", None),
+                                         ("POSSIBLE-MONEY-LAUNDERING-TORNADO-CASH", None, None, "description", 0)],  # the money laundering TC bot transaction may not be the transaction that contains the TC transfer, so the address is parsed from the description
+                   "candidate_filters": ["eoa"], "alert_filter": None, "min_stages": 4, "required_stages": [], "alert_id_groups": []},
+                  {"alert_id": "ATTACK-DETECTOR-2", "detector": "ATTACK_DETECTOR",  # attack simulation/ suspicious contract creation and funding
+                   "candidate_sources": [("AK-ATTACK-SIMULATION-0", None, None, "description", 62),  # "Invocation of the function 0x53000000 of the created contract 0xfd0000000100069ad1670066004306009b487ad7 "
+                                         ("SUSPICIOUS-CONTRACT-CREATION", "0x0b241032ca430d9c02eaa6a52d217bbff046f0d1b3f3d2aa928e42a97150ec91", None, "description", 0)],
+                   "candidate_filters": ["eoa"], "alert_filter": None, "min_stages": 0, "required_stages": ["Funding"], "alert_id_groups": []},
+                  {"alert_id": "ATTACK-DETECTOR-ICE-PHISHING", "detector": "SCAM_DETECTOR",  # ice phishing and funding/ sleep minting/ contract creation/ malicious address
+                   "candidate_sources": [(alert_id, None, None, "description", 0) for alert_id in ICE_PHISHING_ALERT_IDS],
+                   "candidate_filters": ["no_null_address"], "alert_filter": "ice_phishing", "min_stages": 0, "required_stages": [],
+                   "alert_id_groups": [["SLEEPMINT-1"], ["SLEEPMINT-2"],
+                                       ["FUNDING-TORNADO-CASH"], ["TORNADO-CASH-FUNDED-ACCOUNT-INTERACTION"], ["POSSIBLE-MONEY-LAUNDERING-TORNADO-CASH"], ["MALICIOUS-ACCOUNT-FUNDING"],
+                                       ["UNVERIFIED-CODE-CONTRACT-CREATION", "FLASHBOT-TRANSACTION"],
+                                       ["AE-MALICIOUS-ADDR"], ["forta-text-messages-possible-hack"]]}]
@@ -1,25 +1,206 @@
+import gc
 import json
 import logging
+import sys
 import time
+from contextlib import contextmanager
 from datetime import datetime
 
+import forta_agent.alert
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson  # optional; pages are decoded several times faster than with json
+except ImportError:
+    orjson = None
+
+ALERT_FIELDS = {  # GraphQL selection of each alert field; alerts are requested with the selection of the requested fields only
+    "createdAt": "createdAt",
+    "name": "name",
+    "protocol": "protocol",
+    "findingType": "findingType",
+    "source": """source {
+                            transactionHash
+                            block {
+                            number
+                            chainId
+                            }
+                            bot {
+                            id
+                            }
+                        }""",
+    "severity": "severity",
+    "metadata": "metadata",
+    "alertId": "alertId",
+    "description": "description",
+    "addresses": "addresses",
+    "contracts": """contracts {
+                            address
+                            name
+                            projectId
+                        }""",
+    "hash": "hash"}
+REQUIRED_FIELDS = ["createdAt", "source", "alertId", "hash"]  # always requested to split the alerts per bot/ alert id, evict and deduplicate them
+ADDRESS_FIELDS = ["addresses"]  # lists of addresses that are lower cased and interned while the alerts are collected
+
+
+class InternedAddresses(dict):
+    """
+    address as returned by the API -> interned lower case address; an address is lower cased and interned on its first lookup
+    """
+
+    def __missing__(self, address: str) -> str:
+        interned_address = self[address] = sys.intern(address.lower())
+        return interned_address
 
 
 class FortaExplorer:
 
-    def empty_alerts(self) -> pd.DataFrame:
-        df_forta = pd.DataFrame(columns=['createdAt', 'name', 'protocol', 'findingType', 'source', 'severity', 'metadata', 'alertId', 'description', 'addresses', 'contracts', 'hash', 'transactionHash', 'bot_id'])
+    def __init__(self, pool_size: int = 10):
+        # one keep-alive session shared by all queries; the pool size bounds the number of concurrent connections
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+
+    def empty_alerts(self, fields: list = None) -> pd.DataFrame:
+        df_forta = pd.DataFrame(columns=FortaExplorer.columns(fields))
         return df_forta
 
-    def alerts_by_bot(self, bot_id: str, alert_id: str, chain_id: int, start_date: datetime, end_date: datetime) -> pd.DataFrame:
+    @staticmethod
+    def columns(fields: list = None) -> list:
+        """
+        this function returns the columns of the alerts fetched with the given fields: the requested and required fields in query order followed by transactionHash and bot_id; source is only kept if requested
+        :return: columns: list
+        """
+        if fields is None:
+            return list(ALERT_FIELDS.keys()) + ['transactionHash', 'bot_id']
+        return [field for field in ALERT_FIELDS.keys() if field in fields or (field in REQUIRED_FIELDS and field != "source")] + ['transactionHash', 'bot_id']
+
+    def alerts_by_bot(self, bot_id: str, alert_id: str, chain_id: int, start_date: datetime, end_date: datetime, fields: list = None) -> pd.DataFrame:
+        df_forta, _ = self.alerts_by_bot_after(bot_id, alert_id, chain_id, start_date, end_date, None, fields)
+        return df_forta
+
+    def alerts_by_bot_after(self, bot_id: str, alert_id: str, chain_id: int, start_date: datetime, end_date: datetime, cursor: dict, fields: list = None) -> tuple:
+        """
+        this function returns the alerts of the given bot/ alert id that were raised after the given endCursor (or all alerts in the date range if cursor is None)
+        alerts are requested in ascending block order, so the endCursor of the last page can be passed in on the next call to only fetch new alerts
+        :return: (df_forta: pd.DataFrame, end_cursor: dict) - end_cursor is the cursor passed in if no new alerts were fetched
+        """
+        alerts, end_cursor = self.alerts_by_bots_after([(bot_id, alert_id)], chain_id, start_date, end_date, cursor, fields)
+        return alerts[(bot_id, alert_id)], end_cursor
+
+    def alerts_by_bots_after(self, bot_alert_ids: list, chain_id: int, start_date: datetime, end_date: datetime, cursor: dict, fields: list = None) -> tuple:
+        """
+        this function fetches the alerts of many (bot_id, alert_id) pairs with a single paginated query (one shared cursor) and splits them back out per pair
+        only the given fields (and the fields required to split the alerts) are requested; None requests all fields
+        :return: (alerts: dict (bot_id, alert_id) -> pd.DataFrame with FortaExplorer.columns(fields), end_cursor: dict) - end_cursor is the cursor passed in if no new alerts were fetched
+        """
+        return self.alerts_by_bots_from_pages(bot_alert_ids, self.alert_pages(bot_alert_ids, chain_id, start_date, end_date, cursor, fields), fields, cursor)
+
+    def alerts_by_bots_from_pages(self, bot_alert_ids: list, pages, fields: list = None, cursor: dict = None) -> tuple:
+        """
+        this function collects the alerts of the pages (see alert_pages) and splits them per (bot_id, alert_id) pair; alerts of other pairs are dropped
+        :return: (alerts: dict (bot_id, alert_id) -> pd.DataFrame with FortaExplorer.columns(fields), end_cursor: dict)
+        """
+        df_forta, end_cursor = FortaExplorer.collect_alerts(pages, fields, cursor)
+
+        # the query returns any combination of the requested bots and alert ids, so only keep the requested pairs
+        requested_bot_alert_ids = set(bot_alert_ids)
+        alerts = {}
+        for (bot_id, alert_id), df_bot_alerts in df_forta.groupby(["bot_id", "alertId"], sort=False):
+            if (bot_id, alert_id) in requested_bot_alert_ids:
+                alerts[(bot_id, alert_id)] = df_bot_alerts
+        for bot_alert_id in bot_alert_ids:
+            if bot_alert_id not in alerts:
+                alerts[bot_alert_id] = self.empty_alerts(fields)
+        return alerts, end_cursor
+
+    @staticmethod
+    def api_alert(alert: forta_agent.alert.Alert) -> dict:
+        """
+        this function converts an alert pushed to the bot into the alert dict returned by the API, so pushed alerts are collected like fetched ones
+        :return: alert: dict with the keys of ALERT_FIELDS
+        """
+        source = alert.source if alert.source is not None else forta_agent.alert.Source({})
+        return {"createdAt": alert.created_at,
+                "name": alert.name,
+                "protocol": alert.protocol,
+                "findingType": alert.finding_type,
+                "source": {"transactionHash": source.transaction_hash,
+                           "block": {"number": source.block.number, "chainId": source.block.chain_id} if source.block is not None else None,
+                           "bot": {"id": source.bot.id if source.bot is not None else None}},
+                "severity": alert.severity,
+                "metadata": alert.metadata,
+                "alertId": alert.alert_id,
+                "description": alert.description,
+                "addresses": alert.addresses,
+                "contracts": [{"address": contract.address, "name": contract.name, "projectId": contract.project_id} for contract in alert.contracts],
+                "hash": alert.hash}
+
+    @staticmethod
+    def collect_alerts(pages, fields: list = None, cursor: dict = None) -> tuple:
+        """
+        this function collects the alerts of the pages yielded by alert_pages into one list per column and builds the DataFrame once at the end; bot_id and transactionHash are taken from source
+        the address lists of ADDRESS_FIELDS are lower cased and interned on the way, each distinct address only once, and createdAt is parsed once into UTC timestamps
+        :return: (df_forta: pd.DataFrame with FortaExplorer.columns(fields), end_cursor: dict) - end_cursor of the last page, or the cursor passed in if there were no pages
+        """
+        columns = {column: [] for column in FortaExplorer.columns(fields)}
+        addresses = InternedAddresses()
+        end_cursor = cursor
+        for page_alerts, end_cursor in pages:
+            for column, values in columns.items():
+                if column == "bot_id":
+                    values.extend([alert["source"]["bot"]["id"] for alert in page_alerts])
+                elif column == "transactionHash":
+                    values.extend([alert["source"]["transactionHash"] for alert in page_alerts])
+                elif column in ADDRESS_FIELDS:
+                    values.extend([list(map(addresses.__getitem__, alert_addresses)) if alert_addresses is not None else None for alert_addresses in [alert.get(column) for alert in page_alerts]])
+                else:
+                    values.extend([alert.get(column) for alert in page_alerts])
+        if "createdAt" in columns:
+            columns["createdAt"] = pd.to_datetime(columns["createdAt"], utc=True)
+        return pd.DataFrame(columns, columns=list(columns.keys())), end_cursor
+
+    @staticmethod
+    def decode_page(content: bytes) -> dict:
+        """
+        this function decodes the JSON of a page with orjson if it is installed and with json otherwise
+        it is called from several fetch threads at once, so it leaves the garbage collector alone; see paused_gc
+        :return: json_data: dict
+        """
+        return orjson.loads(content) if orjson is not None else json.loads(content)
+
+    @staticmethod
+    @contextmanager
+    def paused_gc():
+        """
+        this function is a context manager that pauses the cyclic garbage collector while pages are fetched and decoded, as it would otherwise repeatedly traverse the nested alert dicts although none of them can be garbage yet
+        it must be entered once by the thread that starts the fetch threads, not by the fetch threads themselves, as the enabled state is process-wide
+        """
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            yield
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def alert_pages(self, bot_alert_ids: list, chain_id: int, start_date: datetime, end_date: datetime, cursor: dict, fields: list = None):
+        """
+        this function is a generator over the pages of the query of alerts_by_bots_after; each page is yielded as soon as it is decoded, so callers can process or aggregate the alerts without holding all pages
+        :return: yields (page_alerts: list of alert dicts as returned by the API, end_cursor: dict) - end_cursor after the page, or the previous one if the page was empty
+        """
+        selection = "\n                        ".join([selection for field, selection in ALERT_FIELDS.items() if fields is None or field in fields or field in REQUIRED_FIELDS])
+        bot_ids = list(dict.fromkeys([bot_id for bot_id, _ in bot_alert_ids]))
+        alert_ids = list(dict.fromkeys([alert_id for _, alert_id in bot_alert_ids]))
+
         url = "https://api.forta.network/graphql"
         chunk_size = 6000
 
-        df_forta = self.empty_alerts()
         json_data = ""
-        first_run = True
+        end_cursor = cursor
         count = 0
         while (json_data == "" or json_data['data']['alerts']['pageInfo']['hasNextPage']):
             query = """query exampleQuery {
@@ -27,6 +208,7 @@ class FortaExplorer:
                         input: {
                             CHUNKSIZE
                             AFTER_CLAUSE
+                            blockSortDirection: asc
                             BLOCK_RANGE_CLAUSE
                             ALERT_ID_CLAUSE
                             BOT_CLAUSE
@@ -41,47 +223,22 @@ class FortaExplorer:
                         }
                         }
                         alerts {
-                        createdAt
-                        name
-                        protocol
-                        findingType
-                        source {
-                            transactionHash
-                            block {
-                            number
-                            chainId
-                            }
-                            bot {
-                            id
-                            }
-                        }
-                        severity
-                        metadata
-                        alertId
-                        description
-                        addresses
-                        contracts {
-                            address
-                            name
-                            projectId
-                        }
-                        hash
+                        FIELDS
                         }
                     }
                     }"""
 
             after_clause = ""
-            if(first_run is False):
-                blockNumber = json_data['data']['alerts']['pageInfo']['endCursor']['blockNumber']
-                alertId = json_data['data']['alerts']['pageInfo']['endCursor']['alertId']
-                after_clause = """after: {{blockNumber:{0}, alertId:"{1}"}}""".format(blockNumber, alertId)
+            if end_cursor is not None:
+                after_clause = """after: {{blockNumber:{0}, alertId:"{1}"}}""".format(end_cursor['blockNumber'], end_cursor['alertId'])
 
             # this is a bit hacky
             query = query.replace("CHUNKSIZE", f"first: {chunk_size},")
+            query = query.replace("FIELDS", selection)
             query = query.replace("AFTER_CLAUSE", after_clause)
             query = query.replace("BLOCK_RANGE_CLAUSE", """blockDateRange: {{ startDate: "{0}", endDate: "{1}" }}""".format(datetime.strftime(start_date, "%Y-%m-%d"), datetime.strftime(end_date, "%Y-%m-%d")))
-            query = query.replace("BOT_CLAUSE", f"""bots: ["{bot_id}"]""")
-            query = query.replace("ALERT_ID_CLAUSE", f"""alertId: "{alert_id}" """)
+            query = query.replace("BOT_CLAUSE", "bots: [{0}]".format(", ".join([f'"{bot_id}"' for bot_id in bot_ids])))
+            query = query.replace("ALERT_ID_CLAUSE", "alertIds: [{0}]".format(", ".join([f'"{alert_id}"' for alert_id in alert_ids])))
             query = query.replace("CHAIN_ID_CLAUSE", f"""chainId: {chain_id} """)
 
             retries = 1
@@ -90,7 +247,7 @@ class FortaExplorer:
             while not success:
                 try:
                     count += 1
-                    r = requests.post(url, json={'query': query})
+                    r = self.session.post(url, json={'query': query})
                     if r.status_code == 200:
                         success = True
                         if chunk_size < 5000:
@@ -112,13 +269,10 @@ class FortaExplorer:
                     if retries > 30:
                         raise Exception("Unable to retrieve alerts even after repeated retries. Pls check logs")
 
-            json_data = json.loads(r.text)
-            df_data = json_data['data']['alerts']['alerts']
-            df_forta = pd.concat([pd.DataFrame(df_data), df_forta])
+            json_data = FortaExplorer.decode_page(r.content)
+            page_alerts = json_data['data']['alerts']['alerts']
+            if json_data['data']['alerts']['pageInfo']['endCursor'] is not None and len(page_alerts) > 0:
+                end_cursor = json_data['data']['alerts']['pageInfo']['endCursor']
 
-            first_run = False
             count += 1
-
-        df_forta["bot_id"] = df_forta["source"].apply(lambda x: x["bot"]["id"])
-        df_forta["transactionHash"] = df_forta["source"].apply(lambda x: x["transactionHash"])
-        return df_forta
+            yield page_alerts, end_cursor
@@ -6,14 +6,27 @@ class FortaExplorerMock:
 
     df = pd.DataFrame(columns=['createdAt', 'name', 'protocol', 'findingType', 'source', 'severity', 'metadata', 'alertId', 'description', 'addresses', 'contracts', 'hash', 'transactionHash'])
 
-    def empty_alerts(self) -> pd.DataFrame:
+    def empty_alerts(self, fields: list = None) -> pd.DataFrame:
         df_forta = pd.DataFrame(columns=['createdAt', 'name', 'protocol', 'findingType', 'source', 'severity', 'metadata', 'alertId', 'description', 'addresses', 'contracts', 'hash', 'bot_id', 'transactionHash'])
         return df_forta
 
     def alerts_by_bot(self, bot_id: str, alert_ids: set, chain_id: int, start_date: datetime, end_date: datetime, results_limit: int = 0) -> pd.DataFrame:
-        self.df["bot_id"] = self.df["source"].apply(lambda x: x["bot"]["id"])
-        self.df["transactionHash"] = self.df["source"].apply(lambda x: x["transactionHash"])
-        return self.df[self.df["bot_id"] == bot_id]
+        df = self.df.copy()
+        df["bot_id"] = df["source"].apply(lambda x: x["bot"]["id"])
+        df["transactionHash"] = df["source"].apply(lambda x: x["transactionHash"])
+        return df[df["bot_id"] == bot_id]
+
+    def alerts_by_bot_after(self, bot_id: str, alert_id: str, chain_id: int, start_date: datetime, end_date: datetime, cursor: dict, fields: list = None) -> tuple:
+        return self.alerts_by_bot(bot_id, alert_id, chain_id, start_date, end_date), cursor
+
+    def alerts_by_bots_after(self, bot_alert_ids: list, chain_id: int, start_date: datetime, end_date: datetime, cursor: dict, fields: list = None) -> tuple:
+        return {(bot_id, alert_id): self.alerts_by_bot(bot_id, alert_id, chain_id, start_date, end_date) for bot_id, alert_id in bot_alert_ids}, cursor
+
+    def alerts_by_bots_from_pages(self, bot_alert_ids: list, pages, fields: list = None, cursor: dict = None) -> tuple:
+        df = pd.DataFrame([alert for page_alerts, _ in pages for alert in page_alerts], columns=self.df.columns.drop('transactionHash', errors='ignore'))
+        df["bot_id"] = df["source"].apply(lambda x: x["bot"]["id"])
+        df["transactionHash"] = df["source"].apply(lambda x: x["transactionHash"])
+        return {(bot_id, alert_id): df[(df["bot_id"] == bot_id) & (df["alertId"] == alert_id)] for bot_id, alert_id in bot_alert_ids}, cursor
 
     def set_df(self, df_forta: pd.DataFrame):
         self.df = df_forta
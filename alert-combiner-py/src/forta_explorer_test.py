@@ -1,7 +1,48 @@
+import gc
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import forta_explorer
 from forta_explorer import FortaExplorer
 from datetime import datetime, timedelta
 
 
+class ResponseMock:
+    def __init__(self, data: dict):
+        self.status_code = 200
+        self.text = json.dumps(data)
+        self.content = self.text.encode("utf-8")
+
+
+class SessionMock:
+    def __init__(self, alerts: list):
+        self.alerts = alerts
+        self.queries = []
+
+    def post(self, url, json):
+        self.queries.append(json['query'])
+        return ResponseMock({"data": {"alerts": {"pageInfo": {"hasNextPage": False, "endCursor": {"alertId": "ALERT-2", "blockNumber": 2}}, "alerts": self.alerts}}})
+
+
+class PagedSessionMock:
+    def __init__(self, pages: list):
+        self.pages = pages
+        self.queries = []
+
+    def post(self, url, json):
+        self.queries.append(json['query'])
+        page = len(self.queries)
+        return ResponseMock({"data": {"alerts": {"pageInfo": {"hasNextPage": page < len(self.pages), "endCursor": {"alertId": "ALERT-1", "blockNumber": page}}, "alerts": self.pages[page - 1]}}})
+
+
+def alert(bot_id: str, alert_id: str, hash: str) -> dict:
+    return {"createdAt": "2022-04-30T23:55:17.284158264Z", "name": "name", "protocol": "ethereum", "findingType": "SUSPICIOUS",
+            "source": {"transactionHash": "0x1", "block": {"number": 1, "chainId": 1}, "bot": {"id": bot_id}},
+            "severity": "HIGH", "metadata": {}, "alertId": alert_id, "description": "description", "addresses": [], "contracts": [], "hash": hash}
+
+
 class TestFortaExplorer:
     def test_empty_alerts(self):
         df = FortaExplorer().empty_alerts()
@@ -16,3 +57,87 @@ class TestFortaExplorer:
 
         alerts = df["alertId"].unique()
         assert len(alerts) > 0, "no alerts returned"
+
+    def test_alerts_by_bots_after_single_query_split_per_bot(self):
+        forta_explorer = FortaExplorer()
+        forta_explorer.session = SessionMock([alert("0xbot1", "ALERT-1", "0x1"), alert("0xbot2", "ALERT-2", "0x2"), alert("0xbot1", "ALERT-2", "0x3")])
+
+        alerts, end_cursor = forta_explorer.alerts_by_bots_after([("0xbot1", "ALERT-1"), ("0xbot2", "ALERT-2"), ("0xbot3", "ALERT-3")], 1, datetime(2022, 4, 29), datetime(2022, 4, 30), None)
+
+        assert len(forta_explorer.session.queries) == 1, "all bots should be fetched with a single query"
+        assert 'bots: ["0xbot1", "0xbot2", "0xbot3"]' in forta_explorer.session.queries[0], "query should contain all bots"
+        assert alerts[("0xbot1", "ALERT-1")]["hash"].tolist() == ["0x1"], "alerts should be split per bot/ alert id"
+        assert alerts[("0xbot2", "ALERT-2")]["hash"].tolist() == ["0x2"], "alerts should be split per bot/ alert id"
+        assert len(alerts[("0xbot3", "ALERT-3")]) == 0, "bot without alerts should have an empty frame"
+        assert ("0xbot1", "ALERT-2") not in alerts, "pairs that were not requested should be dropped"
+        assert end_cursor == {"alertId": "ALERT-2", "blockNumber": 2}, "end cursor should be returned"
+
+    def test_alerts_by_bots_after_requests_only_given_fields(self):
+        forta_explorer = FortaExplorer()
+        forta_explorer.session = SessionMock([alert("0xbot1", "ALERT-1", "0x1")])
+
+        alerts, _ = forta_explorer.alerts_by_bots_after([("0xbot1", "ALERT-1")], 1, datetime(2022, 4, 29), datetime(2022, 4, 30), None, ["metadata"])
+
+        assert "metadata" in forta_explorer.session.queries[0], "query should contain the requested field"
+        assert "bot {" in forta_explorer.session.queries[0], "query should contain the fields required to split the alerts"
+        assert "contracts" not in forta_explorer.session.queries[0] and "protocol" not in forta_explorer.session.queries[0], "query should not contain fields that weren't requested"
+        assert alerts[("0xbot1", "ALERT-1")].columns.tolist() == ["createdAt", "metadata", "alertId", "hash", "transactionHash", "bot_id"], "only the requested and required fields should be returned"
+        assert alerts[("0xbot1", "ALERT-1")]["createdAt"].tolist() == [pd.Timestamp("2022-04-30T23:55:17.284158264Z")], "createdAt should be parsed into UTC timestamps"
+
+    def test_alert_pages_are_yielded_as_they_arrive(self):
+        forta_explorer = FortaExplorer()
+        forta_explorer.session = PagedSessionMock([[alert("0xbot1", "ALERT-1", "0x1"), alert("0xbot1", "ALERT-1", "0x2")], [alert("0xbot1", "ALERT-1", "0x3")]])
+
+        pages = forta_explorer.alert_pages([("0xbot1", "ALERT-1")], 1, datetime(2022, 4, 29), datetime(2022, 4, 30), None)
+        page_alerts, end_cursor = next(pages)
+
+        assert len(forta_explorer.session.queries) == 1, "only the first page should have been fetched"
+        assert [alert["hash"] for alert in page_alerts] == ["0x1", "0x2"], "first page should be yielded"
+        assert end_cursor == {"alertId": "ALERT-1", "blockNumber": 1}, "end cursor of the first page should be yielded"
+        assert [[alert["hash"] for alert in page_alerts] for page_alerts, _ in pages] == [["0x3"]], "remaining pages should be yielded"
+
+    def test_alerts_by_bots_after_collects_all_pages(self):
+        forta_explorer = FortaExplorer()
+        forta_explorer.session = PagedSessionMock([[alert("0xbot1", "ALERT-1", "0x1"), alert("0xbot1", "ALERT-1", "0x2")], [alert("0xbot1", "ALERT-1", "0x3")], []])
+
+        alerts, end_cursor = forta_explorer.alerts_by_bots_after([("0xbot1", "ALERT-1")], 1, datetime(2022, 4, 29), datetime(2022, 4, 30), {"alertId": "ALERT-1", "blockNumber": 0}, ["metadata"])
+
+        assert len(forta_explorer.session.queries) == 3, "all pages should be fetched"
+        assert 'after: {blockNumber:2, alertId:"ALERT-1"}' in forta_explorer.session.queries[2], "next page should be requested after the end cursor of the previous one"
+        assert alerts[("0xbot1", "ALERT-1")]["hash"].tolist() == ["0x1", "0x2", "0x3"], "alerts of all pages should be collected in query order"
+        assert alerts[("0xbot1", "ALERT-1")]["transactionHash"].tolist() == ["0x1", "0x1", "0x1"], "transaction hash should be taken from source"
+        assert end_cursor == {"alertId": "ALERT-1", "blockNumber": 2}, "end cursor of the last non-empty page should be returned"
+
+    def test_collect_alerts_interns_lower_case_addresses(self):
+        first_alert = alert("0xbot1", "ALERT-1", "0x1")
+        first_alert["addresses"] = ["0xAbC", "0xdef"]
+        second_alert = alert("0xbot1", "ALERT-1", "0x2")
+        second_alert["addresses"] = ["0xabc"]
+        third_alert = alert("0xbot1", "ALERT-1", "0x3")
+        third_alert["addresses"] = None
+
+        df_forta, _ = FortaExplorer.collect_alerts([([first_alert, second_alert, third_alert], None)], ["addresses"])
+
+        assert df_forta["addresses"].tolist() == [["0xabc", "0xdef"], ["0xabc"], None], "addresses should be lower cased"
+        assert df_forta["addresses"][0][0] is df_forta["addresses"][1][0], "an address should be held once"
+
+    def test_decode_page_without_orjson(self, monkeypatch):
+        content = json.dumps({"data": {"alerts": {"alerts": [alert("0xbot1", "ALERT-1", "0x1")]}}}).encode("utf-8")
+        json_data = FortaExplorer.decode_page(content)
+        monkeypatch.setattr(forta_explorer, "orjson", None)
+
+        assert FortaExplorer.decode_page(content) == json_data, "page should be decoded the same with json"
+
+    def test_decode_page_from_threads_leaves_gc_enabled(self):
+        content = json.dumps({"data": {"alerts": {"alerts": [alert("0xbot1", "ALERT-1", hex(i)) for i in range(100)]}}}).encode("utf-8")
+        assert gc.isenabled(), "gc should be enabled before decoding"
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            pages = list(executor.map(lambda _: FortaExplorer.decode_page(content), range(200)))
+        assert len(pages) == 200, "all pages should be decoded"
+        assert gc.isenabled(), "gc should be enabled after decoding pages from several threads"
+
+        with FortaExplorer.paused_gc(), ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda _: FortaExplorer.decode_page(content), range(200)))
+            assert not gc.isenabled(), "gc should be paused while the pages are fetched"
+        assert gc.isenabled(), "gc should be enabled again after the fetch"
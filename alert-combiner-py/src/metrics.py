@@ -0,0 +1,124 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SECONDS_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300]
+VOLUME_BUCKETS = [0, 1, 10, 100, 1_000, 10_000, 100_000, 1_000_000]
+
+
+class DetectionMetrics:
+    """
+    per-run instrumentation of the detection: durations of the phases and volumes (rows, candidates, JSON-RPC calls, ...) are recorded for the current run,
+    written as one structured log line when the run finishes and kept as cumulative histograms that are served in the Prometheus text format
+    recording is a perf_counter call and a dictionary update, so it is cheap enough to stay on in production
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.lock = threading.Lock()  # runs are recorded on the scheduler's worker thread and scraped on the server thread
+        self.seconds = {}  # phase -> seconds of the current run
+        self.volumes = {}  # name -> volume of the current run
+        self.histograms = {}  # (metric, label name, label value) -> [bucket counts, sum, count]
+        self.gauges = {}  # name -> value of the last run
+        self.runs = 0
+        self.server = None
+
+    def start_run(self):
+        self.seconds = {}
+        self.volumes = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        this function is a context manager that adds the duration of the block to the phase of the current run; a phase entered several times is summed up
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_seconds(name, time.perf_counter() - start)
+
+    def add_seconds(self, name: str, seconds: float):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def volume(self, name: str, value: int):
+        self.volumes[name] = self.volumes.get(name, 0) + value
+
+    def finish_run(self, gauges: dict = None):
+        """
+        this function logs the phases and volumes of the current run and adds them to the histograms; gauges are kept as they are until the next run
+        """
+        logging.info(f"Detection metrics {json.dumps({'seconds': {name: round(seconds, 4) for name, seconds in self.seconds.items()}, 'volumes': self.volumes, **(gauges or {})})}")
+        with self.lock:
+            self.runs += 1
+            for name, seconds in self.seconds.items():
+                self.observe("phase_seconds", "phase", name, seconds, SECONDS_BUCKETS)
+            for name, value in self.volumes.items():
+                self.observe("volume", "name", name, value, VOLUME_BUCKETS)
+            self.gauges.update(gauges or {})
+
+    def observe(self, metric: str, label_name: str, label_value: str, value: float, buckets: list):
+        histogram = self.histograms.setdefault((metric, label_name, label_value), [[0] * len(buckets), 0.0, 0])
+        for position, bucket in enumerate(buckets):
+            if value <= bucket:
+                histogram[0][position] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def render(self) -> str:
+        """
+        this function renders the histograms and gauges in the Prometheus text format
+        :return: text: str
+        """
+        lines = []
+        with self.lock:
+            lines.append(f"# TYPE {self.prefix}_runs_total counter")
+            lines.append(f"{self.prefix}_runs_total {self.runs}")
+            for metric, buckets in [("phase_seconds", SECONDS_BUCKETS), ("volume", VOLUME_BUCKETS)]:
+                lines.append(f"# TYPE {self.prefix}_{metric} histogram")
+                for (histogram_metric, label_name, label_value), (bucket_counts, total, count) in sorted(self.histograms.items()):
+                    if histogram_metric != metric:
+                        continue
+                    for bucket, bucket_count in zip(buckets, bucket_counts):
+                        lines.append(f'{self.prefix}_{metric}_bucket{{{label_name}="{label_value}",le="{bucket}"}} {bucket_count}')
+                    lines.append(f'{self.prefix}_{metric}_bucket{{{label_name}="{label_value}",le="+Inf"}} {count}')
+                    lines.append(f'{self.prefix}_{metric}_sum{{{label_name}="{label_value}"}} {total}')
+                    lines.append(f'{self.prefix}_{metric}_count{{{label_name}="{label_value}"}} {count}')
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f"# TYPE {self.prefix}_{name} gauge")
+                lines.append(f"{self.prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int):
+        """
+        this function serves the metrics on /metrics of the port from a daemon thread; it is a no-op if the metrics are already served or the port can't be bound, so the bot runs on without the endpoint
+        """
+        if self.server is not None:
+            return
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # scrapes are not logged
+
+        try:
+            self.server = ThreadingHTTPServer(("", port), MetricsHandler)
+        except OSError as e:
+            logging.warning(f"Detection metrics are not served, port {port} can't be bound: {e}")
+            return
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logging.info(f"Serving detection metrics on port {self.server.server_address[1]}")
@@ -0,0 +1,59 @@
+import urllib.request
+
+from metrics import DetectionMetrics
+
+
+class TestDetectionMetrics:
+    def test_run_is_added_to_histograms(self):
+        metrics = DetectionMetrics("test")
+
+        metrics.start_run()
+        with metrics.phase("fetch"):
+            pass
+        metrics.add_seconds("evaluate", 0.2)
+        metrics.add_seconds("evaluate", 0.2)
+        metrics.volume("alerts", 50)
+        metrics.finish_run({"hit_ratio": 0.5})
+
+        assert metrics.seconds["evaluate"] == 0.4, "durations of a phase should be summed up within a run"
+        assert metrics.histograms[("phase_seconds", "phase", "evaluate")] == [[0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1], 0.4, 1], "duration should be observed in the buckets it fits"
+        assert metrics.histograms[("volume", "name", "alerts")][1:] == [50, 1], "volume should be observed"
+
+        metrics.start_run()
+        assert metrics.seconds == {} and metrics.volumes == {}, "a new run should start empty"
+
+    def test_render(self):
+        metrics = DetectionMetrics("test")
+        metrics.start_run()
+        metrics.add_seconds("fetch", 2)
+        metrics.finish_run({"hit_ratio": 0.5})
+
+        text = metrics.render()
+
+        assert "test_runs_total 1" in text, "runs should be counted"
+        assert 'test_phase_seconds_bucket{phase="fetch",le="1"} 0' in text, "bucket below the duration should be empty"
+        assert 'test_phase_seconds_bucket{phase="fetch",le="5"} 1' in text, "bucket above the duration should count it"
+        assert 'test_phase_seconds_bucket{phase="fetch",le="+Inf"} 1' in text, "+Inf bucket should count all observations"
+        assert 'test_phase_seconds_sum{phase="fetch"} 2' in text, "sum should be rendered"
+        assert "test_hit_ratio 0.5" in text, "gauge should be rendered"
+
+    def test_serve(self):
+        metrics = DetectionMetrics("test")
+        metrics.serve(0)
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{metrics.server.server_address[1]}/metrics", timeout=10) as response:
+                assert "test_runs_total 0" in response.read().decode("utf-8"), "metrics should be served"
+        finally:
+            metrics.server.shutdown()
+            metrics.server.server_close()
+
+    def test_serve_on_bound_port(self):
+        metrics = DetectionMetrics("test")
+        metrics.serve(0)
+        try:
+            other_metrics = DetectionMetrics("test")
+            other_metrics.serve(metrics.server.server_address[1])  # should log a warning instead of raising
+            assert other_metrics.server is None, "metrics should not be served on a port that is already bound"
+        finally:
+            metrics.server.shutdown()
+            metrics.server.server_close()
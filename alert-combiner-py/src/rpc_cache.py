@@ -0,0 +1,164 @@
+import heapq
+import logging
+import time
+
+import requests
+from hexbytes import HexBytes
+from web3 import Web3
+
+
+class RpcCache:
+    """
+    cache of the JSON-RPC lookups of detect_attack
+    lookups are sent as JSON-RPC batch requests when the web3 provider exposes an HTTP endpoint; otherwise (e.g. mocks) each lookup goes through w3.eth
+    bytecode is kept for code_ttl_seconds across cycles, transactions are only kept for the current cycle
+    transaction counts are kept for transaction_count_ttl_seconds; as nonces only increase, a count above transaction_count_threshold is kept for the longer large_transaction_count_ttl_seconds
+    expired entries are swept at the start of each cycle and at most max_size bytecodes and transaction counts are kept across cycles
+    """
+
+    def __init__(self, code_ttl_seconds: int, batch_size: int, transaction_count_ttl_seconds: int = 0, transaction_count_threshold: int = None, large_transaction_count_ttl_seconds: int = 0, max_size: int = None):
+        self.code_ttl_seconds = code_ttl_seconds
+        self.batch_size = batch_size
+        self.transaction_count_ttl_seconds = transaction_count_ttl_seconds
+        self.transaction_count_threshold = transaction_count_threshold  # None keeps no count longer
+        self.large_transaction_count_ttl_seconds = large_transaction_count_ttl_seconds
+        self.max_size = max_size  # None keeps all entries until they expire
+        self.session = requests.Session()
+        self.codes = {}  # lower case address -> (HexBytes code, expiry timestamp)
+        self.transaction_counts = {}  # lower case address -> (transaction count, expiry timestamp)
+        self.transaction_tos = {}  # transaction hash -> to address of the current cycle
+        self.round_trips = 0
+        self.lookups = 0  # get_* calls of the current cycle
+        self.hits = 0  # get_* calls of the current cycle answered from the cache
+
+    def new_cycle(self):
+        """
+        this function drops the transactions of the previous cycle, expired bytecode and transaction counts and, beyond max_size, the entries closest to expiry
+        """
+        now = time.time()
+        self.codes = self.sweep(self.codes, now)
+        self.transaction_counts = self.sweep(self.transaction_counts, now)
+        self.transaction_tos = {}
+        self.round_trips = 0
+        self.lookups = 0
+        self.hits = 0
+
+    def sweep(self, entries: dict, now: float) -> dict:
+        """
+        this function drops the expired entries and, if more than max_size remain, the ones closest to expiry
+        :return: entries: dict address -> (value, expiry timestamp)
+        """
+        entries = {address: (value, expiry) for address, (value, expiry) in entries.items() if expiry > now}
+        if self.max_size is not None and len(entries) > self.max_size:
+            entries = dict(heapq.nlargest(self.max_size, entries.items(), key=lambda entry: entry[1][1]))
+        return entries
+
+    def prefetch_codes(self, w3, addresses: list):
+        """
+        this function fetches the bytecode of all addresses that aren't cached yet; addresses that can't be fetched are left out and fail on get_code
+        """
+        addresses = [address for address in dict.fromkeys(address.lower() for address in addresses) if address not in self.codes and Web3.isAddress(address)]
+        expiry = time.time() + self.code_ttl_seconds
+        for address, code in self.fetch(w3, "eth_getCode", addresses, lambda address: [Web3.toChecksumAddress(address), "latest"], lambda address: w3.eth.get_code(Web3.toChecksumAddress(address)), HexBytes).items():
+            self.codes[address] = (code, expiry)
+
+    def prefetch_transaction_counts(self, w3, addresses: list):
+        """
+        this function fetches the transaction count of all addresses that aren't cached yet; addresses that can't be fetched are left out and fail on get_transaction_count
+        """
+        addresses = [address for address in dict.fromkeys(address.lower() for address in addresses) if address not in self.transaction_counts and Web3.isAddress(address)]
+        for address, transaction_count in self.fetch(w3, "eth_getTransactionCount", addresses, lambda address: [Web3.toChecksumAddress(address), "latest"], lambda address: w3.eth.get_transaction_count(Web3.toChecksumAddress(address)), lambda result: int(result, 16)).items():
+            self.transaction_counts[address] = (transaction_count, self.transaction_count_expiry(transaction_count))
+
+    def transaction_count_expiry(self, transaction_count: int) -> float:
+        if self.transaction_count_threshold is not None and transaction_count > self.transaction_count_threshold:
+            return time.time() + self.large_transaction_count_ttl_seconds
+        return time.time() + self.transaction_count_ttl_seconds
+
+    def cached_transaction_count(self, address: str) -> int:
+        """
+        this function returns the cached transaction count of the address without fetching it
+        :return: transaction_count: int or None if the count isn't cached
+        """
+        cached = self.transaction_counts.get(address.lower())
+        return cached[0] if cached is not None else None
+
+    def prefetch_transaction_tos(self, w3, transaction_hashes: list):
+        """
+        this function fetches the to address of all transactions that aren't cached for this cycle yet; transactions that can't be fetched are left out and fail on get_transaction_to
+        """
+        transaction_hashes = [transaction_hash for transaction_hash in dict.fromkeys(transaction_hashes) if transaction_hash not in self.transaction_tos]
+        self.transaction_tos.update(self.fetch(w3, "eth_getTransactionByHash", transaction_hashes, lambda transaction_hash: [transaction_hash], lambda transaction_hash: w3.eth.get_transaction(transaction_hash)['to'], lambda result: result['to']))
+
+    def get_code(self, w3, address: str) -> HexBytes:
+        self.lookups += 1
+        if address.lower() in self.codes:
+            self.hits += 1
+        else:
+            self.round_trips += 1
+            self.codes[address.lower()] = (w3.eth.get_code(Web3.toChecksumAddress(address)), time.time() + self.code_ttl_seconds)
+        return self.codes[address.lower()][0]
+
+    def get_transaction_count(self, w3, address: str) -> int:
+        self.lookups += 1
+        if address.lower() in self.transaction_counts:
+            self.hits += 1
+        else:
+            self.round_trips += 1
+            transaction_count = w3.eth.get_transaction_count(Web3.toChecksumAddress(address))
+            self.transaction_counts[address.lower()] = (transaction_count, self.transaction_count_expiry(transaction_count))
+        return self.transaction_counts[address.lower()][0]
+
+    def get_transaction_to(self, w3, transaction_hash: str) -> str:
+        self.lookups += 1
+        if transaction_hash in self.transaction_tos:
+            self.hits += 1
+        else:
+            self.round_trips += 1
+            self.transaction_tos[transaction_hash] = w3.eth.get_transaction(transaction_hash)['to']
+        return self.transaction_tos[transaction_hash]
+
+    @staticmethod
+    def request_kwargs(provider) -> dict:
+        """
+        this function returns the keyword arguments (headers, timeout, proxies, ...) the web3 provider sends its own requests with, so batch requests carry them as well
+        :return: request_kwargs: dict
+        """
+        get_request_kwargs = getattr(provider, "get_request_kwargs", None)
+        request_kwargs = dict(get_request_kwargs()) if get_request_kwargs is not None else {}
+        request_kwargs.setdefault("timeout", 60)
+        return request_kwargs
+
+    def fetch(self, w3, method: str, keys: list, params, fetch_single, parse_result) -> dict:
+        """
+        this function calls method for each key with batch requests of up to batch_size calls; keys the batch didn't return a result for are fetched with fetch_single
+        :return: results: dict key -> result
+        """
+        results = {}
+        if len(keys) == 0:
+            return results
+
+        endpoint_uri = getattr(getattr(w3, "provider", None), "endpoint_uri", None)
+        if endpoint_uri is not None:
+            request_kwargs = RpcCache.request_kwargs(w3.provider)
+            for i in range(0, len(keys), self.batch_size):
+                batch = keys[i:i + self.batch_size]
+                payload = [{"jsonrpc": "2.0", "id": position, "method": method, "params": params(key)} for position, key in enumerate(batch)]
+                try:
+                    self.round_trips += 1
+                    response = self.session.post(str(endpoint_uri), json=payload, **request_kwargs)
+                    response.raise_for_status()
+                    for item in response.json():
+                        if item.get("result") is not None:
+                            results[batch[item["id"]]] = parse_result(item["result"])
+                except Exception as e:
+                    logging.warning(f"JSON-RPC batch {method} of {len(batch)} calls failed: {e}")
+
+        for key in keys:
+            if key not in results:
+                try:
+                    self.round_trips += 1
+                    results[key] = fetch_single(key)
+                except Exception as e:
+                    logging.warning(f"JSON-RPC {method} of {key} failed: {e}")
+        return results
@@ -0,0 +1,118 @@
+import time
+
+from hexbytes import HexBytes
+from web3 import HTTPProvider
+
+from rpc_cache import RpcCache
+from web3_mock import CONTRACT, EOA_ADDRESS, EOA_ADDRESS_LARGE_TX, Web3Mock
+
+
+class ProviderMock:
+    def __init__(self):
+        self.endpoint_uri = "http://localhost:8545"
+
+
+class ResponseMock:
+    def __init__(self, json_data: list):
+        self.json_data = json_data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.json_data
+
+
+class SessionMock:
+    def __init__(self, results: dict):
+        self.results = results
+        self.payloads = []
+        self.request_kwargs = []
+
+    def post(self, url, json=None, **kwargs):
+        self.payloads.append(json)
+        self.request_kwargs.append(kwargs)
+        return ResponseMock([{"jsonrpc": "2.0", "id": call["id"], "result": self.results[call["params"][0]]} for call in json])
+
+
+class TestRpcCache:
+    def test_get_code_is_cached(self):
+        w3 = Web3Mock()
+        rpc_cache = RpcCache(60, 100)
+
+        assert rpc_cache.get_code(w3, CONTRACT.lower()) != HexBytes('0x'), "contract should have code"
+        rpc_cache.new_cycle()
+        rpc_cache.get_code(w3, CONTRACT)
+
+        assert rpc_cache.round_trips == 0, "code should be cached across cycles within its ttl"
+        assert (rpc_cache.lookups, rpc_cache.hits) == (1, 1), "cached lookup should be counted as a hit"
+
+    def test_transaction_counts_are_cached_per_cycle(self):
+        w3 = Web3Mock()
+        rpc_cache = RpcCache(60, 100)
+
+        rpc_cache.prefetch_transaction_counts(w3, [EOA_ADDRESS, EOA_ADDRESS_LARGE_TX, EOA_ADDRESS.lower()])
+        assert rpc_cache.get_transaction_count(w3, EOA_ADDRESS) == 499, "transaction count should be fetched"
+        assert rpc_cache.round_trips == 2, "each address should only be fetched once"
+
+        rpc_cache.new_cycle()
+        rpc_cache.get_transaction_count(w3, EOA_ADDRESS)
+        assert rpc_cache.round_trips == 1, "transaction count should be refetched in a new cycle"
+
+    def test_transaction_counts_above_threshold_are_cached_longer(self):
+        w3 = Web3Mock()
+        rpc_cache = RpcCache(60, 100, 0, 500, 60)
+
+        rpc_cache.prefetch_transaction_counts(w3, [EOA_ADDRESS, EOA_ADDRESS_LARGE_TX])
+        rpc_cache.new_cycle()
+
+        assert rpc_cache.cached_transaction_count(EOA_ADDRESS) is None, "transaction count below the threshold should expire after its ttl"
+        assert rpc_cache.get_transaction_count(w3, EOA_ADDRESS_LARGE_TX) == 501, "transaction count above the threshold should be cached"
+        assert rpc_cache.round_trips == 0, "transaction count above the threshold should not be fetched again"
+
+    def test_transaction_counts_are_cached_within_ttl(self):
+        w3 = Web3Mock()
+        rpc_cache = RpcCache(60, 100, 60, 500)
+
+        rpc_cache.prefetch_transaction_counts(w3, [EOA_ADDRESS])
+        rpc_cache.new_cycle()
+
+        assert rpc_cache.get_transaction_count(w3, EOA_ADDRESS) == 499, "transaction count should be cached"
+        assert rpc_cache.round_trips == 0, "transaction count should be cached across cycles within its ttl"
+
+    def test_prefetch_codes_batches_calls(self):
+        w3 = Web3Mock()
+        w3.provider = ProviderMock()
+        rpc_cache = RpcCache(60, 2)
+        rpc_cache.session = SessionMock({EOA_ADDRESS: "0x", CONTRACT: "0x05", EOA_ADDRESS_LARGE_TX: "0x"})
+
+        rpc_cache.prefetch_codes(w3, [EOA_ADDRESS, CONTRACT, EOA_ADDRESS_LARGE_TX, "0xnotanaddress"])
+
+        assert [len(payload) for payload in rpc_cache.session.payloads] == [2, 1], "valid addresses should be fetched in batches of batch size"
+        assert rpc_cache.round_trips == 2, "only the batch requests should have been sent"
+        assert rpc_cache.get_code(w3, CONTRACT) == HexBytes("0x05"), "code should be parsed from the batch response"
+        assert rpc_cache.get_code(w3, EOA_ADDRESS) == HexBytes("0x"), "code should be parsed from the batch response"
+
+    def test_batches_carry_provider_request_kwargs(self):
+        w3 = Web3Mock()
+        w3.provider = HTTPProvider("http://localhost:8545", request_kwargs={"headers": {"Authorization": "Bearer token"}, "timeout": 5})
+        rpc_cache = RpcCache(60, 2)
+        rpc_cache.session = SessionMock({CONTRACT: "0x05"})
+
+        rpc_cache.prefetch_codes(w3, [CONTRACT])
+
+        assert rpc_cache.session.request_kwargs[0]["headers"] == {"Authorization": "Bearer token"}, "batch request should carry the headers of the provider"
+        assert rpc_cache.session.request_kwargs[0]["timeout"] == 5, "batch request should use the timeout of the provider"
+
+    def test_cache_is_bounded(self):
+        w3 = Web3Mock()
+        rpc_cache = RpcCache(60, 100, 0, 500, 60, 2)
+
+        rpc_cache.prefetch_codes(w3, [EOA_ADDRESS])
+        rpc_cache.prefetch_codes(w3, [CONTRACT, EOA_ADDRESS_LARGE_TX])
+        rpc_cache.prefetch_transaction_counts(w3, [EOA_ADDRESS_LARGE_TX])
+        rpc_cache.transaction_counts[EOA_ADDRESS_LARGE_TX.lower()] = (501, time.time() - 1)
+        rpc_cache.new_cycle()
+
+        assert set(rpc_cache.codes.keys()) == {CONTRACT.lower(), EOA_ADDRESS_LARGE_TX.lower()}, "code closest to expiry should be dropped beyond max size"
+        assert rpc_cache.cached_transaction_count(EOA_ADDRESS_LARGE_TX) is None, "transaction count above the threshold should expire after its ttl"
@@ -0,0 +1,116 @@
+import logging
+import queue
+import threading
+import time
+
+
+class DetectionScheduler:
+    """
+    long-lived background worker that runs the detection for submitted blocks, one run at a time
+    requests are held in a bounded queue and coalesced: the worker only runs the latest pending request and drops the older ones (latest block wins)
+    each run has a deadline the detection checks cooperatively through deadline_exceeded; findings are handed back through a thread-safe queue
+    """
+
+    def __init__(self, detect, deadline_seconds: float, queue_size: int):
+        self.detect = detect  # detect(*args) -> list of findings
+        self.deadline_seconds = deadline_seconds
+        self.requests = queue.Queue(maxsize=queue_size)
+        self.findings = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+        self.deadline = None  # monotonic time the current run has to finish by; None while idle
+        self.runs = 0
+        self.coalesced = 0  # requests dropped in favor of a newer one; counted under the lock, as both submit and the worker drop requests
+        self.deadline_exceeded_runs = 0
+        self.last_run_seconds = 0.0
+
+    def submit(self, *args):
+        """
+        this function queues a detection run with args and starts the worker if it isn't running; if the queue is full, the oldest request is dropped
+        """
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, daemon=True)
+                self.worker.start()
+
+            while True:
+                try:
+                    self.requests.put_nowait(args)
+                    return
+                except queue.Full:
+                    self.drop_request()
+
+    def collect(self) -> list:
+        """
+        this function returns the findings of all runs finished since the last call
+        :return: findings: list
+        """
+        findings = []
+        while True:
+            try:
+                findings.extend(self.findings.get_nowait())
+            except queue.Empty:
+                return findings
+
+    def backlog(self) -> int:
+        return self.requests.qsize()
+
+    def deadline_exceeded(self) -> bool:
+        """
+        this function assesses whether the current run is past its deadline; it is always false outside of a run, e.g. when the detection is called directly
+        :return: deadline_exceeded: bool
+        """
+        deadline = self.deadline
+        return deadline is not None and time.monotonic() > deadline
+
+    def join(self):
+        """
+        this function blocks until all submitted requests were run or dropped
+        """
+        self.requests.join()
+
+    def drop_request(self):
+        # called by submit with the lock held
+        try:
+            self.requests.get_nowait()
+        except queue.Empty:
+            return
+        self.coalesced += 1
+        self.requests.task_done()
+
+    def run(self):
+        while True:
+            args = self.requests.get()
+            # latest block wins: run the newest pending request instead and drop the ones in between
+            while True:
+                try:
+                    newer_args = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                with self.lock:
+                    self.coalesced += 1
+                self.requests.task_done()
+                args = newer_args
+
+            try:
+                self.run_once(args)
+            finally:
+                self.requests.task_done()
+
+    def run_once(self, args: tuple):
+        start = time.monotonic()
+        self.deadline = start + self.deadline_seconds
+        try:
+            findings = self.detect(*args)
+            if findings:
+                self.findings.put(findings)
+        except Exception as e:
+            logging.error(f"Exception in detection run: {e}")
+        finally:
+            self.deadline = None
+
+        self.last_run_seconds = time.monotonic() - start
+        self.runs += 1
+        if self.last_run_seconds > self.deadline_seconds:
+            self.deadline_exceeded_runs += 1
+        logging.info(f"Detection run took {self.last_run_seconds:.1f}s; backlog {self.backlog()}, coalesced {self.coalesced}, deadline exceeded in {self.deadline_exceeded_runs} of {self.runs} runs")
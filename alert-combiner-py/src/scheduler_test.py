@@ -0,0 +1,66 @@
+import threading
+import time
+
+from scheduler import DetectionScheduler
+
+
+class TestDetectionScheduler:
+    def test_findings_are_collected(self):
+        scheduler = DetectionScheduler(lambda block: [f"finding {block}"], 60, 10)
+
+        scheduler.submit(1)
+        scheduler.join()
+
+        assert scheduler.collect() == ["finding 1"], "findings of the run should be collected"
+        assert scheduler.collect() == [], "findings should only be collected once"
+
+    def test_latest_block_wins(self):
+        started = threading.Event()
+        release = threading.Event()
+        blocks = []
+
+        def detect(block):
+            blocks.append(block)
+            started.set()
+            release.wait(10)
+            return []
+
+        scheduler = DetectionScheduler(detect, 60, 2)
+        scheduler.submit(1)
+        started.wait(10)
+        for block in range(2, 6):
+            scheduler.submit(block)
+        release.set()
+        scheduler.join()
+
+        assert blocks == [1, 5], "pending blocks should be coalesced into the latest one"
+        assert scheduler.coalesced == 3, "three pending blocks should have been dropped"
+        assert scheduler.backlog() == 0, "backlog should be empty"
+
+    def test_deadline_exceeded(self):
+        deadline_exceeded = []
+
+        def detect(block):
+            time.sleep(0.05)
+            deadline_exceeded.append(scheduler.deadline_exceeded())
+            return []
+
+        scheduler = DetectionScheduler(detect, 0.01, 10)
+        scheduler.submit(1)
+        scheduler.join()
+
+        assert deadline_exceeded == [True], "deadline should be exceeded within the run"
+        assert not scheduler.deadline_exceeded(), "deadline should not be exceeded outside of a run"
+        assert scheduler.deadline_exceeded_runs == 1, "run should be counted as exceeding the deadline"
+
+    def test_every_request_is_run_or_coalesced(self):
+        scheduler = DetectionScheduler(lambda block: [], 60, 2)
+
+        threads = [threading.Thread(target=lambda: [scheduler.submit(block) for block in range(500)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        scheduler.join()
+
+        assert scheduler.runs + scheduler.coalesced == 2000, "each request submitted concurrently should either be run or counted as coalesced"
@@ -23,6 +23,7 @@ class EthMock:
             return 501
         return 0
 
+    @property
     def chain_id(self):
         return 1
 
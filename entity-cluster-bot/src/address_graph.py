@@ -0,0 +1,265 @@
+import heapq
+
+import numpy as np
+from web3 import Web3
+
+from src.entity_components import EntityComponents
+
+
+class AddressGraph:
+    """
+    compact directed graph of addresses: addresses are interned as 20 byte keys mapped to integer ids, edges are held as numpy arrays of ids and last_seen as unix timestamps in a numpy array
+    edge lookups go through a set of edges packed into ints; each address with edges holds the list of indexes of its edges, so removing addresses only touches their own edges
+    ids of removed addresses are reused; the connected components of the bidirectional edges and a min-heap expiry index of last_seen are maintained along with the graph
+    the graph is pickled as flat arrays of its addresses, last_seen and edges; components and expiry index are rebuilt when it is unpickled
+    once mutations is set to a list, the mutations are appended to it so they can be persisted as delta and replayed onto an earlier state of the graph
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.ids = {}  # 20 byte address -> id
+        self.keys = []  # id -> 20 byte address; None for free ids
+        self.free_ids = []
+        self.last_seen = np.zeros(capacity, dtype=np.float64)  # id -> unix timestamp the address was last seen
+        self.edge_keys = set()  # edges packed as from_id << 32 | to_id
+        self.edge_from = np.zeros(capacity, dtype=np.int32)  # ids of the edges; the first len(edge_keys) entries are in use
+        self.edge_to = np.zeros(capacity, dtype=np.int32)
+        self.adjacency = {}  # id -> list of indexes of the edges from and to the address; only held for addresses with edges
+        self.components = EntityComponents()  # connected components of the bidirectional edges over ids
+        self.expiry_index = []  # min-heap of (last_seen, id); entries of addresses that were seen again or removed since are stale and skipped when popped
+        self.mutations = None  # list of ("node", key, last_seen), ("edge", from key, to key) and ("remove", keys) if mutations are recorded
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def edges(self) -> int:
+        return len(self.edge_keys)
+
+    def __contains__(self, address: str) -> bool:
+        return AddressGraph.key(address) in self.ids
+
+    @staticmethod
+    def key(address: str) -> bytes:
+        return bytes.fromhex(address[2:])
+
+    def id(self, address: str) -> int:
+        """
+        this function returns the id of the address
+        :return: id: int or None if the address isn't part of the graph
+        """
+        return self.ids.get(AddressGraph.key(address))
+
+    def address(self, id: int) -> str:
+        return Web3.toChecksumAddress(self.keys[id])
+
+    def add_node(self, address: str, last_seen: float):
+        """
+        this function adds the address to the graph if it isn't part of it yet and sets its last_seen
+        """
+        self.add_key(AddressGraph.key(address), last_seen)
+
+    def add_key(self, key: bytes, last_seen: float):
+        id = self.ids.get(key)
+        if id is None:
+            if len(self.free_ids) > 0:
+                id = self.free_ids.pop()
+                self.keys[id] = key
+            else:
+                id = len(self.keys)
+                self.keys.append(key)
+                if id >= len(self.last_seen):
+                    self.last_seen = np.concatenate([self.last_seen, np.zeros(len(self.last_seen), dtype=np.float64)])
+            self.ids[key] = id
+        self.touch(id, last_seen)
+
+    def touch_node(self, address: str, last_seen: float):
+        """
+        this function sets the last_seen of an address that is part of the graph
+        """
+        self.touch(self.ids[AddressGraph.key(address)], last_seen)
+
+    def touch(self, id: int, last_seen: float):
+        self.last_seen[id] = last_seen
+        if self.mutations is not None:
+            self.mutations.append(("node", self.keys[id], last_seen))
+        heapq.heappush(self.expiry_index, (last_seen, id))
+
+        #  stale entries only leave the index once they expire, so the index is rebuilt once most of its entries are stale
+        if len(self.expiry_index) > 2 * len(self.ids) + 1000:
+            self.rebuild_expiry_index()
+
+    def rebuild_expiry_index(self):
+        self.expiry_index = [(self.last_seen[id], id) for id in self.ids.values()]
+        heapq.heapify(self.expiry_index)
+
+    def add_edge(self, from_: str, to: str) -> bool:
+        """
+        this function adds an edge between two addresses that are part of the graph; once the reverse edge exists too, the components of both addresses are merged
+        :return: added: bool - false if one of the addresses isn't part of the graph
+        """
+        from_id = self.id(from_)
+        to_id = self.id(to)
+        if from_id is None or to_id is None:
+            return False
+        self.add_edge_ids(from_id, to_id)
+        return True
+
+    def add_edge_ids(self, from_id: int, to_id: int):
+        edge_key = from_id << 32 | to_id
+        if edge_key in self.edge_keys:
+            return
+        edge = len(self.edge_keys)
+        if edge >= len(self.edge_from):
+            self.edge_from = np.concatenate([self.edge_from, np.zeros(len(self.edge_from), dtype=np.int32)])
+            self.edge_to = np.concatenate([self.edge_to, np.zeros(len(self.edge_to), dtype=np.int32)])
+        self.edge_from[edge] = from_id
+        self.edge_to[edge] = to_id
+        self.edge_keys.add(edge_key)
+        self.adjacency.setdefault(from_id, []).append(edge)
+        if to_id != from_id:
+            self.adjacency.setdefault(to_id, []).append(edge)
+        if self.mutations is not None:
+            self.mutations.append(("edge", self.keys[from_id], self.keys[to_id]))
+        if (to_id << 32 | from_id) in self.edge_keys:
+            self.components.union(from_id, to_id)
+
+    def has_edge(self, from_: str, to: str) -> bool:
+        from_id = self.id(from_)
+        to_id = self.id(to)
+        return from_id is not None and to_id is not None and (from_id << 32 | to_id) in self.edge_keys
+
+    def has_reverse_edge(self, from_: str, to: str) -> bool:
+        return self.has_edge(to, from_)
+
+    def bidirectional_edges(self, ids: set) -> list:
+        """
+        this function returns the bidirectional edges between the given ids; only the edges of the given ids are looked at
+        :return: edges: list of (from_id, to_id)
+        """
+        bidirectional_edges = []
+        for id in ids:
+            for edge in self.adjacency.get(id, ()):
+                to_id = int(self.edge_to[edge])
+                if self.edge_from[edge] == id and to_id in ids and (to_id << 32 | id) in self.edge_keys:
+                    bidirectional_edges.append((id, to_id))
+        return bidirectional_edges
+
+    def remove_nodes(self, ids: set):
+        """
+        this function removes the addresses with the given ids and their edges; the components of the addresses are split up along the remaining bidirectional edges
+        removed edges leave holes in the edge arrays that are filled with the last edges, so the cost is the number of edges of the removed addresses and of the moved edges
+        """
+        if len(ids) == 0:
+            return
+        if self.mutations is not None:
+            self.mutations.append(("remove", [self.keys[id] for id in ids]))
+
+        removed_edges = set()
+        for id in ids:
+            removed_edges.update(self.adjacency.pop(id, ()))
+        for edge in removed_edges:
+            from_id, to_id = int(self.edge_from[edge]), int(self.edge_to[edge])
+            self.edge_keys.discard(from_id << 32 | to_id)
+            for neighbor in {from_id, to_id} - ids:
+                self.unlink(neighbor, edge)
+
+        #  the last edges are moved into the holes the removed edges left below the new end of the arrays
+        edges = len(self.edge_keys)
+        holes = sorted(edge for edge in removed_edges if edge < edges)
+        moved_edges = [edge for edge in range(edges, edges + len(removed_edges)) if edge not in removed_edges]
+        for hole, edge in zip(holes, moved_edges):
+            from_id, to_id = int(self.edge_from[edge]), int(self.edge_to[edge])
+            self.edge_from[hole] = from_id
+            self.edge_to[hole] = to_id
+            for neighbor in {from_id, to_id}:
+                neighbor_edges = self.adjacency[neighbor]
+                neighbor_edges[neighbor_edges.index(edge)] = hole
+
+        for id in ids:
+            del self.ids[self.keys[id]]
+            self.keys[id] = None
+            self.free_ids.append(id)
+        self.components.remove(ids, self.bidirectional_edges)
+
+    def unlink(self, id: int, edge: int):
+        edges = self.adjacency[id]
+        edges.remove(edge)
+        if len(edges) == 0:
+            del self.adjacency[id]
+
+    def remove_expired(self, expiry: float) -> list:
+        """
+        this function removes the addresses that were last seen before expiry; stale entries of the expiry index are dropped on the way, so the cost is the number of expired entries
+        :return: addresses: list of the removed addresses
+        """
+        ids = set()
+        while len(self.expiry_index) > 0 and self.expiry_index[0][0] < expiry:
+            last_seen, id = heapq.heappop(self.expiry_index)
+            if self.keys[id] is not None and self.last_seen[id] == last_seen:
+                ids.add(id)
+        addresses = [self.address(id) for id in ids]
+        self.remove_nodes(ids)
+        return addresses
+
+    def component(self, address: str) -> set:
+        """
+        this function returns the addresses of the component of bidirectional edges the address belongs to
+        :return: component: set of checksum addresses; empty if the address isn't part of the graph
+        """
+        id = self.id(address)
+        if id is None:
+            return set()
+        return {self.address(member) for member in self.components.component(id)} or {self.address(id)}
+
+    def pop_mutations(self) -> list:
+        """
+        this function returns the mutations recorded since the last call and starts recording anew
+        :return: mutations: list
+        """
+        mutations, self.mutations = self.mutations or [], []
+        return mutations
+
+    def replay(self, mutations: list):
+        """
+        this function applies mutations recorded by pop_mutations to the graph
+        """
+        for mutation in mutations:
+            if mutation[0] == "node":
+                self.add_key(mutation[1], mutation[2])
+            elif mutation[0] == "edge":
+                from_id = self.ids.get(mutation[1])
+                to_id = self.ids.get(mutation[2])
+                if from_id is not None and to_id is not None:
+                    self.add_edge_ids(from_id, to_id)
+            elif mutation[0] == "remove":
+                self.remove_nodes({self.ids[key] for key in mutation[1] if key in self.ids})
+
+    def __getstate__(self) -> dict:
+        ids = np.fromiter(self.ids.values(), dtype=np.int64, count=len(self.ids))
+        positions = np.full(len(self.keys), -1, dtype=np.int64)
+        positions[ids] = np.arange(len(ids))
+        edges = len(self.edge_keys)
+        return {"keys": b"".join(self.keys[id] for id in ids.tolist()),
+                "last_seen": self.last_seen[ids],
+                "edge_from": positions[self.edge_from[:edges]].astype(np.int32),
+                "edge_to": positions[self.edge_to[:edges]].astype(np.int32)}
+
+    def __setstate__(self, state: dict):
+        edge_from, edge_to = state["edge_from"], state["edge_to"]
+        self.__init__(max(len(state["last_seen"]), len(edge_from), 1024))
+        keys = state["keys"]
+        self.keys = [keys[position:position + 20] for position in range(0, len(keys), 20)]
+        self.ids = {key: id for id, key in enumerate(self.keys)}
+        self.last_seen[:len(self.keys)] = state["last_seen"]
+        self.edge_from[:len(edge_from)] = edge_from
+        self.edge_to[:len(edge_to)] = edge_to
+        edge_keys = edge_from.astype(np.int64) << 32 | edge_to
+        self.edge_keys = set(edge_keys.tolist())
+        for edge, (from_id, to_id) in enumerate(zip(edge_from.tolist(), edge_to.tolist())):
+            self.adjacency.setdefault(from_id, []).append(edge)
+            if to_id != from_id:
+                self.adjacency.setdefault(to_id, []).append(edge)
+        bidirectional = np.isin(edge_to.astype(np.int64) << 32 | edge_from, edge_keys)
+        for from_id, to_id in zip(edge_from[bidirectional].tolist(), edge_to[bidirectional].tolist()):
+            self.components.union(from_id, to_id)
+        self.rebuild_expiry_index()
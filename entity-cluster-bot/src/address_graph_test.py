@@ -0,0 +1,149 @@
+import pickle
+import random
+
+import networkx as nx
+import numpy as np
+
+from address_graph import AddressGraph
+from web3_mock import EOA_ADDRESS_NEW, EOA_ADDRESS_OLD, EOA_ADDRESS_SMALL_TX, EOA_ADDRESS_LARGE_TX
+
+
+def address(number: int) -> str:
+    return "0x" + number.to_bytes(20, "big").hex()
+
+
+def edges(graph: AddressGraph) -> set:
+    return {(graph.address(from_id), graph.address(to_id)) for from_id, to_id in zip(graph.edge_from[:graph.edges].tolist(), graph.edge_to[:graph.edges].tolist())}
+
+
+def adjacency(graph: AddressGraph) -> dict:
+    adjacency = {}
+    for edge, (from_id, to_id) in enumerate(zip(graph.edge_from[:graph.edges].tolist(), graph.edge_to[:graph.edges].tolist())):
+        adjacency.setdefault(from_id, set()).add(edge)
+        adjacency.setdefault(to_id, set()).add(edge)
+    return adjacency
+
+
+class CountingArray(np.ndarray):
+    reads = 0  # number of elements read from counting arrays
+
+    def __getitem__(self, item):
+        result = super().__getitem__(item)
+        CountingArray.reads += np.size(result)
+        return result
+
+
+def bidirectional_components(graph: nx.DiGraph) -> set:
+    filtered_graph = nx.subgraph_view(graph, filter_edge=lambda n1, n2: graph.has_edge(n2, n1))
+    return {frozenset(component) for component in nx.connected_components(filtered_graph.to_undirected())}
+
+
+class TestAddressGraph:
+    def test_add_edge(self):
+        graph = AddressGraph()
+        graph.add_node(EOA_ADDRESS_NEW, 1.0)
+        graph.add_node(EOA_ADDRESS_OLD, 1.0)
+
+        assert not graph.add_edge(EOA_ADDRESS_NEW, EOA_ADDRESS_SMALL_TX), "edge to an address that isn't part of the graph should not be added"
+        assert graph.add_edge(EOA_ADDRESS_NEW, EOA_ADDRESS_OLD.lower()), "edge should be added regardless of the case of the address"
+        assert graph.has_reverse_edge(EOA_ADDRESS_OLD, EOA_ADDRESS_NEW), "reverse edge should exist"
+        assert graph.component(EOA_ADDRESS_NEW) == {EOA_ADDRESS_NEW}, "one directional edge should not merge components"
+
+        graph.add_edge(EOA_ADDRESS_OLD, EOA_ADDRESS_NEW)
+        assert graph.edges == 2, "both edges should exist"
+        assert graph.component(EOA_ADDRESS_NEW.lower()) == {EOA_ADDRESS_NEW, EOA_ADDRESS_OLD}, "component should hold the checksum addresses"
+        assert graph.component(EOA_ADDRESS_SMALL_TX) == set(), "address that isn't part of the graph has no component"
+
+    def test_remove_expired(self):
+        graph = AddressGraph()
+        graph.add_node(EOA_ADDRESS_NEW, 1.0)
+        graph.add_node(EOA_ADDRESS_OLD, 1.0)
+        graph.add_node(EOA_ADDRESS_SMALL_TX, 1.0)
+        graph.add_edge(EOA_ADDRESS_NEW, EOA_ADDRESS_OLD)
+        graph.add_edge(EOA_ADDRESS_OLD, EOA_ADDRESS_NEW)
+        graph.add_edge(EOA_ADDRESS_OLD, EOA_ADDRESS_SMALL_TX)
+        graph.add_edge(EOA_ADDRESS_SMALL_TX, EOA_ADDRESS_OLD)
+        graph.touch_node(EOA_ADDRESS_NEW, 3.0)
+        graph.touch_node(EOA_ADDRESS_SMALL_TX, 3.0)
+
+        assert graph.remove_expired(2.0) == [EOA_ADDRESS_OLD], "address that wasn't seen again should be removed"
+        assert len(graph) == 2 and graph.edges == 0, "edges of the removed address should be removed"
+        assert graph.component(EOA_ADDRESS_NEW) == {EOA_ADDRESS_NEW}, "component should be split at the removed address"
+        assert len(graph.expiry_index) == 2, "stale entries should have been dropped from the expiry index"
+
+        graph.add_node(EOA_ADDRESS_LARGE_TX, 4.0)
+        assert len(graph.keys) == 3, "id of the removed address should be reused"
+
+    def test_pickle(self):
+        graph = AddressGraph()
+        for number in range(1, 11):
+            graph.add_node(address(number), float(number))
+        for number in range(1, 10):
+            graph.add_edge(address(number), address(number + 1))
+        graph.add_edge(address(2), address(1))
+        graph.remove_expired(4.0)
+
+        loaded_graph = pickle.loads(pickle.dumps(graph))
+        assert len(loaded_graph) == 7 and loaded_graph.edges == 6, "addresses and edges should be restored"
+        assert loaded_graph.has_reverse_edge(address(6), address(5)), "edges should be restored between the same addresses"
+        assert sorted(loaded_graph.remove_expired(6.0)) == [address(4), address(5)], "last_seen should be restored"
+
+    def test_replay(self):
+        graph = AddressGraph()
+        graph.add_node(EOA_ADDRESS_NEW, 1.0)
+        graph.add_node(EOA_ADDRESS_OLD, 1.0)
+        graph.pop_mutations()
+        snapshot = pickle.dumps(graph)
+
+        graph.add_node(EOA_ADDRESS_SMALL_TX, 2.0)
+        graph.add_edge(EOA_ADDRESS_NEW, EOA_ADDRESS_SMALL_TX)
+        graph.add_edge(EOA_ADDRESS_SMALL_TX, EOA_ADDRESS_NEW)
+        graph.add_edge(EOA_ADDRESS_NEW, EOA_ADDRESS_OLD)
+        graph.touch_node(EOA_ADDRESS_NEW, 3.0)
+        graph.remove_expired(1.5)
+        mutations = graph.pop_mutations()
+
+        loaded_graph = pickle.loads(snapshot)
+        loaded_graph.replay(mutations)
+        assert len(loaded_graph) == 2 and loaded_graph.edges == 2, "mutations should be replayed onto the snapshot"
+        assert loaded_graph.component(EOA_ADDRESS_NEW) == {EOA_ADDRESS_NEW, EOA_ADDRESS_SMALL_TX}, "edges should be replayed"
+        assert loaded_graph.remove_expired(2.5) == [EOA_ADDRESS_SMALL_TX], "last_seen should be replayed"
+        assert graph.pop_mutations() == [], "mutations should only be returned once"
+
+    def test_matches_networkx(self):
+        random.seed(7)
+        graph = AddressGraph()
+        nx_graph = nx.DiGraph()
+        for step in range(3000):
+            number_a, number_b = random.randint(1, 80), random.randint(1, 80)
+            for number in (number_a, number_b):
+                graph.add_node(address(number), float(step))
+                nx_graph.add_node(graph.address(graph.id(address(number))))
+            graph.add_edge(address(number_a), address(number_b))
+            nx_graph.add_edge(graph.address(graph.id(address(number_a))), graph.address(graph.id(address(number_b))))
+            if step % 100 == 99:
+                nx_graph.remove_nodes_from(graph.remove_expired(step - 60.0))
+                assert adjacency(graph) == {id: set(edges) for id, edges in graph.adjacency.items()}, "edge indexes of the addresses should match the edge arrays"
+            if step % 1000 == 999:
+                graph = pickle.loads(pickle.dumps(graph))
+
+        assert len(graph) == len(nx_graph) and edges(graph) == set(nx_graph.edges), "graph should match networkx"
+        assert {frozenset(graph.component(node)) for node in nx_graph.nodes} == bidirectional_components(nx_graph), "components should match the connected components of the bidirectional edges"
+
+
+    def test_prune_only_reads_edges_of_removed_addresses(self):
+        graph = AddressGraph()
+        for number in range(1, 100001):
+            graph.add_node(address(number), 10.0 if number > 10 else 1.0)
+        for number in range(1, 100001):
+            if number % 10 != 0:  # entities of 10 addresses each
+                graph.add_edge(address(number), address(number + 1))
+                graph.add_edge(address(number + 1), address(number))
+        graph.edge_from = graph.edge_from.view(CountingArray)
+        graph.edge_to = graph.edge_to.view(CountingArray)
+        CountingArray.reads = 0
+
+        assert len(graph.remove_expired(5.0)) == 10, "addresses of the expired entity should be removed"
+        assert graph.edges == 179982, "edges of the expired entity should be removed"
+        assert CountingArray.reads < 200, f"pruning should only read the edges of the removed addresses and the edges moved into their place, not all edges: {CountingArray.reads} reads"
+        assert adjacency(graph) == {id: set(edges) for id, edges in graph.adjacency.items()}, "edge indexes of the addresses should match the edge arrays"
@@ -1,9 +1,9 @@
 import logging
 import sys
+import time
 from datetime import datetime, timedelta
 
 import forta_agent
-import networkx as nx
 import rlp
 import requests
 from forta_agent import Finding, FindingSeverity, FindingType, get_json_rpc_url
@@ -15,14 +15,19 @@ import os
 from dotenv import load_dotenv
 load_dotenv()
 
-from src.constants import MAX_AGE_IN_DAYS, MAX_NONCE, ALERTED_ADDRESSES_KEY, FINDINGS_CACHE_KEY, GRAPH_KEY, ONE_WAY_WEI_TRANSFER_THRESHOLD, NEW_FUNDED_MAX_WEI_TRANSFER_THRESHOLD, NEW_FUNDED_MAX_NONCE
+from src.constants import MAX_AGE_IN_DAYS, MAX_NONCE, ALERTED_ADDRESSES_KEY, FINDINGS_CACHE_KEY, GRAPH_KEY, STATE_KEY, PERSIST_INTERVAL_IN_BLOCKS, SNAPSHOT_INTERVAL_IN_BLOCKS, MAX_FINDINGS_CACHE_SIZE, RPC_BATCH_SIZE, ONE_WAY_WEI_TRANSFER_THRESHOLD, NEW_FUNDED_MAX_WEI_TRANSFER_THRESHOLD, NEW_FUNDED_MAX_NONCE
+from src.address_graph import AddressGraph
+from src.rpc_cache import RpcCache
+from src.state_log import StateLog
 
 web3 = Web3(Web3.HTTPProvider(get_json_rpc_url()))
 
 TC_FUNDING_ADDRESSES = []
 FINDINGS_CACHE = []
+NEW_FINDINGS = []  # components added to FINDINGS_CACHE since the last delta
 ALERTED_ADDRESSES = []
-GRAPH = nx.DiGraph()
+GRAPH = AddressGraph()  # maintains the entity components and the expiry index along with the graph
+RPC_CACHE = RpcCache(RPC_BATCH_SIZE)  # transaction counts and bytecode of the current block
 MUTEX = False
 
 root = logging.getLogger()
@@ -44,35 +49,84 @@ def initialize():
     it is called from test to reset state between tests
     """
     global ALERTED_ADDRESSES
-    alerted_address = load(ALERTED_ADDRESSES_KEY)
-    ALERTED_ADDRESSES = [] if alerted_address is None else list(alerted_address)
-
     global FINDINGS_CACHE
-    findings_cache = load(FINDINGS_CACHE_KEY)
-    FINDINGS_CACHE = [] if findings_cache is None else findings_cache
-
+    global NEW_FINDINGS
     global GRAPH
-    graph = load(GRAPH_KEY)
-    GRAPH = nx.DiGraph() if graph is None else nx.DiGraph(graph)
+    global RPC_CACHE
+
+    RPC_CACHE = RpcCache(RPC_BATCH_SIZE)
+
+    STATE_LOG.wait()
+    snapshot, deltas = STATE_LOG.read()
+    if snapshot is None:
+        #  state persisted under separate keys by earlier versions of the bot; the next persist_state writes it as snapshot
+        alerted_address = load(ALERTED_ADDRESSES_KEY)
+        ALERTED_ADDRESSES = [] if alerted_address is None else list(alerted_address)
+
+        findings_cache = load(FINDINGS_CACHE_KEY)
+        FINDINGS_CACHE = [] if findings_cache is None else findings_cache
+
+        graph = load(GRAPH_KEY)
+        if graph is None:
+            GRAPH = AddressGraph()
+        elif isinstance(graph, AddressGraph):
+            GRAPH = graph
+        else:
+            GRAPH = from_networkx(graph)
+    else:
+        ALERTED_ADDRESSES = snapshot["alerted_addresses"]
+        FINDINGS_CACHE = snapshot["findings_cache"]
+        GRAPH = snapshot["graph"]
+
+    for delta in deltas:
+        GRAPH.replay(delta["graph"])
+        FINDINGS_CACHE.extend(delta["findings_cache"])
+    del FINDINGS_CACHE[:-MAX_FINDINGS_CACHE_SIZE]
+    NEW_FINDINGS = []
+    GRAPH.pop_mutations()
 
 
+def from_networkx(graph) -> AddressGraph:
+    """
+    this function converts a graph persisted as networkx.DiGraph by earlier versions of the bot; networkx is only needed to unpickle such a graph
+    :return: graph: AddressGraph
+    """
+    address_graph = AddressGraph()
+    for node, last_seen in graph.nodes(data="last_seen"):
+        address_graph.add_node(node, (last_seen or datetime.now()).timestamp())
+    for from_, to in graph.edges:
+        address_graph.add_edge(from_, to)
+    logging.info(f"Converted graph of {len(address_graph)} addresses and {address_graph.edges} edges")
+    return address_graph
+
 
 def persist(obj: object, key: str):
+    persist_bytes(pickle.dumps(obj), key)
+
+
+def persist_bytes(bytes: bytes, key: str):
     if os.environ.get('LOCAL_NODE') is None:
         logging.info(f"Persisting {key} using API")
-        bytes = pickle.dumps(obj)
         token = forta_agent.fetch_jwt({})
 
         headers = {"Authorization": f"Bearer {token}"}
         res = requests.post(f"{DATABASE}{key}", data=bytes, headers=headers)
         logging.info(f"Persisting {key} to database. Response: {res}")
-        return
+        res.raise_for_status()
     else:
         logging.info(f"Persisting {key} locally")
-        pickle.dump(obj, open(key, "wb"))
+        #  written to a temporary file first, so a partially written file is never loaded
+        with open(f"{key}.tmp", "wb") as file:
+            file.write(bytes)
+        os.replace(f"{key}.tmp", key)
 
 
 def load(key: str) -> object:
+    bytes = load_bytes(key)
+    return None if bytes is None else pickle.loads(bytes)
+
+
+def load_bytes(key: str) -> bytes:
     if os.environ.get('LOCAL_NODE') is None:
         logging.info(f"Loading {key} using API")
         token = forta_agent.fetch_jwt({})
@@ -82,19 +136,31 @@ def load(key: str) -> object:
         res = requests.get(f"{DATABASE}{key}", headers=headers)
         logging.info(f"Loaded {key}. Response: {res}")
         if res.status_code==200 and len(res.content) > 0:
-            return pickle.loads(res.content)
+            return res.content
         else:
             logging.info(f"{key} does not exist")
     else:
         # load locally
         logging.info(f"Loading {key} locally")
         if os.path.exists(key):
-            return pickle.load(open(key, "rb"))
+            with open(key, "rb") as file:
+                return file.read()
         else:
             logging.info(f"File {key} does not exist")
     return None
 
 
+def remove_local(key: str) -> bool:
+    #  the database has no delete, so only local files of earlier epochs are removed; the database ones are overwritten by later deltas
+    if os.environ.get('LOCAL_NODE') is None or not os.path.exists(key):
+        return False
+    os.remove(key)
+    return True
+
+
+STATE_LOG = StateLog(STATE_KEY, persist_bytes, load_bytes, remove_local)
+
+
 def add_address(w3, address):
     global GRAPH
 
@@ -105,31 +171,33 @@ def add_address(w3, address):
         return
 
     checksum_address = Web3.toChecksumAddress(address)
-    if w3.eth.get_transaction_count(checksum_address) <= MAX_NONCE:
-        if checksum_address in GRAPH.nodes:
-            GRAPH.nodes[checksum_address]["last_seen"] = datetime.now()
-            logging.info(f"Updated address {checksum_address} last_seen in graph. Graph size is still {len(GRAPH.nodes)}")
+    if RPC_CACHE.get_transaction_count(w3, checksum_address) <= MAX_NONCE:
+        if checksum_address in GRAPH:
+            touch_address(checksum_address, datetime.now())
+            logging.info(f"Updated address {checksum_address} last_seen in graph. Graph size is still {len(GRAPH)}")
         else:
-            GRAPH.add_node(checksum_address, last_seen=datetime.now())
-            logging.info(f"Added address {checksum_address} to graph. Graph size is now {len(GRAPH.nodes)}")
+            GRAPH.add_node(checksum_address, datetime.now().timestamp())
+            logging.info(f"Added address {checksum_address} to graph. Graph size is now {len(GRAPH)}")
+
+
+def touch_address(checksum_address: str, last_seen: datetime):
+    """
+    this function sets the last_seen of the address in the graph and adds it to the expiry index
+    """
+    GRAPH.touch_node(checksum_address, last_seen.timestamp())
 
 
 def prune_graph():
     global GRAPH
 
-    #  looks at each node in the graph and assesses how old it is
-    #  if its older than MAX_AGE_IN_DAYS, it will be removed from the graph
+    #  pops the addresses from the expiry index that were last seen more than MAX_AGE_IN_DAYS ago and removes them from the graph
+    #  entries of addresses that were seen again since are stale and dropped, so a pass only costs the number of expired entries
     #  note, if the nonce is larger than MAX_NONCE, it will not be removed from the graph
     #  as the nonce is only assessed when the node is created
 
-    nodes_to_remove = set()
-    for node in GRAPH.nodes:
-        if datetime.now() - GRAPH.nodes[node]["last_seen"] > timedelta(days=MAX_AGE_IN_DAYS):
-            nodes_to_remove.add(node)
-
-    for node in nodes_to_remove:
-        GRAPH.remove_node(node)
-        logging.info(f"Removed address {node} from graph. Graph size is now {len(GRAPH.nodes)}")
+    expiry = time.time() - timedelta(days=MAX_AGE_IN_DAYS).total_seconds()
+    for node in GRAPH.remove_expired(expiry):
+        logging.info(f"Removed address {node} from graph. Graph size is now {len(GRAPH)}")
 
 
 def add_directed_edge(w3, from_, to):
@@ -138,8 +206,8 @@ def add_directed_edge(w3, from_, to):
     if from_ is None or to is None:
         return
 
-    if Web3.toChecksumAddress(from_) in GRAPH.nodes and Web3.toChecksumAddress(to) in GRAPH.nodes:
-        GRAPH.add_edges_from([(Web3.toChecksumAddress(from_), Web3.toChecksumAddress(to))])
+    #  once the edge is bidirectional, the graph merges the components of both addresses into one entity
+    if GRAPH.add_edge(from_, to):
         logging.info(f"Added edge from address {from_} to {to}.")
         
 
@@ -160,13 +228,35 @@ def is_contract(w3, address) -> bool:
     """
     if address is None:
         return True
-    code = w3.eth.get_code(Web3.toChecksumAddress(address))
+    code = RPC_CACHE.get_code(w3, address)
     return code != HexBytes('0x')
 
 
+def lookup_addresses(transaction_event) -> tuple:
+    """
+    this function returns the addresses cluster_entities looks up the transaction count and the bytecode of, after the cheap value and transfer filters
+    the bytecode of new accounts with a small transfer depends on their transaction counts, so it is left to is_contract
+    :return: transaction_count_addresses: list, code_addresses: list
+    """
+    transaction_count_addresses = [transaction_event.transaction.from_, transaction_event.transaction.to]
+    if transaction_event.transaction.to is None:
+        transaction_count_addresses.append(calc_contract_address(None, transaction_event.transaction.from_, transaction_event.transaction.nonce))
+    code_addresses = []
+    if transaction_event.transaction.value > 0:
+        code_addresses += [transaction_event.transaction.to, transaction_event.transaction.from_]
+    for transfer_event in transaction_event.filter_log(ERC20_TRANSFER_EVENT):
+        if transfer_event['args']['value'] > 0:
+            code_addresses += [transfer_event['args']['to'], transfer_event['args']['from']]
+    return transaction_count_addresses, code_addresses
+
+
 def cluster_entities(w3, transaction_event) -> list:
     findings = []
-    
+
+    #  the transaction counts and bytecode cluster_entities looks up are fetched in one batch and memoized for the block
+    RPC_CACHE.new_block(transaction_event.block.number)
+    RPC_CACHE.prefetch(w3, *lookup_addresses(transaction_event))
+
     add_address(w3, transaction_event.transaction.from_)
     add_address(w3, transaction_event.transaction.to)
 
@@ -175,8 +265,6 @@ def cluster_entities(w3, transaction_event) -> list:
         contract_address = calc_contract_address(w3, transaction_event.transaction.from_, transaction_event.transaction.nonce)
         add_address(w3, contract_address)
 
-    prune_graph()
-
     #  add edges for each native transfer
     if transaction_event.transaction.value > 0:
         logging.info(f"Observing native transfer of value {transaction_event.transaction.value} from {transaction_event.transaction.from_} to {transaction_event.transaction.to}")
@@ -198,7 +286,7 @@ def cluster_entities(w3, transaction_event) -> list:
                 findings.append(finding)
 
     #  add edges for small native transfers, new accounts
-    if w3.eth.get_transaction_count(Web3.toChecksumAddress(transaction_event.transaction.from_), transaction_event.block.number) <= NEW_FUNDED_MAX_NONCE and w3.eth.get_transaction_count(Web3.toChecksumAddress(transaction_event.transaction.to), transaction_event.block.number) <= NEW_FUNDED_MAX_NONCE:
+    if RPC_CACHE.get_transaction_count(w3, transaction_event.transaction.from_) <= NEW_FUNDED_MAX_NONCE and RPC_CACHE.get_transaction_count(w3, transaction_event.transaction.to) <= NEW_FUNDED_MAX_NONCE:
         if transaction_event.transaction.value < NEW_FUNDED_MAX_WEI_TRANSFER_THRESHOLD:
             logging.info(f"Observing small native transfer of value {transaction_event.transaction.value} from new EOA {transaction_event.transaction.from_} to new EOA {transaction_event.transaction.to}")
             if not is_contract(w3, transaction_event.transaction.to) and not is_contract(w3, transaction_event.transaction.from_):
@@ -234,41 +322,29 @@ def cluster_entities(w3, transaction_event) -> list:
     return findings
 
 
-def filter_edge(n1, n2):
-    # filters for bidirectional edges
-    if [n2, n1] in GRAPH.edges:
-        return True
-    return False
-
-
 def create_finding(from_) -> Finding:
-    filtered_graph = nx.subgraph_view(GRAPH, filter_edge=filter_edge)
-    undirected_graph = filtered_graph.to_undirected()
-    
-    #  find all connected components
-    connected_components = list(nx.connected_components(undirected_graph))
-
-    #  find the connected component that contains the from_ address
-    for component in connected_components:
-        if Web3.toChecksumAddress(from_) in component and len(component) > 1:
-            if component not in FINDINGS_CACHE:
-                FINDINGS_CACHE.append(component)
-
-                if len(FINDINGS_CACHE) > 10000:
-                    FINDINGS_CACHE.pop(0)
-
-                return Finding(
-                    {
-                        "name": "Entity identified",
-                        "description": f"Entity of size {len(component)} has been identified. Transaction from {from_} created this entity.",
-                        "alert_id": "ENTITY-CLUSTER",
-                        "type": FindingType.Info,
-                        "severity": FindingSeverity.Info,
-                        "metadata": {
-                            "entity_addresses": list(component)
-                        }
+    #  look up the connected component of bidirectional edges that contains the from_ address
+    component = GRAPH.component(from_)
+    if len(component) > 1:
+        if component not in FINDINGS_CACHE:
+            FINDINGS_CACHE.append(component)
+            NEW_FINDINGS.append(component)
+
+            if len(FINDINGS_CACHE) > MAX_FINDINGS_CACHE_SIZE:
+                FINDINGS_CACHE.pop(0)
+
+            return Finding(
+                {
+                    "name": "Entity identified",
+                    "description": f"Entity of size {len(component)} has been identified. Transaction from {from_} created this entity.",
+                    "alert_id": "ENTITY-CLUSTER",
+                    "type": FindingType.Info,
+                    "severity": FindingSeverity.Info,
+                    "metadata": {
+                        "entity_addresses": list(component)
                     }
-                )
+                }
+            )
 
 
 def query_alerts(w3, aq):
@@ -293,22 +369,31 @@ def provide_handle_transaction(w3):
 
 real_handle_transaction = provide_handle_transaction(web3)
 
-def persist_state():
-    global GRAPH
-    global ALERTED_ADDRESSES
-    global FINDINGS_CACHE
+def persist_state(snapshot: bool = False):
+    """
+    this function persists the mutations of the state since the last call as delta, or the full state as snapshot if requested or needed
+    both are written from the background thread of the state log, so this only costs pickling the state
+    """
+    global NEW_FINDINGS
 
-    persist(GRAPH, GRAPH_KEY)
-    persist(FINDINGS_CACHE, FINDINGS_CACHE_KEY)
-    persist(ALERTED_ADDRESSES, ALERTED_ADDRESSES_KEY)
-    logging.info(f"Persisted bot state.")
+    if snapshot or STATE_LOG.snapshot_needed:
+        GRAPH.pop_mutations()
+        STATE_LOG.write_snapshot({"graph": GRAPH, "findings_cache": FINDINGS_CACHE, "alerted_addresses": ALERTED_ADDRESSES})
+        logging.info("Persisting bot state as snapshot.")
+    else:
+        STATE_LOG.write_delta({"graph": GRAPH.pop_mutations(), "findings_cache": NEW_FINDINGS})
+        logging.info("Persisting bot state as delta.")
+    NEW_FINDINGS = []
 
 def handle_block(block_event: forta_agent.block_event.BlockEvent) -> list:
     logging.info(f"Handling block {block_event.block_number}.")
 
-    if block_event.block_number % 240 == 0:
+    #  expired addresses are pruned once per block rather than on every transaction
+    prune_graph()
+
+    if block_event.block_number % PERSIST_INTERVAL_IN_BLOCKS == 0:
         logging.info(f"Persisting block {block_event.block_number}.")
-        persist_state()
+        persist_state(snapshot=block_event.block_number % SNAPSHOT_INTERVAL_IN_BLOCKS == 0)
 
     findings = []
     return findings
@@ -1,12 +1,13 @@
 import agent
 from forta_agent import create_transaction_event
 from datetime import datetime, timedelta
+import glob
 import os
 import networkx as nx
 
 from web3 import Web3
 from web3_mock import CONTRACT, EOA_ADDRESS_LARGE_TX, EOA_ADDRESS_NEW, EOA_ADDRESS_OLD, EOA_ADDRESS_SMALL_TX, EOA_ADDRESS_FUNDED_NEW, EOA_ADDRESS_FUNDED_OLD, EOA_ADDRESS_FUNDER_NEW, EOA_ADDRESS_FUNDER_OLD, Web3Mock
-from constants import ALERTED_ADDRESSES_KEY, FINDINGS_CACHE_KEY, GRAPH_KEY
+from constants import ALERTED_ADDRESSES_KEY, FINDINGS_CACHE_KEY, GRAPH_KEY, STATE_KEY
 from forta_agent import get_alerts
 w3 = Web3Mock()
 
@@ -19,6 +20,9 @@ class TestEntityClusterBot:
             os.remove(FINDINGS_CACHE_KEY)
         if os.path.isfile(GRAPH_KEY):
             os.remove(GRAPH_KEY)
+        agent.STATE_LOG.wait()
+        for key in glob.glob(f"{STATE_KEY}_*"):
+            os.remove(key)
     
 
     def test_prune_graph_age(self):
@@ -30,12 +34,25 @@ class TestEntityClusterBot:
         agent.add_address(w3, EOA_ADDRESS_NEW)
         agent.add_address(w3, EOA_ADDRESS_OLD)
 
-        agent.GRAPH.nodes[EOA_ADDRESS_NEW]["last_seen"] = datetime.now() - timedelta(days=6)
-        agent.GRAPH.nodes[EOA_ADDRESS_OLD]["last_seen"] = datetime.now() - timedelta(days=8)
+        agent.touch_address(EOA_ADDRESS_NEW, datetime.now() - timedelta(days=6))
+        agent.touch_address(EOA_ADDRESS_OLD, datetime.now() - timedelta(days=8))
         
         agent.prune_graph()
 
-        assert len(agent.GRAPH.nodes) == 1, "Old address was not removed from graph"
+        assert len(agent.GRAPH) == 1, "Old address was not removed from graph"
+
+    def test_prune_graph_skips_addresses_seen_again(self):
+        TestEntityClusterBot.remove_persistent_state()
+        agent.initialize()
+
+        agent.add_address(w3, EOA_ADDRESS_NEW)
+        agent.touch_address(EOA_ADDRESS_NEW, datetime.now() - timedelta(days=8))
+        agent.add_address(w3, EOA_ADDRESS_NEW)
+
+        agent.prune_graph()
+
+        assert len(agent.GRAPH) == 1, "Address seen again should not be removed from graph"
+        assert len(agent.GRAPH.expiry_index) == 2, "Stale entry of the address should have been dropped from the expiry index"
 
     def test_add_address_discard(self):
         #  calls address on address with too large of a nonce
@@ -44,7 +61,7 @@ class TestEntityClusterBot:
 
         agent.add_address(w3, EOA_ADDRESS_LARGE_TX)
 
-        assert len(agent.GRAPH.nodes) == 0, "Address shouldnt have been added to graph. Its nonce is too large"
+        assert len(agent.GRAPH) == 0, "Address shouldnt have been added to graph. Its nonce is too large"
 
     def test_add_address_valid(self):
         #  calls address on address with appropriate nonce
@@ -53,7 +70,7 @@ class TestEntityClusterBot:
 
         agent.add_address(w3, EOA_ADDRESS_SMALL_TX)
 
-        assert len(agent.GRAPH.nodes) == 1, "Address should have been added to graph. Its nonce is within range"
+        assert len(agent.GRAPH) == 1, "Address should have been added to graph. Its nonce is within range"
 
     def test_persist(self):
         TestEntityClusterBot.remove_persistent_state()
@@ -63,7 +80,51 @@ class TestEntityClusterBot:
         agent.persist_state()  # will perist state
 
         agent.initialize()  # will load state
-        assert len(agent.GRAPH.nodes) == 1, "Address should have been added to graph. Its nonce is within range"
+        assert len(agent.GRAPH) == 1, "Address should have been added to graph. Its nonce is within range"
+
+    def test_persist_delta(self):
+        TestEntityClusterBot.remove_persistent_state()
+        agent.initialize()
+
+        agent.add_address(w3, EOA_ADDRESS_NEW)
+        agent.add_address(w3, EOA_ADDRESS_OLD)
+        agent.persist_state()  # will persist snapshot, as none exists yet
+
+        agent.add_directed_edge(w3, EOA_ADDRESS_NEW, EOA_ADDRESS_OLD)
+        agent.add_directed_edge(w3, EOA_ADDRESS_OLD, EOA_ADDRESS_NEW)
+        agent.create_finding(EOA_ADDRESS_NEW)
+        agent.touch_address(EOA_ADDRESS_OLD, datetime.now() - timedelta(days=8))
+        agent.persist_state()  # will persist delta
+        agent.STATE_LOG.wait()
+        assert os.path.isfile(f"{STATE_KEY}_delta_1"), "Delta should have been persisted"
+
+        agent.initialize()  # will load snapshot and replay delta
+        assert len(agent.GRAPH) == 2, "Addresses of the snapshot should have been loaded"
+        assert agent.GRAPH.component(EOA_ADDRESS_NEW) == {EOA_ADDRESS_NEW, EOA_ADDRESS_OLD}, "Edges of the delta should have been replayed"
+        assert len(agent.FINDINGS_CACHE) == 1, "Findings cache of the delta should have been replayed"
+
+        agent.prune_graph()
+        agent.persist_state(snapshot=True)
+        agent.STATE_LOG.wait()
+        assert not os.path.isfile(f"{STATE_KEY}_delta_1"), "Delta of the earlier snapshot should have been removed"
+
+        agent.initialize()
+        assert len(agent.GRAPH) == 1, "Old address was not removed from graph"
+
+    def test_load_networkx_graph(self):
+        TestEntityClusterBot.remove_persistent_state()
+        graph = nx.DiGraph()
+        graph.add_node(EOA_ADDRESS_NEW, last_seen=datetime.now())
+        graph.add_node(EOA_ADDRESS_OLD, last_seen=datetime.now() - timedelta(days=8))
+        graph.add_edges_from([(EOA_ADDRESS_NEW, EOA_ADDRESS_OLD), (EOA_ADDRESS_OLD, EOA_ADDRESS_NEW)])
+        agent.persist(graph, GRAPH_KEY)
+
+        agent.initialize()  # will convert the graph persisted by earlier versions
+        assert len(agent.GRAPH) == 2, "Addresses of the persisted graph should have been loaded"
+        assert agent.GRAPH.component(EOA_ADDRESS_NEW) == {EOA_ADDRESS_NEW, EOA_ADDRESS_OLD}, "Bidirectional edge should have been loaded"
+
+        agent.prune_graph()
+        assert len(agent.GRAPH) == 1, "Old address was not removed from graph"
 
 
     def test_add_directed_edges_without_add(self):
@@ -72,7 +133,7 @@ class TestEntityClusterBot:
 
         agent.add_directed_edge(w3, EOA_ADDRESS_NEW, EOA_ADDRESS_OLD)
 
-        assert len(agent.GRAPH.nodes) == 0, "No addresses were added initially, so should be empty"
+        assert len(agent.GRAPH) == 0, "No addresses were added initially, so should be empty"
 
     def test_add_directed_edges_with_add(self):
         TestEntityClusterBot.remove_persistent_state()
@@ -82,10 +143,10 @@ class TestEntityClusterBot:
         agent.add_address(w3, EOA_ADDRESS_OLD)
         agent.add_directed_edge(w3, EOA_ADDRESS_NEW, EOA_ADDRESS_OLD)
 
-        assert len(agent.GRAPH.nodes) == 2, "Addresses were added initially"
-        assert len(agent.GRAPH.edges) == 1, "Edge should exist"
+        assert len(agent.GRAPH) == 2, "Addresses were added initially"
+        assert agent.GRAPH.edges == 1, "Edge should exist"
 
-    def test_filter_edge(self):
+    def test_has_reverse_edge(self):
         TestEntityClusterBot.remove_persistent_state()
         agent.initialize()
 
@@ -93,12 +154,21 @@ class TestEntityClusterBot:
         agent.add_address(w3, EOA_ADDRESS_OLD)
         agent.add_directed_edge(w3, EOA_ADDRESS_NEW, EOA_ADDRESS_OLD)
 
-        filtered_graph = nx.subgraph_view(agent.GRAPH, filter_edge=agent.filter_edge)
-        assert len(filtered_graph.edges) == 0, "Edge should have been filtered out"
+        assert not agent.GRAPH.has_reverse_edge(EOA_ADDRESS_NEW, EOA_ADDRESS_OLD), "Reverse edge should not exist yet"
 
         agent.add_directed_edge(w3, EOA_ADDRESS_OLD, EOA_ADDRESS_NEW)
-        filtered_graph = nx.subgraph_view(agent.GRAPH, filter_edge=agent.filter_edge)
-        assert len(filtered_graph.edges) == 2, "Edges should not have been filtered out"
+        assert agent.GRAPH.has_reverse_edge(EOA_ADDRESS_NEW, EOA_ADDRESS_OLD), "Reverse edge should exist"
+        assert agent.GRAPH.has_reverse_edge(EOA_ADDRESS_OLD, EOA_ADDRESS_NEW), "Reverse edge should exist"
+
+    def test_lookup_addresses(self):
+        transaction = {'hash': "0", 'from': EOA_ADDRESS_NEW, 'to': EOA_ADDRESS_OLD, 'value': 0, 'nonce': 8}
+        block = {'number': 0, 'timestamp': datetime.now().timestamp()}
+
+        no_transfer = create_transaction_event({'transaction': transaction, 'block': block, 'receipt': {'logs': []}})
+        assert agent.lookup_addresses(no_transfer) == ([EOA_ADDRESS_NEW, EOA_ADDRESS_OLD], []), "Bytecode should not be prefetched for a transaction without transfers"
+
+        native_transfer = create_transaction_event({'transaction': dict(transaction, value=1), 'block': block, 'receipt': {'logs': []}})
+        assert agent.lookup_addresses(native_transfer) == ([EOA_ADDRESS_NEW, EOA_ADDRESS_OLD], [EOA_ADDRESS_OLD, EOA_ADDRESS_NEW]), "Bytecode of both addresses of a native transfer should be prefetched"
 
     def test_finding_bidirectional(self):
         TestEntityClusterBot.remove_persistent_state()
@@ -124,6 +194,7 @@ class TestEntityClusterBot:
 
         findings = agent.cluster_entities(w3, native_transfer1)
         assert len(findings) == 0, "No findings should be returned as it is not bidirectional"
+        round_trips = agent.RPC_CACHE.round_trips
 
         native_transfer2 = create_transaction_event({
 
@@ -145,6 +216,7 @@ class TestEntityClusterBot:
 
         findings = agent.cluster_entities(w3, native_transfer2)
         assert len(findings) == 1, "Finding should be returned as it is bidirectional"
+        assert agent.RPC_CACHE.round_trips == round_trips, "Lookups of the addresses should be memoized within the block"
 
     def test_nofinding_onedirectional_below_threshold(self):
         TestEntityClusterBot.remove_persistent_state()
@@ -6,6 +6,13 @@ ONE_WAY_WEI_TRANSFER_THRESHOLD = 50000000000000000000  # 50 ETH
 ALERTED_ADDRESSES_KEY = "alerted_addresses_key"
 FINDINGS_CACHE_KEY = "findings_cache_key"
 GRAPH_KEY = "graph_key"
+STATE_KEY = "state_key"  # snapshots and deltas of the state are persisted under keys with this prefix
+
+PERSIST_INTERVAL_IN_BLOCKS = 240  # a delta of the state is persisted every this many blocks
+SNAPSHOT_INTERVAL_IN_BLOCKS = 240 * 24  # a snapshot of the full state is persisted instead of the delta every this many blocks
+MAX_FINDINGS_CACHE_SIZE = 10000
+
+RPC_BATCH_SIZE = 100  # max number of calls sent with a single JSON-RPC batch request
 
 NEW_FUNDED_MAX_NONCE = 1
 NEW_FUNDED_MAX_WEI_TRANSFER_THRESHOLD = 1000000000000000000 # 1 ETH
@@ -0,0 +1,99 @@
+import logging
+
+
+class EntityComponents:
+    """
+    disjoint-set (union-find) of the connected components of the graph's bidirectional edges, i.e. of the entities
+    components are merged when an edge whose reverse edge exists is added; removing nodes can split a component, so the components of removed nodes are rebuilt from their remaining members
+    nodes are the integer ids AddressGraph assigns to addresses; any hashable node works
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        this function removes all components
+        """
+        self.parents = {}  # id -> parent id; roots point to themselves
+        self.members = {}  # root id -> set of ids of the component
+
+    def __len__(self) -> int:
+        return len(self.parents)
+
+    def rebuild(self, ids, bidirectional_edges):
+        """
+        this function rebuilds the components from all ids and the bidirectional edges between them
+        """
+        self.reset()
+        for id in ids:
+            self.add(id)
+        for id_a, id_b in bidirectional_edges:
+            self.union(id_a, id_b)
+        logging.info(f"Rebuilt {len(self.members)} entity components of {len(self)} addresses")
+
+    def add(self, id: int):
+        if id not in self.parents:
+            self.parents[id] = id
+            self.members[id] = {id}
+
+    def find(self, id: int) -> int:
+        """
+        this function returns the root id of the component the id belongs to, compressing the path on the way
+        :return: root: int
+        """
+        root = id
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[id] != root:
+            self.parents[id], id = root, self.parents[id]
+        return root
+
+    def union(self, id_a: int, id_b: int) -> int:
+        """
+        this function merges the components of both ids; the smaller component is attached to the larger one
+        :return: root: int - root id of the merged component
+        """
+        self.add(id_a)
+        self.add(id_b)
+        root_a = self.find(id_a)
+        root_b = self.find(id_b)
+        if root_a == root_b:
+            return root_a
+        if len(self.members[root_a]) < len(self.members[root_b]):
+            root_a, root_b = root_b, root_a
+        self.parents[root_b] = root_a
+        self.members[root_a].update(self.members.pop(root_b))
+        return root_a
+
+    def remove(self, ids: set, bidirectional_edges):
+        """
+        this function removes the ids that were removed from the graph; the remaining members of their components are split up again along the bidirectional edges of the graph
+        bidirectional_edges returns the bidirectional edges between the given set of remaining members
+        """
+        remaining = set()
+        for id in ids:
+            if id not in self.parents:
+                continue
+            root = self.find(id)
+            if root in self.members:
+                remaining.update(self.members.pop(root))
+        remaining -= ids
+
+        for id in ids:
+            self.parents.pop(id, None)
+        for id in remaining:
+            self.parents[id] = id
+            self.members[id] = {id}
+        if len(remaining) > 0:
+            for id_a, id_b in bidirectional_edges(remaining):
+                self.union(id_a, id_b)
+
+    def component(self, id: int) -> set:
+        """
+        this function returns the ids of the component the id belongs to
+        :return: component: set - a copy, so it isn't changed by later merges; empty if the id isn't part of the graph
+        """
+        if id not in self.parents:
+            return set()
+        return set(self.members[self.find(id)])
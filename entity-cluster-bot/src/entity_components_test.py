@@ -0,0 +1,69 @@
+import random
+
+import networkx as nx
+
+from entity_components import EntityComponents
+
+
+def bidirectional_components(graph: nx.DiGraph) -> set:
+    filtered_graph = nx.subgraph_view(graph, filter_edge=lambda n1, n2: graph.has_edge(n2, n1))
+    return {frozenset(component) for component in nx.connected_components(filtered_graph.to_undirected())}
+
+
+def bidirectional_edges(graph: nx.DiGraph, nodes=None) -> list:
+    return [(node_a, node_b) for node_a, node_b in graph.edges if graph.has_edge(node_b, node_a) and (nodes is None or (node_a in nodes and node_b in nodes))]
+
+
+def components(entity_components: EntityComponents, graph: nx.DiGraph) -> set:
+    return {frozenset(entity_components.component(node)) if node in entity_components.parents else frozenset([node]) for node in graph.nodes}
+
+
+class TestEntityComponents:
+    def test_bidirectional_edges_are_merged(self):
+        graph = nx.DiGraph([("a", "b"), ("b", "a"), ("b", "c")])
+        entity_components = EntityComponents()
+        entity_components.rebuild(graph.nodes, bidirectional_edges(graph))
+
+        assert entity_components.component("a") == {"a", "b"}, "addresses with a bidirectional edge should form a component"
+        assert entity_components.component("c") == {"c"}, "one directional edge should not merge components"
+        assert entity_components.component("d") == set(), "address that isn't part of the graph has no component"
+
+        graph.add_edge("c", "b")
+        entity_components.union("c", "b")
+        assert entity_components.component("a") == {"a", "b", "c"}, "components should be merged"
+
+    def test_removed_addresses_split_their_component(self):
+        graph = nx.DiGraph([("a", "b"), ("b", "a"), ("b", "c"), ("c", "b"), ("c", "d"), ("d", "c")])
+        entity_components = EntityComponents()
+        entity_components.rebuild(graph.nodes, bidirectional_edges(graph))
+        component = entity_components.component("a")
+
+        graph.remove_node("c")
+        entity_components.remove({"c"}, lambda remaining: bidirectional_edges(graph, remaining))
+
+        assert entity_components.component("a") == {"a", "b"}, "component should be split at the removed address"
+        assert entity_components.component("d") == {"d"}, "component should be split at the removed address"
+        assert entity_components.component("c") == set(), "removed address has no component"
+        assert component == {"a", "b", "c", "d"}, "returned component should not be changed by later updates"
+
+    def test_matches_connected_components(self):
+        random.seed(7)
+        graph = nx.DiGraph()
+        graph.add_nodes_from(range(60))
+        entity_components = EntityComponents()
+        entity_components.rebuild(graph.nodes, bidirectional_edges(graph))
+
+        for step in range(2000):
+            if step % 100 == 99:
+                removed = set(random.sample(list(graph.nodes), 10))
+                graph.remove_nodes_from(removed)
+                entity_components.remove(removed, lambda remaining: bidirectional_edges(graph, remaining))
+                new_node = max(graph.nodes) + 1
+                graph.add_nodes_from(range(new_node, new_node + 10))
+                continue
+            node_a, node_b = random.sample(list(graph.nodes), 2)
+            graph.add_edge(node_a, node_b)
+            if graph.has_edge(node_b, node_a):
+                entity_components.union(node_a, node_b)
+
+        assert components(entity_components, graph) == bidirectional_components(graph), "components should match the connected components of the bidirectional edges"
@@ -0,0 +1,110 @@
+import logging
+
+import requests
+from hexbytes import HexBytes
+from web3 import Web3
+
+
+class RpcCache:
+    """
+    per-block memo of the transaction counts and bytecode looked up by cluster_entities
+    the counts and bytecode cluster_entities looks up for a transaction are prefetched in one JSON-RPC batch request when the web3 provider exposes an HTTP endpoint;
+    otherwise (e.g. mocks) or for calls the batch didn't answer each lookup goes through w3.eth
+    transaction counts are looked up at the block of the transactions, so the memo is dropped once a transaction of another block is seen
+    """
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.session = requests.Session()
+        self.block_number = None
+        self.codes = {}  # lower case address -> HexBytes code
+        self.transaction_counts = {}  # lower case address -> transaction count at block_number
+        self.round_trips = 0
+        self.lookups = 0  # get_* calls of the current block
+        self.hits = 0  # get_* calls of the current block answered from the memo
+
+    def new_block(self, block_number: int):
+        """
+        this function drops the memo of the previous block, if the block number changed
+        """
+        if block_number == self.block_number:
+            return
+        if self.block_number is not None:
+            logging.info(f"JSON-RPC lookups of block {self.block_number}: {self.lookups} lookups, {self.hits} hits, {self.round_trips} round trips")
+        self.block_number = block_number
+        self.codes = {}
+        self.transaction_counts = {}
+        self.round_trips = 0
+        self.lookups = 0
+        self.hits = 0
+
+    def block_identifier(self):
+        return "latest" if self.block_number is None else self.block_number
+
+    @staticmethod
+    def request_kwargs(provider) -> dict:
+        """
+        this function returns the keyword arguments (headers, timeout, proxies, ...) the web3 provider sends its own requests with, so batch requests carry them as well
+        :return: request_kwargs: dict
+        """
+        get_request_kwargs = getattr(provider, "get_request_kwargs", None)
+        request_kwargs = dict(get_request_kwargs()) if get_request_kwargs is not None else {}
+        request_kwargs.setdefault("timeout", 60)
+        return request_kwargs
+
+    def prefetch(self, w3, transaction_count_addresses: list, code_addresses: list):
+        """
+        this function fetches the transaction counts and bytecode of the addresses that aren't memoized yet in one batch request of up to batch_size calls per request
+        addresses the batch didn't return a result for are fetched on get_transaction_count or get_code
+        """
+        calls = [("eth_getTransactionCount", address) for address in RpcCache.valid_addresses(transaction_count_addresses) if address not in self.transaction_counts]
+        calls += [("eth_getCode", address) for address in RpcCache.valid_addresses(code_addresses) if address not in self.codes]
+        endpoint_uri = getattr(getattr(w3, "provider", None), "endpoint_uri", None)
+        if endpoint_uri is None or len(calls) == 0:
+            return
+
+        request_kwargs = RpcCache.request_kwargs(w3.provider)
+        block_identifier = "latest" if self.block_number is None else hex(self.block_number)
+        for i in range(0, len(calls), self.batch_size):
+            batch = calls[i:i + self.batch_size]
+            payload = [{"jsonrpc": "2.0", "id": position, "method": method, "params": [Web3.toChecksumAddress(address), block_identifier if method == "eth_getTransactionCount" else "latest"]} for position, (method, address) in enumerate(batch)]
+            try:
+                self.round_trips += 1
+                response = self.session.post(str(endpoint_uri), json=payload, **request_kwargs)
+                response.raise_for_status()
+                for item in response.json():
+                    if item.get("result") is None:
+                        continue
+                    method, address = batch[item["id"]]
+                    if method == "eth_getTransactionCount":
+                        self.transaction_counts[address] = int(item["result"], 16)
+                    else:
+                        self.codes[address] = HexBytes(item["result"])
+            except Exception as e:
+                logging.warning(f"JSON-RPC batch of {len(batch)} calls failed: {e}")
+
+    @staticmethod
+    def valid_addresses(addresses: list) -> list:
+        """
+        this function returns the distinct lower case addresses, dropping None and invalid addresses
+        :return: addresses: list
+        """
+        return [address for address in dict.fromkeys(address.lower() for address in addresses if address is not None) if Web3.isAddress(address)]
+
+    def get_transaction_count(self, w3, address: str) -> int:
+        self.lookups += 1
+        if address.lower() in self.transaction_counts:
+            self.hits += 1
+        else:
+            self.round_trips += 1
+            self.transaction_counts[address.lower()] = w3.eth.get_transaction_count(Web3.toChecksumAddress(address), self.block_identifier())
+        return self.transaction_counts[address.lower()]
+
+    def get_code(self, w3, address: str) -> HexBytes:
+        self.lookups += 1
+        if address.lower() in self.codes:
+            self.hits += 1
+        else:
+            self.round_trips += 1
+            self.codes[address.lower()] = w3.eth.get_code(Web3.toChecksumAddress(address))
+        return self.codes[address.lower()]
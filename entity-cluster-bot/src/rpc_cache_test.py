@@ -0,0 +1,80 @@
+from hexbytes import HexBytes
+from web3 import HTTPProvider
+
+from rpc_cache import RpcCache
+from web3_mock import CONTRACT, EOA_ADDRESS_LARGE_TX, EOA_ADDRESS_SMALL_TX, Web3Mock
+
+
+class ProviderMock:
+    def __init__(self):
+        self.endpoint_uri = "http://localhost:8545"
+
+
+class ResponseMock:
+    def __init__(self, json_data: list):
+        self.json_data = json_data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.json_data
+
+
+class SessionMock:
+    def __init__(self, transaction_counts: dict, codes: dict):
+        self.results = {"eth_getTransactionCount": transaction_counts, "eth_getCode": codes}
+        self.payloads = []
+        self.request_kwargs = []
+
+    def post(self, url, json=None, **kwargs):
+        self.payloads.append(json)
+        self.request_kwargs.append(kwargs)
+        return ResponseMock([{"jsonrpc": "2.0", "id": call["id"], "result": self.results[call["method"]][call["params"][0]]} for call in json])
+
+
+class TestRpcCache:
+    def test_lookups_are_memoized_per_block(self):
+        w3 = Web3Mock()
+        rpc_cache = RpcCache(100)
+        rpc_cache.new_block(1)
+
+        assert rpc_cache.get_code(w3, CONTRACT.lower()) != HexBytes('0x'), "contract should have code"
+        assert rpc_cache.get_transaction_count(w3, EOA_ADDRESS_SMALL_TX) == 499, "transaction count should be fetched"
+        rpc_cache.new_block(1)
+        rpc_cache.get_code(w3, CONTRACT)
+        rpc_cache.get_transaction_count(w3, EOA_ADDRESS_SMALL_TX.lower())
+        assert rpc_cache.round_trips == 2, "lookups should be memoized within the block"
+        assert (rpc_cache.lookups, rpc_cache.hits) == (4, 2), "memoized lookups should be counted as hits"
+
+        rpc_cache.new_block(2)
+        rpc_cache.get_transaction_count(w3, EOA_ADDRESS_SMALL_TX)
+        assert rpc_cache.round_trips == 1, "transaction count should be refetched in a new block"
+
+    def test_prefetch_batches_calls(self):
+        w3 = Web3Mock()
+        w3.provider = ProviderMock()
+        rpc_cache = RpcCache(3)
+        rpc_cache.session = SessionMock({EOA_ADDRESS_SMALL_TX: "0x1f3", CONTRACT: "0x1"}, {EOA_ADDRESS_SMALL_TX: "0x", CONTRACT: "0x6080"})
+        rpc_cache.new_block(16)
+
+        rpc_cache.prefetch(w3, [EOA_ADDRESS_SMALL_TX, CONTRACT.lower(), None], [EOA_ADDRESS_SMALL_TX, CONTRACT])
+        assert rpc_cache.get_transaction_count(w3, EOA_ADDRESS_SMALL_TX) == 499, "transaction count should be prefetched"
+        assert rpc_cache.get_code(w3, CONTRACT) == HexBytes("0x6080"), "code should be prefetched"
+        assert rpc_cache.round_trips == 2, "4 calls should be sent as 2 batches of up to 3 calls"
+        assert rpc_cache.session.payloads[0][0]["params"] == [EOA_ADDRESS_SMALL_TX, "0x10"], "transaction count should be fetched at the block"
+
+        rpc_cache.prefetch(w3, [EOA_ADDRESS_SMALL_TX, EOA_ADDRESS_LARGE_TX.lower()[:10]], [CONTRACT])
+        assert rpc_cache.round_trips == 2, "memoized and invalid addresses should not be fetched"
+
+    def test_prefetch_carries_provider_request_kwargs(self):
+        w3 = Web3Mock()
+        w3.provider = HTTPProvider("http://localhost:8545", request_kwargs={"headers": {"Authorization": "Bearer token"}, "timeout": 5})
+        rpc_cache = RpcCache(3)
+        rpc_cache.session = SessionMock({CONTRACT: "0x1"}, {CONTRACT: "0x6080"})
+        rpc_cache.new_block(16)
+
+        rpc_cache.prefetch(w3, [CONTRACT], [CONTRACT])
+
+        assert rpc_cache.session.request_kwargs[0]["headers"] == {"Authorization": "Bearer token"}, "batch request should carry the headers of the provider"
+        assert rpc_cache.session.request_kwargs[0]["timeout"] == 5, "batch request should use the timeout of the provider"
@@ -0,0 +1,109 @@
+import logging
+import pickle
+import queue
+import threading
+import zlib
+
+
+class StateLog:
+    """
+    persists the bot state as compressed snapshots of the full state plus an append-only log of deltas written in between
+    snapshots and deltas are pickled on the calling thread, so they capture a consistent state, and compressed and written in order from a background thread
+    each snapshot starts a new epoch; deltas are numbered within their epoch, so deltas left behind by an earlier epoch are not replayed
+    once a write fails, the remaining deltas of the epoch are dropped and snapshot_needed is set, so the next write has to be a snapshot
+    """
+
+    def __init__(self, key: str, persist, load, remove=None):
+        self.key = key
+        self.persist = persist  # (bytes, key) -> None; raises if the bytes couldn't be written
+        self.load = load  # key -> bytes or None if the key doesn't exist
+        self.remove = remove  # key -> bool whether the key existed; removes the deltas of earlier epochs once a snapshot is written, if set
+        self.epoch = 0
+        self.sequence = 0  # number of the last delta of the epoch
+        self.snapshot_needed = True
+        self.failed_epoch = None
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def snapshot_key(self) -> str:
+        return f"{self.key}_snapshot"
+
+    def delta_key(self, sequence: int) -> str:
+        return f"{self.key}_delta_{sequence}"
+
+    def read(self) -> tuple:
+        """
+        this function reads the last snapshot and the deltas of its epoch; later writes continue the epoch
+        :return: (snapshot, deltas): snapshot is None if no snapshot was written yet, in which case deltas is empty
+        """
+        content = self.load(self.snapshot_key())
+        if content is None:
+            self.epoch, self.sequence, self.snapshot_needed = 0, 0, True
+            return None, []
+        snapshot = pickle.loads(zlib.decompress(content))
+        self.epoch, self.sequence, self.snapshot_needed = snapshot["epoch"], 0, False
+
+        deltas = []
+        while True:
+            content = self.load(self.delta_key(self.sequence + 1))
+            if content is None:
+                break
+            delta = pickle.loads(zlib.decompress(content))
+            if delta["epoch"] != self.epoch:
+                break
+            deltas.append(delta["state"])
+            self.sequence += 1
+        logging.info(f"Read snapshot of epoch {self.epoch} and {len(deltas)} deltas")
+        return snapshot["state"], deltas
+
+    def write_snapshot(self, state: object):
+        """
+        this function starts a new epoch with a snapshot of the full state
+        """
+        self.epoch += 1
+        self.sequence = 0
+        self.snapshot_needed = False
+        self.write(self.snapshot_key(), {"epoch": self.epoch, "state": state})
+
+    def write_delta(self, state: object):
+        """
+        this function appends a delta to the log of the current epoch
+        """
+        self.sequence += 1
+        self.write(self.delta_key(self.sequence), {"epoch": self.epoch, "sequence": self.sequence, "state": state})
+
+    def write(self, key: str, content: dict):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.work, daemon=True)
+            self.thread.start()
+        self.queue.put((key, content["epoch"], content.get("sequence"), pickle.dumps(content, protocol=pickle.HIGHEST_PROTOCOL)))
+
+    def work(self):
+        while True:
+            key, epoch, sequence, content = self.queue.get()
+            try:
+                if sequence is not None and epoch == self.failed_epoch:
+                    logging.info(f"Dropped delta {key} of failed epoch {epoch}")
+                    continue
+                compressed = zlib.compress(content)
+                self.persist(compressed, key)
+                logging.info(f"Wrote {key} of epoch {epoch}: {len(compressed)} bytes")
+                if sequence is None and self.remove is not None:
+                    self.remove_deltas()
+            except Exception as e:
+                logging.warning(f"Failed to write {key} of epoch {epoch}: {e}")
+                self.failed_epoch = epoch
+                self.snapshot_needed = True
+            finally:
+                self.queue.task_done()
+
+    def remove_deltas(self):
+        sequence = 1
+        while self.remove(self.delta_key(sequence)):
+            sequence += 1
+
+    def wait(self):
+        """
+        this function blocks until all snapshots and deltas are written
+        """
+        self.queue.join()
@@ -0,0 +1,66 @@
+from state_log import StateLog
+
+
+class StoreMock:
+    def __init__(self):
+        self.contents = {}
+        self.failing_keys = set()
+
+    def persist(self, content: bytes, key: str):
+        if key in self.failing_keys:
+            raise Exception(f"failed to write {key}")
+        self.contents[key] = content
+
+    def load(self, key: str) -> bytes:
+        return self.contents.get(key)
+
+    def remove(self, key: str) -> bool:
+        return self.contents.pop(key, None) is not None
+
+
+class TestStateLog:
+    def test_snapshot_and_deltas(self):
+        store = StoreMock()
+        state_log = StateLog("state", store.persist, store.load, store.remove)
+        assert state_log.read() == (None, []), "nothing should be read before a snapshot is written"
+        assert state_log.snapshot_needed, "a snapshot should be needed before deltas can be written"
+
+        state_log.write_snapshot({"a": 1})
+        state_log.write_delta([1])
+        state_log.write_delta([2])
+        state_log.wait()
+
+        state_log = StateLog("state", store.persist, store.load, store.remove)
+        assert state_log.read() == ({"a": 1}, [[1], [2]]), "snapshot and deltas should be read in order"
+        state_log.write_delta([3])
+        state_log.wait()
+        assert state_log.read() == ({"a": 1}, [[1], [2], [3]]), "written deltas should continue the epoch"
+
+        state_log.write_snapshot({"a": 2})
+        state_log.wait()
+        assert set(store.contents.keys()) == {"state_snapshot"}, "deltas of the earlier epoch should have been removed"
+
+    def test_deltas_of_earlier_epoch_are_not_replayed(self):
+        store = StoreMock()
+        state_log = StateLog("state", store.persist, store.load)
+        state_log.write_snapshot({"a": 1})
+        state_log.write_delta([1])
+        state_log.write_delta([2])
+        state_log.write_snapshot({"a": 2})
+        state_log.write_delta([3])
+        state_log.wait()
+
+        assert state_log.read() == ({"a": 2}, [[3]]), "delta 2 of the earlier epoch should not be replayed"
+
+    def test_failed_delta_needs_snapshot(self):
+        store = StoreMock()
+        state_log = StateLog("state", store.persist, store.load)
+        state_log.write_snapshot({"a": 1})
+        store.failing_keys.add("state_delta_1")
+        state_log.write_delta([1])
+        state_log.write_delta([2])
+        state_log.wait()
+
+        assert "state_delta_2" not in store.contents, "deltas after a failed delta should be dropped"
+        assert state_log.snapshot_needed, "a snapshot should be needed after a failed delta"
+        assert state_log.read() == ({"a": 1}, []), "only the snapshot should be read"
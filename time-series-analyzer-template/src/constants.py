@@ -1 +1,4 @@
 TIMESTAMP_QUEUE_SIZE = 100  # the number of timestamps that are held in the queue
+ALERT_FIELDS = ["createdAt", "findingType", "severity"]  # alert fields requested from the Forta API; alerts are counted per minute as they arrive and the finding takes type and severity of the first alert
+DETECTION_DEADLINE_IN_SECONDS = 300  # a detection run skips model training once it exceeds the deadline
+DETECTION_QUEUE_SIZE = 10  # max number of pending blocks; the scheduler only runs the latest of them
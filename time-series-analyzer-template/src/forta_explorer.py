@@ -6,17 +6,107 @@ from datetime import datetime
 import pandas as pd
 import requests
 
+ALERT_FIELDS = {  # GraphQL selection of each alert field; alerts are requested with the selection of the requested fields only
+    "createdAt": "createdAt",
+    "name": "name",
+    "protocol": "protocol",
+    "findingType": "findingType",
+    "source": """source {
+                            transactionHash
+                            block {
+                            number
+                            chainId
+                            }
+                            bot {
+                            id
+                            }
+                        }""",
+    "severity": "severity",
+    "metadata": "metadata",
+    "alertId": "alertId",
+    "description": "description",
+    "addresses": "addresses",
+    "contracts": """contracts {
+                            address
+                            name
+                            projectId
+                        }""",
+    "hash": "hash"}
+REQUIRED_FIELDS = ["createdAt"]  # always requested as the alerts are bucketed by it
+
 
 class FortaExplorer:
 
-    def empty_alerts(self) -> pd.DataFrame:
-        df_forta = pd.DataFrame(columns=['createdAt', 'name', 'protocol', 'findingType', 'source', 'severity', 'metadata', 'alertId', 'description', 'addresses', 'contracts', 'hash'])
+    def empty_alerts(self, fields: list = None) -> pd.DataFrame:
+        df_forta = pd.DataFrame(columns=FortaExplorer.columns(fields))
         return df_forta
 
-    def alerts_by_bot(self, bot_id: str, alert_name: str, contract_address: str, start_date: datetime, end_date: datetime) -> pd.DataFrame:
+    @staticmethod
+    def columns(fields: list = None) -> list:
+        """
+        this function returns the columns of the alerts fetched with the given fields: the requested and required fields in query order
+        :return: columns: list
+        """
+        return [field for field in ALERT_FIELDS.keys() if fields is None or field in fields or field in REQUIRED_FIELDS]
+
+    def alerts_by_bot(self, bot_id: str, alert_name: str, contract_address: str, start_date: datetime, end_date: datetime, fields: list = None) -> pd.DataFrame:
+        """
+        this function fetches the alerts of the bot/ alert name for the contract address; only the given fields (and createdAt) are requested, None requests all fields
+        :return: df_forta: pd.DataFrame with FortaExplorer.columns(fields)
+        """
+        return FortaExplorer.collect_alerts(self.alert_pages(bot_id, alert_name, contract_address, start_date, end_date, fields), fields)
+
+    def alert_counts_by_bot(self, bot_id: str, alert_name: str, contract_address: str, start_date: datetime, end_date: datetime, fields: list = None) -> pd.DataFrame:
+        """
+        this function counts the alerts of the bot/ alert name for the contract address per minute as the pages arrive, so only one page of alerts is held at a time
+        minutes are a common refinement of all bucket windows in minutes, so resampling the counts yields the same buckets as resampling the alerts
+        :return: df_counts: pd.DataFrame with columns createdAt (minute), count and the other given fields taken from the first alert of the minute, in minute order
+        """
+        return FortaExplorer.count_alerts(self.alert_pages(bot_id, alert_name, contract_address, start_date, end_date, fields), fields)
+
+    @staticmethod
+    def collect_alerts(pages, fields: list = None) -> pd.DataFrame:
+        """
+        this function collects the alerts of the pages yielded by alert_pages into one list per column and builds the DataFrame once at the end
+        :return: df_forta: pd.DataFrame with FortaExplorer.columns(fields)
+        """
+        columns = {column: [] for column in FortaExplorer.columns(fields)}
+        for page_alerts in pages:
+            for column, values in columns.items():
+                values.extend(alert.get(column) for alert in page_alerts)
+        df_forta = pd.DataFrame(columns, columns=list(columns.keys()))
+        df_forta["createdAt"] = pd.to_datetime(df_forta["createdAt"], utc=True)
+        return df_forta
+
+    @staticmethod
+    def count_alerts(pages, fields: list = None) -> pd.DataFrame:
+        """
+        this function aggregates the alerts of the pages yielded by alert_pages into counts per minute; each page is reduced before the next one is fetched
+        :return: df_counts: pd.DataFrame with columns createdAt (minute), count and the other given fields taken from the first alert of the minute, in minute order
+        """
+        other_columns = [column for column in FortaExplorer.columns(fields) if column != "createdAt"]
+        page_counts = []
+        for page_alerts in pages:
+            df_page = FortaExplorer.collect_alerts([page_alerts], fields)
+            df_page["createdAt"] = df_page["createdAt"].dt.floor("min")
+            page_counts.append(df_page.groupby("createdAt", sort=False).agg(count=("createdAt", "size"), **{column: (column, "first") for column in other_columns}))
+
+        df_counts = pd.concat([FortaExplorer.empty_counts(fields)] + page_counts)
+        df_counts = df_counts.groupby(level=0, sort=True).agg({"count": "sum", **{column: "first" for column in other_columns}}).astype({"count": "int64"})
+        return df_counts.rename_axis("createdAt").reset_index()
+
+    @staticmethod
+    def empty_counts(fields: list = None) -> pd.DataFrame:
+        return pd.DataFrame(columns=["count"] + [column for column in FortaExplorer.columns(fields) if column != "createdAt"], index=pd.DatetimeIndex([], tz="UTC", name="createdAt"))
+
+    def alert_pages(self, bot_id: str, alert_name: str, contract_address: str, start_date: datetime, end_date: datetime, fields: list = None):
+        """
+        this function is a generator over the pages of alerts of the bot/ alert name for the contract address; each page is yielded as soon as it is decoded
+        :return: yields page_alerts: list of alert dicts as returned by the API
+        """
         url = "https://api.forta.network/graphql"
+        selection = "\n                        ".join([ALERT_FIELDS[field] for field in FortaExplorer.columns(fields)])
 
-        df_forta = self.empty_alerts()
         json_data = ""
         first_run = True
         count = 0
@@ -40,31 +130,7 @@ class FortaExplorer:
                         }
                         }
                         alerts {
-                        createdAt
-                        name
-                        protocol
-                        findingType
-                        source {
-                            transactionHash
-                            block {
-                            number
-                            chainId
-                            }
-                            bot {
-                            id
-                            }
-                        }
-                        severity
-                        metadata
-                        alertId
-                        description
-                        addresses
-                        contracts {
-                            address
-                            name
-                            projectId
-                        }
-                        hash
+                        FIELDS
                         }
                     }
                     }"""
@@ -78,6 +144,7 @@ class FortaExplorer:
             # this is a bit hacky
             query = query.replace("AFTER_CLAUSE", after_clause)
             query = query.replace("BLOCK_RANGE_CLAUSE", """blockDateRange: {{ startDate: "{0}", endDate: "{1}" }}""".format(datetime.strftime(start_date, "%Y-%m-%d"), datetime.strftime(end_date, "%Y-%m-%d")))
+            query = query.replace("FIELDS", selection)
             query = query.replace("BOT_CLAUSE", f"""bots: ["{bot_id}"]""")
             query = query.replace("ALERT_NAME_CLAUSE", f"""alertName: "{alert_name}" """)
             query = query.replace("CONTRACT_ADDRESS_CLAUSE", f"""addresses: ["{contract_address}"]""")
@@ -102,11 +169,7 @@ class FortaExplorer:
                         raise Exception("Unable to retrieve alerts even after repeated retries. Pls check logs")
 
             json_data = json.loads(r.text)
-            df_data = json_data['data']['alerts']['alerts']
-            df_forta = pd.concat([pd.DataFrame(df_data), df_forta])
-            df_forta["createdAt"] = pd.to_datetime(df_forta["createdAt"], utc=True)
 
             first_run = False
             count += 1
-
-        return df_forta
+            yield json_data['data']['alerts']['alerts']
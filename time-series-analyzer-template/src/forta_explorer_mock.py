@@ -2,17 +2,22 @@ from datetime import datetime
 
 import pandas as pd
 
+from src.forta_explorer import FortaExplorer
+
 
 class FortaExplorerMock:
 
     df = pd.DataFrame(columns=['createdAt', 'name', 'protocol', 'findingType', 'source', 'severity', 'metadata', 'alertId', 'description', 'addresses', 'contracts', 'hash'])
 
-    def empty_alerts(self) -> pd.DataFrame:
+    def empty_alerts(self, fields: list = None) -> pd.DataFrame:
         df_forta = pd.DataFrame(columns=['createdAt', 'name', 'protocol', 'findingType', 'source', 'severity', 'metadata', 'alertId', 'description', 'addresses', 'contracts', 'hash'])
         return df_forta
 
-    def alerts_by_bot(self, bot_id: str, agent_name: str, contract_address: str, start_date: datetime, end_date: datetime) -> pd.DataFrame:
+    def alerts_by_bot(self, bot_id: str, agent_name: str, contract_address: str, start_date: datetime, end_date: datetime, fields: list = None) -> pd.DataFrame:
         return self.df
 
+    def alert_counts_by_bot(self, bot_id: str, agent_name: str, contract_address: str, start_date: datetime, end_date: datetime, fields: list = None) -> pd.DataFrame:
+        return FortaExplorer.count_alerts([self.df.to_dict("records")], fields)
+
     def set_df(self, df_forta: pd.DataFrame):
         self.df = df_forta
@@ -1,8 +1,26 @@
+import json
 from datetime import datetime, timedelta
 
+import pandas as pd
+
+import forta_explorer
 from forta_explorer import FortaExplorer
 
 
+class ResponseMock:
+    def __init__(self, data: dict):
+        self.status_code = 200
+        self.text = json.dumps(data)
+
+
+def paged_post(pages: list, queries: list):
+    def post(url, json):
+        queries.append(json['query'])
+        page = len(queries)
+        return ResponseMock({"data": {"alerts": {"pageInfo": {"hasNextPage": page < len(pages), "endCursor": {"alertId": "ALERT-1", "blockNumber": page}}, "alerts": pages[page - 1]}}})
+    return post
+
+
 class TestFortaExplorer:
     def test_empty_alerts(self):
         df = FortaExplorer().empty_alerts()
@@ -17,3 +35,43 @@ class TestFortaExplorer:
 
         alerts = df["alertId"].unique()
         assert len(alerts) > 0, "no alerts returned"
+
+    def test_alerts_by_bot_requests_only_given_fields(self, monkeypatch):
+        queries = []
+
+        def post(url, json):
+            queries.append(json['query'])
+            return ResponseMock({"data": {"alerts": {"pageInfo": {"hasNextPage": False, "endCursor": None}, "alerts": [{"createdAt": "2022-04-30T23:55:17.284158264Z", "hash": "0x1"}]}}})
+
+        monkeypatch.setattr(forta_explorer.requests, "post", post)
+        df = FortaExplorer().alerts_by_bot("0xbot", "alert name", "0xcontract", datetime(2022, 4, 29), datetime(2022, 4, 30), ["hash"])
+
+        assert "hash" in queries[0] and "createdAt" in queries[0], "query should contain the requested and required fields"
+        assert "source" not in queries[0] and "description" not in queries[0], "query should not contain fields that weren't requested"
+        assert df.columns.tolist() == ["createdAt", "hash"], "only the requested and required fields should be returned"
+
+    def test_alerts_by_bot_collects_all_pages(self, monkeypatch):
+        queries = []
+        pages = [[{"createdAt": "2022-04-30T23:55:17.284158264Z", "hash": "0x1"}, {"createdAt": "2022-04-30T23:56:17.284158264Z", "hash": "0x2"}], [{"createdAt": "2022-04-30T23:57:17.284158264Z", "hash": "0x3"}]]
+        monkeypatch.setattr(forta_explorer.requests, "post", paged_post(pages, queries))
+
+        df = FortaExplorer().alerts_by_bot("0xbot", "alert name", "0xcontract", datetime(2022, 4, 29), datetime(2022, 4, 30), ["hash"])
+
+        assert len(queries) == 2, "all pages should be fetched"
+        assert df["hash"].tolist() == ["0x1", "0x2", "0x3"], "alerts of all pages should be collected in query order"
+        assert str(df["createdAt"].dtype) == "datetime64[ns, UTC]", "createdAt should be parsed"
+
+    def test_alert_counts_by_bot_match_resampled_alerts(self, monkeypatch):
+        created_ats = [datetime(2022, 4, 30, 10, 3, 5) + timedelta(seconds=97 * i) for i in range(200)]
+        alerts = [{"createdAt": created_at.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), "findingType": "SUSPICIOUS", "severity": "HIGH"} for created_at in created_ats]
+        monkeypatch.setattr(forta_explorer.requests, "post", paged_post([alerts[0:70], alerts[70:150], alerts[150:]], []))
+
+        df_counts = FortaExplorer().alert_counts_by_bot("0xbot", "alert name", "0xcontract", datetime(2022, 4, 29), datetime(2022, 4, 30), ["findingType", "severity"])
+        df_alerts = FortaExplorer.collect_alerts([alerts], ["findingType", "severity"])
+
+        assert df_counts["count"].sum() == 200, "all alerts should be counted"
+        assert df_counts.iloc[0]["findingType"] == "SUSPICIOUS", "fields should be taken from the first alert"
+        for bucket in ["5min", "7min", "60min"]:
+            expected = df_alerts.resample(bucket, on="createdAt").size()
+            actual = df_counts.resample(bucket, on="createdAt")["count"].sum()
+            pd.testing.assert_series_equal(actual, expected, check_names=False, check_freq=False)